@@ -0,0 +1,391 @@
+"""
+Bulk management of registered users, for migrating instances and rotating keys.
+
+    python admin.py export [-o users.jsonl]
+    python admin.py import users.csv [--keep-existing]
+    python admin.py validate [--workers 16] [--report report.jsonl] [--prune]
+
+Files are JSON Lines ({"user_id": ..., "api_key": ...} per line) or CSV
+with a user_id,api_key header, chosen by file extension unless --format is
+given; "-" means stdin or stdout. Files are streamed rather than loaded
+whole, and an import is a single transaction, so a bad row leaves the
+database untouched.
+
+Runs against the bot's DB_FILE while the bot keeps running: bot processes
+see imported, replaced and pruned keys within API_KEY_CACHE_CHECK_INTERVAL
+seconds.
+"""
+
+import os
+import sys
+import csv
+import json
+import math
+import time
+import asyncio
+import logging
+import argparse
+import contextlib
+
+from config import load_config
+
+# Load environment variables from .env file, before the modules below read their settings
+load_config()
+
+import db
+from api_handler import check_api_key, key_check_breaker, KeyCheckUnsupported
+from cache import TTLCache, MISSING
+from client_pool import shapes_clients
+
+# Set up logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+
+logger = logging.getLogger(__name__)
+
+# API keys checked against the Shapes API at the same time
+ADMIN_CHECK_WORKERS = int(os.environ.get("ADMIN_CHECK_WORKERS", "16"))
+
+# Times a key the Shapes API couldn't be asked about is checked again, first after
+# the key check breaker's cooldown, then twice as long each time
+ADMIN_CHECK_RETRIES = int(os.environ.get("ADMIN_CHECK_RETRIES", "3"))
+
+# Seconds after the first of those retries in which keys are still checked again;
+# later unknown results are reported straight away, so an outage can't stall a run
+ADMIN_CHECK_RETRY_TIME = float(os.environ.get("ADMIN_CHECK_RETRY_TIME", "600"))
+
+# Results remembered for keys shared by several users (least recently used are forgotten)
+ADMIN_CHECK_CACHE_SIZE = int(os.environ.get("ADMIN_CHECK_CACHE_SIZE", "10000"))
+
+# Users read from the database per query
+BATCH_SIZE = 1000
+
+# Log progress every this many users while validating
+PROGRESS_INTERVAL = 1000
+
+USER_FIELDS = ("user_id", "api_key")
+REPORT_FIELDS = ("user_id", "status")
+
+# check_api_key() result -> status in the validation report
+STATUSES = {True: "valid", False: "rejected", None: "unknown"}
+
+
+def file_format(path, requested=None):
+    """
+    Pick the format of a users file.
+
+    Args:
+        path (str): The file, or "-" for stdin/stdout
+        requested (str, optional): "jsonl" or "csv", overriding the extension
+
+    Returns:
+        str: "jsonl" or "csv"
+    """
+    if requested:
+        return requested
+    return "csv" if path.lower().endswith(".csv") else "jsonl"
+
+
+def open_file(path, mode):
+    """
+    Open a file for reading or writing, with "-" meaning stdin or stdout
+    """
+    if path == "-":
+        return contextlib.nullcontext(sys.stdin if mode == "r" else sys.stdout)
+    # csv handles line endings itself
+    return open(path, mode, newline="", encoding="utf-8")
+
+
+def _user_row(line, record):
+    """
+    Check one imported record and convert it to a (user_id, api_key) row
+    """
+    try:
+        user_id = int(record["user_id"])
+        api_key = str(record["api_key"]).strip()
+    except (KeyError, TypeError, ValueError):
+        raise ValueError(f"Line {line}: expected an integer user_id and an api_key")
+    if not api_key:
+        raise ValueError(f"Line {line}: api_key is empty")
+    return user_id, api_key
+
+
+def read_users(file, fmt):
+    """
+    Read users from an import file, one row at a time.
+
+    Args:
+        file (file): The open file
+        fmt (str): "jsonl" or "csv"
+
+    Yields:
+        tuple: (user_id, api_key)
+
+    Raises:
+        ValueError: At the first malformed row
+    """
+    if fmt == "csv":
+        reader = csv.DictReader(file)
+        for record in reader:
+            yield _user_row(reader.line_num, record)
+        return
+
+    for line, text in enumerate(file, 1):
+        if not text.strip():
+            continue
+        try:
+            record = json.loads(text)
+        except ValueError:
+            raise ValueError(f"Line {line}: not valid JSON")
+        yield _user_row(line, record)
+
+
+class RowWriter:
+    """
+    Writes rows of fixed fields to an open file as JSON Lines or CSV.
+    """
+
+    def __init__(self, file, fmt, fields):
+        self.file = file
+        self.fields = fields
+        self.count = 0
+        self._csv = None
+        if fmt == "csv":
+            self._csv = csv.writer(file)
+            self._csv.writerow(fields)
+
+    def write(self, row):
+        if self._csv is not None:
+            self._csv.writerow(row)
+        else:
+            self.file.write(json.dumps(dict(zip(self.fields, row))) + "\n")
+        self.count += 1
+
+
+def export_users(args):
+    """
+    Write every registered user to a file
+    """
+    with open_file(args.output, "w") as file:
+        writer = RowWriter(file, file_format(args.output, args.format), USER_FIELDS)
+        for row in db.iter_api_keys(BATCH_SIZE):
+            writer.write(row)
+
+    logger.info(f"Exported {writer.count} users")
+    return 0
+
+
+def import_users(args):
+    """
+    Register every user in a file, in one transaction
+    """
+    with open_file(args.file, "r") as file:
+        try:
+            stored = db.store_api_keys(read_users(file, file_format(args.file, args.format)),
+                                       replace=not args.keep_existing)
+        except ValueError as e:
+            logger.error(f"Nothing imported: {str(e)}")
+            return 1
+
+    logger.info(f"Imported {stored} users")
+    return 0
+
+
+class RetryWindow:
+    """
+    Limits how long a validation run keeps checking keys again.
+
+    The window opens at the first retry and lasts ADMIN_CHECK_RETRY_TIME
+    seconds, however many keys are retried in it.
+    """
+
+    def __init__(self, seconds=ADMIN_CHECK_RETRY_TIME):
+        self.seconds = seconds
+        self.deadline = None
+
+    def allows(self, delay):
+        """
+        Check whether a retry after the given delay still falls within the window
+        """
+        now = time.monotonic()
+        if self.deadline is None:
+            self.deadline = now + self.seconds
+        return now + delay <= self.deadline
+
+
+async def check_key(api_key, window, retries=ADMIN_CHECK_RETRIES):
+    """
+    Check a key, asking again later while the Shapes API can't tell.
+
+    Args:
+        api_key (str): The API key to check
+        window (RetryWindow): The run's time left for retries
+        retries (int): Extra checks after an unknown result
+
+    Returns:
+        bool or None: As check_api_key(), None if every check was unknown
+
+    Raises:
+        KeyCheckUnsupported: As check_api_key()
+    """
+    delay = key_check_breaker.reset_timeout
+    for attempt in range(retries + 1):
+        result = await check_api_key(api_key)
+        if result is not None or attempt == retries or not window.allows(delay):
+            return result
+        # Long enough for an open breaker to let a trial call through
+        await asyncio.sleep(delay)
+        delay *= 2
+
+
+async def check_users(workers, report=None):
+    """
+    Check every registered user's key against the Shapes API.
+
+    Users are read from the database in batches while a fixed number of
+    workers check their keys, so memory use stays flat however many users
+    there are. Users who share a key have it checked once while their
+    checks overlap, and again only if its result has dropped out of a
+    cache of ADMIN_CHECK_CACHE_SIZE keys.
+
+    Args:
+        workers (int): Keys checked at the same time
+        report (RowWriter, optional): Gets a (user_id, status) row per user
+
+    Returns:
+        tuple: (status -> number of users, (user_id, api_key) rows whose key was rejected)
+
+    Raises:
+        KeyCheckUnsupported: If the Shapes API can't check keys at all
+    """
+    queue = asyncio.Queue(maxsize=workers * 2)
+    window = RetryWindow()
+    # api_key -> check in progress
+    checking = {}
+    # api_key -> check_api_key() result, kept for the whole run
+    results = TTLCache(ADMIN_CHECK_CACHE_SIZE, math.inf)
+    counts = dict.fromkeys(STATUSES.values(), 0)
+    rejected = []
+
+    async def check(api_key):
+        result = results.get(api_key)
+        if result is not MISSING:
+            return result
+        task = checking.get(api_key)
+        if task is None:
+            task = checking[api_key] = asyncio.ensure_future(check_key(api_key, window))
+            task.add_done_callback(lambda task: checking.pop(api_key, None))
+        result = await task
+        results.set(api_key, result)
+        return result
+
+    async def read():
+        after = None
+        while True:
+            rows = await db.run_in_db_thread(db.list_api_keys, after, BATCH_SIZE)
+            for row in rows:
+                await queue.put(row)
+            if len(rows) < BATCH_SIZE:
+                break
+            after = rows[-1][0]
+        for _ in range(workers):
+            await queue.put(None)
+
+    async def work():
+        while (row := await queue.get()) is not None:
+            user_id, api_key = row
+            status = STATUSES[await check(api_key)]
+
+            counts[status] += 1
+            if status == "rejected":
+                rejected.append(row)
+            if report is not None:
+                report.write((user_id, status))
+
+            checked = sum(counts.values())
+            if checked % PROGRESS_INTERVAL == 0:
+                logger.info(f"Checked {checked} users")
+
+    tasks = [asyncio.ensure_future(read()), *(asyncio.ensure_future(work()) for _ in range(workers))]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # One failed check ends the run; don't leave the others going
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return counts, rejected
+
+
+async def validate_users(args):
+    """
+    Check every registered user's key, optionally deleting the rejected ones
+    """
+    try:
+        if args.report:
+            with open_file(args.report, "w") as file:
+                report = RowWriter(file, file_format(args.report, args.format), REPORT_FIELDS)
+                counts, rejected = await check_users(args.workers, report)
+        else:
+            counts, rejected = await check_users(args.workers)
+    except KeyCheckUnsupported as e:
+        logger.error(f"The Shapes API can't check keys, so none were checked: {str(e)}")
+        return 1
+    finally:
+        await shapes_clients.close()
+
+    logger.info(", ".join(f"{count} {status}" for status, count in counts.items()))
+    if counts["unknown"]:
+        logger.warning(f"{counts['unknown']} keys could not be checked; they are never pruned")
+
+    if args.prune and rejected:
+        # Users who registered a new key since the check are kept
+        deleted = await db.run_in_db_thread(db.delete_api_keys, rejected)
+        logger.info(f"Pruned {deleted} users with rejected keys")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk management of registered users")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    # Every command reads or writes a users file
+    file_options = argparse.ArgumentParser(add_help=False)
+    file_options.add_argument("--format", choices=["jsonl", "csv"],
+                              help="File format (default: csv for .csv files, jsonl otherwise)")
+
+    export_parser = commands.add_parser("export", parents=[file_options],
+                                        help="Write all users and their keys to a file")
+    export_parser.add_argument("-o", "--output", default="-", help="File to write (default: stdout)")
+
+    import_parser = commands.add_parser("import", parents=[file_options],
+                                        help="Register the users in a file")
+    import_parser.add_argument("file", help="File to read, or - for stdin")
+    import_parser.add_argument("--keep-existing", action="store_true",
+                               help="Don't overwrite the keys of users already registered")
+
+    validate_parser = commands.add_parser("validate", parents=[file_options],
+                                          help="Check every user's key against the Shapes API")
+    validate_parser.add_argument("--workers", type=int, default=ADMIN_CHECK_WORKERS,
+                                 help=f"Keys checked at the same time (default: {ADMIN_CHECK_WORKERS})")
+    validate_parser.add_argument("--report", help="File to write each user's result to")
+    validate_parser.add_argument("--prune", action="store_true",
+                                 help="Delete users whose key was rejected")
+
+    args = parser.parse_args(argv)
+
+    db.init_db()
+    try:
+        if args.command == "export":
+            return export_users(args)
+        if args.command == "import":
+            return import_users(args)
+        return asyncio.run(validate_users(args))
+    finally:
+        db.close_db()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
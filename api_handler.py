@@ -1,10 +1,17 @@
 import os
+import time
 import logging
-from openai import OpenAI
-from dotenv import load_dotenv
+import contextlib
+
+from config import load_config
 
 # Load environment variables from .env file
-load_dotenv()
+load_config()
+
+from client_pool import shapes_clients
+from resilience import CircuitBreaker, CircuitOpenError, call_with_retries
+from metrics import SHAPES_REQUEST_SECONDS, SHAPES_ERRORS_TOTAL
+from profiling import span, span_iter
 
 # Set up logging
 logger = logging.getLogger(__name__)
@@ -16,38 +23,248 @@ SHAPES_API_URL = os.environ.get("SHAPES_API_URL", "https://api.shapes.inc/v1/")
 # Log the model we're using for debugging
 logger.info(f"Configured to use Shapes model: {SHAPES_MODEL}")
 
-def process_message(message_text, api_key):
+# Per-attempt timeouts in seconds (image generation takes much longer; inline
+# results are only useful while the user is still looking at the query)
+SHAPES_TIMEOUT = float(os.environ.get("SHAPES_TIMEOUT", "60"))
+SHAPES_IMAGINE_TIMEOUT = float(os.environ.get("SHAPES_IMAGINE_TIMEOUT", "180"))
+SHAPES_INLINE_TIMEOUT = float(os.environ.get("SHAPES_INLINE_TIMEOUT", "8"))
+COMMAND_TIMEOUTS = {"imagine": SHAPES_IMAGINE_TIMEOUT, "inline": SHAPES_INLINE_TIMEOUT}
+
+# Retries for transient errors, with exponential backoff and jitter
+SHAPES_RETRIES = int(os.environ.get("SHAPES_RETRIES", "2"))
+# Telegram gives up on an inline query after about 10 seconds, so those aren't retried
+COMMAND_RETRIES = {"inline": 0}
+SHAPES_RETRY_BASE_DELAY = float(os.environ.get("SHAPES_RETRY_BASE_DELAY", "0.5"))
+SHAPES_RETRY_MAX_DELAY = float(os.environ.get("SHAPES_RETRY_MAX_DELAY", "8"))
+
+# Stop calling the Shapes API for a while after this many consecutive failures
+SHAPES_BREAKER_THRESHOLD = int(os.environ.get("SHAPES_BREAKER_THRESHOLD", "5"))
+SHAPES_BREAKER_COOLDOWN = float(os.environ.get("SHAPES_BREAKER_COOLDOWN", "30"))
+
+class ErrorReply(str):
+    """
+    A user-facing error message returned in place of a Shapes response
+    """
+
+# Shared circuit breaker for the Shapes API
+shapes_breaker = CircuitBreaker("Shapes API", SHAPES_BREAKER_THRESHOLD, SHAPES_BREAKER_COOLDOWN)
+
+# Bulk key checks (admin.py validate) trip their own breaker, not the one replies go through
+key_check_breaker = CircuitBreaker("Shapes API key checks", SHAPES_BREAKER_THRESHOLD, SHAPES_BREAKER_COOLDOWN)
+
+def is_transient_error(error):
+    """
+    Check whether an error is worth retrying
+    
+    Args:
+        error (Exception): The error raised by the API call
+        
+    Returns:
+        bool: True for timeouts, connection problems, rate limits and server errors
+    """
+    # Already imported by the client that raised the error
+    import openai
+    
+    return isinstance(error, (
+        openai.APITimeoutError,
+        openai.APIConnectionError,
+        openai.RateLimitError,
+        openai.InternalServerError,
+    ))
+
+def is_upstream_failure(error):
+    """
+    Check whether an error means the Shapes API itself is struggling
+    
+    Rate limits are per API key, so one throttled user mustn't open the
+    circuit for everyone else.
+    
+    Args:
+        error (Exception): The error raised by the API call
+        
+    Returns:
+        bool: True for transient errors other than rate limits
+    """
+    # Already imported by the client that raised the error
+    import openai
+    
+    return is_transient_error(error) and not isinstance(error, openai.RateLimitError)
+
+def retry_after(error):
+    """
+    Get how long the Shapes API asked us to wait before retrying
+    
+    Args:
+        error (Exception): The error raised by the API call
+        
+    Returns:
+        float or None: Seconds from the Retry-After header, if there is one
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return max(0.0, float(response.headers.get("retry-after", "")))
+    except ValueError:
+        # HTTP dates aren't worth parsing; fall back to our own backoff
+        return None
+
+def build_messages(content, history=None):
+    """
+    Build the chat messages for a request
+    
+    Args:
+        content (str): The new user message
+        history (list, optional): Earlier {"role", "content"} turns, oldest first
+        
+    Returns:
+        list: The messages to send
+    """
+    return list(history or []) + [{"role": "user", "content": content}]
+
+async def _complete(api_key, content, command, history=None):
+    """
+    Run a chat completion through the shared call pipeline
+    
+    Args:
+        api_key (str): The user's API key
+        content (str): The message to send
+        command (str): Which command this is for (selects the timeout)
+        history (list, optional): Earlier turns to send before the message
+        
+    Returns:
+        str: The response from the API
+    """
+    # Get the pooled client for the user's API key
+    client = shapes_clients.get(api_key)
+    timeout = COMMAND_TIMEOUTS.get(command, SHAPES_TIMEOUT)
+    
+    async def call():
+        async with _measure(command):
+            response = await client.chat.completions.create(
+                model=SHAPES_MODEL,
+                messages=build_messages(content, history),
+                timeout=timeout
+            )
+        return response.choices[0].message.content
+    
+    return await _call_pipeline(call, command)
+
+async def _call_pipeline(call, command, breaker=shapes_breaker):
+    """
+    Run an API call with retries behind a circuit breaker
+    
+    Args:
+        call (callable): Zero-argument coroutine function making one attempt
+        command (str): Which command this is for (selects the retries; used in metrics)
+        breaker (CircuitBreaker): The breaker to go through (default: the one for replies)
+        
+    Returns:
+        Whatever the call returns
+    """
+    try:
+        return await call_with_retries(
+            call,
+            is_transient_error,
+            breaker=breaker,
+            retries=COMMAND_RETRIES.get(command, SHAPES_RETRIES),
+            base_delay=SHAPES_RETRY_BASE_DELAY,
+            max_delay=SHAPES_RETRY_MAX_DELAY,
+            is_failure=is_upstream_failure,
+            retry_after=retry_after,
+        )
+    except CircuitOpenError:
+        SHAPES_ERRORS_TOTAL.inc(command=command, error="CircuitOpenError")
+        raise
+
+@contextlib.asynccontextmanager
+async def _measure(command):
+    """
+    Record the latency and any error of one Shapes API attempt
+    """
+    start = time.perf_counter()
+    try:
+        with span("shapes"):
+            yield
+    except Exception as e:
+        SHAPES_ERRORS_TOTAL.inc(command=command, error=type(e).__name__)
+        raise
+    finally:
+        SHAPES_REQUEST_SECONDS.observe(time.perf_counter() - start, command=command)
+
+async def process_message(message_text, api_key, history=None, command="message"):
     """
     Send the message to the Shapes API using the OpenAI SDK compatibility
     
     Args:
         message_text (str): The message to process
         api_key (str): The user's API key
+        history (list, optional): Earlier turns of the conversation, oldest first
+        command (str): "message", or "inline" for inline queries (shorter timeout, no retries)
         
     Returns:
         str: The response from the API
     """
     try:
-        # Create client with user's API key
-        client = OpenAI(api_key=api_key, base_url=SHAPES_API_URL)
-        
         # Send the message to the Shapes API
         logger.info(f"Sending message to Shapes API using model: {SHAPES_MODEL}")
-        response = client.chat.completions.create(
-            model=SHAPES_MODEL,
-            messages=[{"role": "user", "content": message_text}]
-        )
-        
-        # Extract the response content
-        response_text = response.choices[0].message.content
+        response_text = await _complete(api_key, message_text, command, history)
         logger.info("Successfully received response from Shapes API")
         return response_text
     
     except Exception as e:
         logger.error(f"Error processing message with Shapes API: {str(e)}")
-        return f"Sorry, I had trouble processing your request. Error: {str(e)}"
+        return ErrorReply(f"Sorry, I had trouble processing your request. Error: {str(e)}")
 
-def send_wack(api_key):
+async def stream_message(message_text, api_key, history=None):
+    """
+    Send the message to the Shapes API and yield the response as it is generated
+    
+    Args:
+        message_text (str): The message to process
+        api_key (str): The user's API key
+        history (list, optional): Earlier turns of the conversation, oldest first
+        
+    Yields:
+        str: Pieces of the response text, in order
+    """
+    received_any = False
+    try:
+        # Get the pooled client for the user's API key
+        client = shapes_clients.get(api_key)
+        
+        async def open_stream():
+            # Measures time to the start of the stream
+            async with _measure("stream"):
+                return await client.chat.completions.create(
+                    model=SHAPES_MODEL,
+                    messages=build_messages(message_text, history),
+                    stream=True,
+                    timeout=SHAPES_TIMEOUT
+                )
+        
+        # Ask the Shapes API to stream the completion (only retried until it starts)
+        logger.info(f"Streaming message to Shapes API using model: {SHAPES_MODEL}")
+        stream = await _call_pipeline(open_stream, "stream")
+        
+        async for chunk in span_iter(stream, "shapes"):
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                received_any = True
+                yield delta
+        
+        logger.info("Successfully streamed response from Shapes API")
+    
+    except Exception as e:
+        logger.error(f"Error streaming message from Shapes API: {str(e)}")
+        if received_any:
+            yield ErrorReply(f"\n\n(The response was cut off. Error: {str(e)})")
+        else:
+            yield ErrorReply(f"Sorry, I had trouble processing your request. Error: {str(e)}")
+
+async def send_wack(api_key):
     """
     Send a !wack command to restart the model
     
@@ -58,26 +275,17 @@ def send_wack(api_key):
         str: The response from the API
     """
     try:
-        # Create client with user's API key
-        client = OpenAI(api_key=api_key, base_url=SHAPES_API_URL)
-        
         # Send the !wack command
         logger.info("Sending !wack command to Shapes API")
-        response = client.chat.completions.create(
-            model=SHAPES_MODEL,
-            messages=[{"role": "user", "content": "!wack"}]
-        )
-        
-        # Extract the response content
-        response_text = response.choices[0].message.content
+        response_text = await _complete(api_key, "!wack", "wack")
         logger.info("Successfully sent !wack command")
         return response_text
     
     except Exception as e:
         logger.error(f"Error sending !wack command: {str(e)}")
-        return f"Sorry, I had trouble processing your !wack command. Error: {str(e)}"
+        return ErrorReply(f"Sorry, I had trouble processing your !wack command. Error: {str(e)}")
 
-def send_sleep(api_key):
+async def send_sleep(api_key):
     """
     Send a !sleep command to save a memory
     
@@ -88,26 +296,17 @@ def send_sleep(api_key):
         str: The response from the API
     """
     try:
-        # Create client with user's API key
-        client = OpenAI(api_key=api_key, base_url=SHAPES_API_URL)
-        
         # Send the !sleep command
         logger.info("Sending !sleep command to Shapes API")
-        response = client.chat.completions.create(
-            model=SHAPES_MODEL,
-            messages=[{"role": "user", "content": "!sleep"}]
-        )
-        
-        # Extract the response content
-        response_text = response.choices[0].message.content
+        response_text = await _complete(api_key, "!sleep", "sleep")
         logger.info("Successfully sent !sleep command")
         return response_text
     
     except Exception as e:
         logger.error(f"Error sending !sleep command: {str(e)}")
-        return f"Sorry, I had trouble processing your !sleep command. Error: {str(e)}"
+        return ErrorReply(f"Sorry, I had trouble processing your !sleep command. Error: {str(e)}")
 
-def send_reset(api_key):
+async def send_reset(api_key):
     """
     Send a !reset command to delete all long term memories
     
@@ -118,26 +317,17 @@ def send_reset(api_key):
         str: The response from the API
     """
     try:
-        # Create client with user's API key
-        client = OpenAI(api_key=api_key, base_url=SHAPES_API_URL)
-        
         # Send the !reset command
         logger.info("Sending !reset command to Shapes API")
-        response = client.chat.completions.create(
-            model=SHAPES_MODEL,
-            messages=[{"role": "user", "content": "!reset"}]
-        )
-        
-        # Extract the response content
-        response_text = response.choices[0].message.content
+        response_text = await _complete(api_key, "!reset", "reset")
         logger.info("Successfully sent !reset command")
         return response_text
     
     except Exception as e:
         logger.error(f"Error sending !reset command: {str(e)}")
-        return f"Sorry, I had trouble processing your !reset command. Error: {str(e)}"
+        return ErrorReply(f"Sorry, I had trouble processing your !reset command. Error: {str(e)}")
 
-def send_imagine(api_key, user_prompt):
+async def send_imagine(api_key, user_prompt):
     """
     Send a !imagine command with the user's description to generate an image
     
@@ -149,23 +339,54 @@ def send_imagine(api_key, user_prompt):
         str: The response from the API
     """
     try:
-        # Create client with user's API key
-        client = OpenAI(api_key=api_key, base_url=SHAPES_API_URL)
-        
         # Send the !imagine command with the user's prompt
         imagine_command = f"!imagine {user_prompt}"
         logger.info(f"Sending imagine command to Shapes API: {imagine_command}")
         
-        response = client.chat.completions.create(
-            model=SHAPES_MODEL,
-            messages=[{"role": "user", "content": imagine_command}]
-        )
-        
-        # Extract the response content
-        response_text = response.choices[0].message.content
+        response_text = await _complete(api_key, imagine_command, "imagine")
         logger.info("Successfully processed imagine command")
         return response_text
     
     except Exception as e:
         logger.error(f"Error sending imagine command: {str(e)}")
-        return f"Sorry, I had trouble generating the image. Error: {str(e)}"
+        return ErrorReply(f"Sorry, I had trouble generating the image. Error: {str(e)}")
+
+# Answers to listing models that mean no key can be checked (e.g. a deployment without /models)
+KEY_CHECK_UNSUPPORTED_STATUSES = {404, 405, 501}
+
+class KeyCheckUnsupported(Exception):
+    """
+    The Shapes API can't tell whether any key is valid
+    """
+
+async def check_api_key(api_key):
+    """
+    Check whether the Shapes API accepts an API key, by listing its models
+    
+    Args:
+        api_key (str): The API key to check
+        
+    Returns:
+        bool or None: True if accepted, False if rejected, None if the API couldn't tell
+        
+    Raises:
+        KeyCheckUnsupported: If the API answered in a way that would be the same for every key
+    """
+    import openai
+    
+    client = shapes_clients.get(api_key)
+    
+    async def call():
+        async with _measure("check_key"):
+            await client.models.list(timeout=SHAPES_TIMEOUT)
+    
+    try:
+        await _call_pipeline(call, "check_key", key_check_breaker)
+        return True
+    except (openai.AuthenticationError, openai.PermissionDeniedError):
+        return False
+    except Exception as e:
+        if getattr(e, "status_code", None) in KEY_CHECK_UNSUPPORTED_STATUSES:
+            raise KeyCheckUnsupported(f"{type(e).__name__}: {str(e)}") from e
+        logger.warning(f"Could not check API key: {type(e).__name__}: {str(e)}")
+        return None
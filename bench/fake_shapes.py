@@ -0,0 +1,170 @@
+"""
+A stand-in for the Shapes API (OpenAI-compatible chat completions) with
+configurable latency, error rate and streaming behaviour.
+
+Run on its own with `python -m bench.fake_shapes --port 8100`, then set
+SHAPES_API_URL=http://127.0.0.1:8100/v1/ for the bot.
+"""
+
+import time
+import json
+import zlib
+import struct
+import hashlib
+import random
+import asyncio
+import logging
+import argparse
+
+from bench.http_server import serve, Response, json_response
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+class FakeShapesServer:
+    """
+    Answers /v1/chat/completions after a simulated generation delay.
+
+    Args:
+        latency (float): Mean seconds before a reply (or before the first streamed chunk)
+        jitter (float): Latency varies uniformly by up to this many seconds either way
+        imagine_latency (float): Mean seconds for `!imagine` requests
+        error_rate (float): Fraction of requests answered with a 500 error
+        reply_words (int): Words in each reply
+        chunk_delay (float): Seconds between streamed chunks
+    """
+
+    def __init__(self, latency=0.5, jitter=0.1, imagine_latency=3.0, error_rate=0.0,
+                 reply_words=40, chunk_delay=0.05):
+        self.latency = latency
+        self.jitter = jitter
+        self.imagine_latency = imagine_latency
+        self.error_rate = error_rate
+        self.reply_words = reply_words
+        self.chunk_delay = chunk_delay
+        self.requests = 0
+        self.errors = 0
+        self.server = None
+
+    @property
+    def port(self):
+        return self.server.sockets[0].getsockname()[1]
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.server = await serve(self.handle, host, port)
+        logger.info(f"Fake Shapes API listening on http://{host}:{self.port}/v1/")
+        return self
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def _delay(self, mean):
+        return max(0.0, mean + random.uniform(-self.jitter, self.jitter))
+
+    def _reply(self, content):
+        if content.startswith("!imagine"):
+            image_id = hashlib.sha1(content.encode()).hexdigest()[:12]
+            return f"Here you go! http://127.0.0.1:{self.port}/images/{image_id}.png"
+        if content.startswith("!"):
+            return f"Done: {content.split()[0]}"
+        words = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit"]
+        return " ".join(random.choice(words) for _ in range(self.reply_words))
+
+    async def handle(self, request):
+        if request.path.startswith("/images/"):
+            return Response(_solid_png(request.path), content_type="image/png")
+
+        if request.path.endswith("/models"):
+            return json_response({"object": "list", "data": [{"id": "shapesinc/bench", "object": "model"}]})
+
+        if not request.path.endswith("/chat/completions") or request.method != "POST":
+            return json_response({"error": {"message": "Not found"}}, status=404)
+
+        if not request.headers.get("authorization", "").startswith("Bearer "):
+            return json_response({"error": {"message": "Missing API key"}}, status=401)
+
+        self.requests += 1
+        body = request.json()
+        content = body["messages"][-1]["content"]
+        mean = self.imagine_latency if content.startswith("!imagine") else self.latency
+
+        await asyncio.sleep(self._delay(mean))
+
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return json_response({"error": {"message": "Simulated upstream failure"}}, status=500)
+
+        reply = self._reply(content)
+        if body.get("stream"):
+            return Response(content_type="text/event-stream", chunks=self._stream(body["model"], reply))
+
+        return json_response({
+            "id": f"chatcmpl-{self.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": reply},
+                "finish_reason": "stop",
+            }],
+        })
+
+    async def _stream(self, model, reply):
+        """
+        Send the reply a few words at a time as server-sent events
+        """
+        words = reply.split(" ")
+        for start in range(0, len(words), 3):
+            piece = " ".join(words[start:start + 3]) + ("" if start + 3 >= len(words) else " ")
+            chunk = {
+                "id": f"chatcmpl-{self.requests}",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}],
+            }
+            yield f"data: {json.dumps(chunk)}\n\n"
+            await asyncio.sleep(self.chunk_delay)
+        yield "data: [DONE]\n\n"
+
+
+def _solid_png(seed, size=256):
+    """
+    A single-colour PNG whose colour depends on the seed, so each URL is a different image
+    """
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    colour = hashlib.sha1(seed.encode()).digest()[:3]
+    rows = b"".join(b"\x00" + colour * size for _ in range(size))
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows))
+            + chunk(b"IEND", b""))
+
+
+async def _main(args):
+    server = FakeShapesServer(
+        latency=args.latency, jitter=args.jitter, imagine_latency=args.imagine_latency,
+        error_rate=args.error_rate, reply_words=args.reply_words, chunk_delay=args.chunk_delay,
+    )
+    await server.start(args.host, args.port)
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a fake Shapes API server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency", type=float, default=0.5, help="Mean reply latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.1, help="Latency jitter in seconds")
+    parser.add_argument("--imagine-latency", type=float, default=3.0, help="Mean !imagine latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests that fail")
+    parser.add_argument("--reply-words", type=int, default=40, help="Words per reply")
+    parser.add_argument("--chunk-delay", type=float, default=0.05, help="Seconds between streamed chunks")
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    asyncio.run(_main(parser.parse_args()))
@@ -0,0 +1,249 @@
+"""
+A fake Telegram Bot API that serves injected updates through getUpdates and
+records when the bot answers each one.
+
+Point the bot at it with TELEGRAM_API_URL=http://127.0.0.1:<port>.
+"""
+
+import time
+import asyncio
+import logging
+
+from bench.http_server import serve, json_response
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+BOT_ID = 1000
+BOT_USERNAME = "bench_bot"
+
+# Methods that post a new message into the chat
+SEND_METHODS = {"sendmessage", "sendphoto", "senddocument", "sendanimation", "sendsticker"}
+
+# Methods that change a message the bot already sent
+EDIT_METHODS = {"editmessagetext", "editmessagecaption", "editmessagemedia"}
+
+
+class Tracked:
+    """
+    Timing of one injected update and the bot's answers to it.
+    """
+
+    __slots__ = ("kind", "expected_replies", "sent_at", "first_reply_at", "last_reply_at", "replies")
+
+    def __init__(self, kind, expected_replies):
+        self.kind = kind
+        self.expected_replies = expected_replies
+        self.sent_at = time.perf_counter()
+        self.first_reply_at = None
+        self.last_reply_at = None
+        self.replies = 0
+
+    def record(self):
+        now = time.perf_counter()
+        if self.first_reply_at is None:
+            self.first_reply_at = now
+        self.last_reply_at = now
+        self.replies += 1
+
+
+class FakeTelegramServer:
+    """
+    Plays the Bot API for one bot token.
+
+    Updates passed to inject() are handed out by getUpdates (long polling
+    included). Every message the bot sends or edits is matched back to the
+    update it answers: through reply_parameters when the bot quotes it (as in
+    groups), otherwise to the oldest update in the chat still expecting a
+    reply, and through the message ID for edits.
+    """
+
+    def __init__(self, token):
+        self.token = token
+        self.server = None
+        self.calls = {}
+        self.tracked = {}
+        # Chat ID -> tracked updates in the order they were sent
+        self._by_chat = {}
+        self._updates = []
+        self._next_update_id = 1
+        self._next_message_id = 1
+        self._new_updates = asyncio.Condition()
+        # Bot message (chat_id, message_id) -> key of the update it answers
+        self._answers = {}
+
+    @property
+    def port(self):
+        return self.server.sockets[0].getsockname()[1]
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.server = await serve(self.handle, host, port)
+        logger.info(f"Fake Telegram Bot API listening on http://{host}:{self.port}")
+        return self
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def message_id(self):
+        message_id = self._next_message_id
+        self._next_message_id += 1
+        return message_id
+
+    async def inject(self, update, kind=None, expected_replies=1):
+        """
+        Queue an update for the bot and start timing it.
+
+        Args:
+            update (dict): The update, without update_id
+            kind (str, optional): Scenario name used to group the results; untimed if None
+            expected_replies (int): Messages the bot should send in answer (e.g. an
+                acknowledgement plus the result)
+        """
+        update["update_id"] = self._next_update_id
+        self._next_update_id += 1
+
+        message = update.get("message")
+        if message and kind is not None:
+            chat_id = message["chat"]["id"]
+            tracked = Tracked(kind, expected_replies)
+            self.tracked[(chat_id, message["message_id"])] = tracked
+            self._by_chat.setdefault(chat_id, []).append((message["message_id"], tracked))
+
+        async with self._new_updates:
+            self._updates.append(update)
+            self._new_updates.notify_all()
+
+    async def handle(self, request):
+        prefix = f"/bot{self.token}/"
+        if not request.path.startswith(prefix):
+            return json_response({"ok": False, "error_code": 404, "description": "Not Found"}, status=404)
+
+        method = request.path[len(prefix):].lower()
+        params = request.params()
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+        if method == "getupdates":
+            result = await self._get_updates(params)
+        elif method == "getme":
+            result = {"id": BOT_ID, "is_bot": True, "first_name": "Bench", "username": BOT_USERNAME,
+                      "can_join_groups": True, "can_read_all_group_messages": False,
+                      "supports_inline_queries": True}
+        elif method in SEND_METHODS:
+            result = self._send(method, params)
+        elif method in EDIT_METHODS:
+            result = self._edit(params)
+        else:
+            # deleteWebhook, sendChatAction, answerCallbackQuery and friends
+            result = True
+
+        return json_response({"ok": True, "result": result})
+
+    async def _get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+
+        async with self._new_updates:
+            # Confirmed updates are forgotten, as in the real API
+            self._updates = [update for update in self._updates if update["update_id"] >= offset]
+            if not self._updates and timeout:
+                try:
+                    await asyncio.wait_for(self._new_updates.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return self._updates[:limit]
+
+    def _send(self, method, params):
+        chat_id = int(params["chat_id"])
+        message_id = self.message_id()
+
+        key = self._answered_update(chat_id, params)
+        if key is not None:
+            self.tracked[key].record()
+            self._answers[(chat_id, message_id)] = key
+
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            "from": {"id": BOT_ID, "is_bot": True, "first_name": "Bench", "username": BOT_USERNAME},
+        }
+        if method == "sendphoto":
+            # Photos sent by file_id keep it; uploads get a new one
+            photo = params.get("photo")
+            file_id = photo if isinstance(photo, str) else f"photo-{message_id}"
+            message["photo"] = [{"file_id": file_id, "file_unique_id": f"u{file_id}",
+                                 "width": 256, "height": 256}]
+            message["caption"] = params.get("caption")
+        else:
+            message["text"] = params.get("text", "")
+        return message
+
+    def _answered_update(self, chat_id, params):
+        """
+        Find the key of the tracked update a new bot message answers
+        """
+        reply_to = (params.get("reply_parameters") or {}).get("message_id") or params.get("reply_to_message_id")
+        if reply_to is not None:
+            key = (chat_id, int(reply_to))
+            return key if key in self.tracked else None
+
+        pending = self._by_chat.get(chat_id, [])
+        for message_id, tracked in pending:
+            if tracked.replies < tracked.expected_replies:
+                return (chat_id, message_id)
+        return None
+
+    def _edit(self, params):
+        chat_id = int(params["chat_id"])
+        message_id = int(params["message_id"])
+
+        key = self._answers.get((chat_id, message_id))
+        if key is not None:
+            self.tracked[key].record()
+
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            "text": params.get("text", ""),
+        }
+
+
+def private_message(message_id, user_id, text):
+    """
+    Build a direct message update
+    """
+    return {"message": {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private", "first_name": f"user{user_id}"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+        "text": text,
+        **_command_entities(text),
+    }}
+
+
+def group_message(message_id, chat_id, user_id, text, mention=False):
+    """
+    Build a group message update, optionally starting with an @mention of the bot
+    """
+    entities = []
+    if mention:
+        entities.append({"type": "mention", "offset": 0, "length": len(BOT_USERNAME) + 1})
+        text = f"@{BOT_USERNAME} {text}"
+    return {"message": {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "supergroup", "title": f"group{chat_id}"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+        "text": text,
+        **({"entities": entities} if entities else {}),
+    }}
+
+
+def _command_entities(text):
+    if not text.startswith("/"):
+        return {}
+    return {"entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]}
@@ -0,0 +1,166 @@
+"""
+Just enough HTTP/1.1 for the fake servers: keep-alive, Content-Length
+request bodies, and plain or chunked (streamed) responses.
+"""
+
+import json
+import asyncio
+import logging
+from email.parser import BytesParser
+from email.policy import HTTP
+from urllib.parse import urlsplit, parse_qsl
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+REASONS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found",
+           429: "Too Many Requests", 500: "Internal Server Error", 502: "Bad Gateway"}
+
+
+class Request:
+    """
+    A parsed HTTP request.
+    """
+
+    def __init__(self, method, target, headers, body):
+        url = urlsplit(target)
+        self.method = method
+        self.path = url.path
+        self.query = dict(parse_qsl(url.query))
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body or b"{}")
+
+    def params(self):
+        """
+        Get the request parameters, whether sent as query, JSON, form or multipart.
+
+        Values that look like JSON (numbers, objects, lists) are decoded, the way
+        the Bot API reads them.
+
+        Returns:
+            dict: Parameter name to value
+        """
+        content_type = self.headers.get("content-type", "")
+        params = dict(self.query)
+
+        if content_type.startswith("application/json"):
+            params.update(self.json())
+            return params
+
+        if content_type.startswith("multipart/form-data"):
+            message = BytesParser(policy=HTTP).parsebytes(
+                f"Content-Type: {content_type}\r\n\r\n".encode() + self.body
+            )
+            for part in message.iter_parts():
+                name = part.get_param("name", header="content-disposition")
+                if part.get_filename():
+                    params[name] = part.get_payload(decode=True)
+                else:
+                    params[name] = _decode_value(part.get_content())
+            return params
+
+        for name, value in parse_qsl(self.body.decode()):
+            params[name] = _decode_value(value)
+        return params
+
+
+class Response:
+    """
+    A response with a fixed body, or a streamed one when `chunks` is an async iterator.
+    """
+
+    def __init__(self, body=b"", status=200, content_type="application/json", chunks=None):
+        self.body = body if isinstance(body, bytes) else body.encode()
+        self.status = status
+        self.content_type = content_type
+        self.chunks = chunks
+
+
+def json_response(data, status=200):
+    return Response(json.dumps(data), status=status)
+
+
+def _decode_value(value):
+    if value[:1] in ("{", "[") or value.lstrip("-").isdigit() or value in ("true", "false"):
+        try:
+            return json.loads(value)
+        except ValueError:
+            pass
+    return value
+
+
+async def _read_request(reader):
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    body = b""
+    length = int(headers.get("content-length", "0"))
+    if length:
+        body = await reader.readexactly(length)
+
+    method, target, _ = request_line.decode("latin-1").split(" ", 2)
+    return Request(method, target, headers, body)
+
+
+async def _write_response(writer, response):
+    head = f"HTTP/1.1 {response.status} {REASONS.get(response.status, 'Unknown')}\r\n"
+    head += f"Content-Type: {response.content_type}\r\n"
+
+    if response.chunks is None:
+        head += f"Content-Length: {len(response.body)}\r\n\r\n"
+        writer.write(head.encode() + response.body)
+        await writer.drain()
+        return
+
+    writer.write((head + "Transfer-Encoding: chunked\r\n\r\n").encode())
+    async for chunk in response.chunks:
+        data = chunk if isinstance(chunk, bytes) else chunk.encode()
+        writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        await writer.drain()
+    writer.write(b"0\r\n\r\n")
+    await writer.drain()
+
+
+async def serve(handler, host, port):
+    """
+    Start an HTTP server.
+
+    Args:
+        handler (callable): Coroutine function taking a Request and returning a Response
+        host (str): Address to bind
+        port (int): Port to listen on (0 picks a free one)
+
+    Returns:
+        asyncio.base_events.Server: The running server
+    """
+    async def handle_connection(reader, writer):
+        try:
+            while True:
+                request = await _read_request(reader)
+                if request is None:
+                    break
+                try:
+                    response = await handler(request)
+                except Exception as e:
+                    logger.exception(f"Error handling {request.method} {request.path}")
+                    response = json_response({"ok": False, "description": str(e)}, status=500)
+                await _write_response(writer, response)
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            # Client went away, or the benchmark is shutting down
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle_connection, host, port)
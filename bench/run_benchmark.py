@@ -0,0 +1,255 @@
+"""
+Offline benchmark: runs the real bot (`main.py`) against the fake Telegram
+and Shapes servers, replays a synthetic mix of updates and reports reply
+latency percentiles and throughput.
+
+    python -m bench.run_benchmark --users 200 --updates 2000 --rate 100
+
+Scenarios, mixed by weight:
+    dm        direct message to the bot
+    mention   group message mentioning the bot
+    noise     group message not addressed to the bot (should get no reply)
+    imagine   /imagine followed by a prompt, as a burst from one user; the
+              latency to the last reply covers the generated result
+"""
+
+import os
+import sys
+import time
+import random
+import signal
+import asyncio
+import logging
+import argparse
+import tempfile
+import subprocess
+
+from bench.fake_shapes import FakeShapesServer
+from bench.fake_telegram import FakeTelegramServer, private_message, group_message
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_TOKEN = "123456:bench"
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of a list of numbers (None if empty)
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+
+def seed_users(db_file, users):
+    """
+    Register an API key for every synthetic user in a fresh database
+    """
+    os.environ["DB_FILE"] = db_file
+    import db
+
+    db.init_db()
+    with db.get_connection() as connection:
+        connection.executemany(
+            "INSERT OR REPLACE INTO users (user_id, api_key) VALUES (?, ?)",
+            ((user_id, f"bench-key-{user_id}") for user_id in range(1, users + 1)),
+        )
+    db.close_db()
+
+
+def build_schedule(args):
+    """
+    Pick the scenario of every synthetic update.
+
+    Returns:
+        list: One list per scenario of (update, kind, expected_replies), sent back to back
+    """
+    weights = {"dm": args.dm, "mention": args.mention, "noise": args.noise, "imagine": args.imagine}
+    kinds = [kind for kind, weight in weights.items() if weight > 0]
+    groups = [-1000000000000 - index for index in range(1, args.groups + 1)]
+    message_ids = {}
+
+    def next_id(chat_id):
+        message_ids[chat_id] = message_ids.get(chat_id, 0) + 1
+        return message_ids[chat_id]
+
+    schedule = []
+    for _ in range(args.updates):
+        kind = random.choices(kinds, weights=[weights[kind] for kind in kinds])[0]
+        user_id = random.randint(1, args.users)
+        chat_id = random.choice(groups)
+        text = f"benchmark message {len(schedule)}"
+
+        if kind == "dm":
+            updates = [(private_message(next_id(user_id), user_id, text), kind, 1)]
+        elif kind == "mention":
+            updates = [(group_message(next_id(chat_id), chat_id, user_id, text, mention=True), kind, 1)]
+        elif kind == "noise":
+            updates = [(group_message(next_id(chat_id), chat_id, user_id, text), kind, 0)]
+        else:
+            # The prompt is answered twice: "please wait", then the image
+            updates = [
+                (private_message(next_id(user_id), user_id, "/imagine"), "imagine_command", 1),
+                (private_message(next_id(user_id), user_id, f"a cat riding a bike #{len(schedule)}"), kind, 2),
+            ]
+        schedule.append(updates)
+    return schedule
+
+
+def start_bot(args, telegram_port, shapes_port, db_file):
+    """
+    Launch main.py in a subprocess, configured to use the fake servers
+    """
+    env = dict(os.environ)
+    env.update({
+        "TELEGRAM_TOKEN": BENCH_TOKEN,
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{telegram_port}",
+        "SHAPES_API_URL": f"http://127.0.0.1:{shapes_port}/v1/",
+        "SHAPES_MODEL": "shapesinc/bench",
+        "SHAPES_STREAMING": "true" if args.streaming else "false",
+        "DB_FILE": db_file,
+        "IMAGE_CACHE_DIR": os.path.join(os.path.dirname(db_file), "images"),
+        # The fake Shapes server serves its images over plain HTTP from localhost
+        "IMAGE_HOSTS": "127.0.0.1",
+        "IMAGE_URL_SCHEMES": "http",
+        "IMAGE_ALLOW_PRIVATE_HOSTS": "true",
+        "BOT_MODE": "polling",
+        # Exists once the bot, and every worker, is ready for updates
+        "READY_FILE": os.path.join(os.path.dirname(db_file), "ready"),
+    })
+    command = [sys.executable, "main.py", "--workers", str(args.workers)]
+    output = None if args.verbose else subprocess.DEVNULL
+    return subprocess.Popen(command, cwd=REPO_ROOT, env=env, stdout=output, stderr=output)
+
+
+async def wait_until(condition, timeout, interval=0.05):
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            return False
+        await asyncio.sleep(interval)
+    return True
+
+
+def report(telegram, shapes, started_at, elapsed):
+    """
+    Print latency percentiles per scenario plus overall throughput
+    """
+    def ms(value):
+        return "-" if value is None else f"{value * 1000:.0f}"
+
+    print()
+    print(f"{'scenario':<16} {'sent':>6} {'answered':>9} {'first p50':>10} {'first p99':>10} "
+          f"{'last p50':>9} {'last p99':>9}  (ms)")
+
+    answered_total = 0
+    last_reply = started_at
+    by_kind = {}
+    for tracked in telegram.tracked.values():
+        by_kind.setdefault(tracked.kind, []).append(tracked)
+
+    for kind, items in sorted(by_kind.items()):
+        answered = [item for item in items if item.first_reply_at is not None]
+        first = [item.first_reply_at - item.sent_at for item in answered]
+        last = [item.last_reply_at - item.sent_at for item in answered]
+        if kind != "noise":
+            answered_total += len(answered)
+        for item in answered:
+            last_reply = max(last_reply, item.last_reply_at)
+        print(f"{kind:<16} {len(items):>6} {len(answered):>9} {ms(percentile(first, 0.5)):>10} "
+              f"{ms(percentile(first, 0.99)):>10} {ms(percentile(last, 0.5)):>9} {ms(percentile(last, 0.99)):>9}")
+
+    busy = max(last_reply - started_at, 1e-9)
+    print()
+    print(f"Answered {answered_total} updates in {busy:.1f}s: {answered_total / busy:.1f} messages/sec "
+          f"(run took {elapsed:.1f}s)")
+    print(f"Shapes API: {shapes.requests} requests, {shapes.errors} simulated errors")
+    print("Bot API calls: " + ", ".join(f"{method}={count}" for method, count in sorted(telegram.calls.items())))
+
+
+async def run(args):
+    telegram = await FakeTelegramServer(BENCH_TOKEN).start()
+    shapes = await FakeShapesServer(
+        latency=args.latency, jitter=args.jitter, imagine_latency=args.imagine_latency,
+        error_rate=args.error_rate, reply_words=args.reply_words, chunk_delay=args.chunk_delay,
+    ).start()
+
+    workdir = tempfile.mkdtemp(prefix="shape-bench-")
+    db_file = os.path.join(workdir, "bench.db")
+    seed_users(db_file, args.users)
+
+    schedule = build_schedule(args)
+    bot = start_bot(args, telegram.port, shapes.port, db_file)
+    try:
+        ready_file = os.path.join(workdir, "ready")
+        if not await wait_until(lambda: os.path.exists(ready_file) or bot.poll() is not None, 60):
+            raise RuntimeError("The bot was not ready within 60 seconds")
+        if bot.poll() is not None:
+            raise RuntimeError(f"The bot exited with code {bot.returncode}; rerun with --verbose")
+        logger.info(f"Bot is ready; sending {args.updates} updates at {args.rate}/s")
+
+        started_at = time.perf_counter()
+        interval = 1 / args.rate
+        for index, updates in enumerate(schedule):
+            for update, kind, expected_replies in updates:
+                await telegram.inject(update, kind, expected_replies)
+            # Pace against the start time so slow iterations don't lower the rate
+            delay = started_at + (index + 1) * interval - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        def settled():
+            expected = [item for item in telegram.tracked.values() if item.expected_replies]
+            if any(item.replies < item.expected_replies for item in expected):
+                return False
+            last = max((item.last_reply_at for item in expected), default=started_at)
+            return time.perf_counter() - last > args.settle
+
+        if not await wait_until(settled, args.timeout):
+            logger.warning(f"Not every update was answered within {args.timeout}s")
+
+        report(telegram, shapes, started_at, time.perf_counter() - started_at)
+    finally:
+        bot.send_signal(signal.SIGINT)
+        try:
+            # Keep the fake servers answering while the bot shuts down
+            await asyncio.to_thread(bot.wait, timeout=30)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        await telegram.stop()
+        await shapes.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the bot against fake Telegram and Shapes servers")
+    parser.add_argument("--users", type=int, default=100, help="Registered synthetic users")
+    parser.add_argument("--groups", type=int, default=10, help="Synthetic group chats")
+    parser.add_argument("--updates", type=int, default=500, help="Scenarios to send")
+    parser.add_argument("--rate", type=float, default=50, help="Scenarios per second")
+    parser.add_argument("--workers", type=int, default=1, help="Bot worker processes")
+    parser.add_argument("--streaming", action="store_true", help="Run the bot with SHAPES_STREAMING on")
+    parser.add_argument("--dm", type=float, default=5, help="Weight of direct messages")
+    parser.add_argument("--mention", type=float, default=3, help="Weight of group mentions")
+    parser.add_argument("--noise", type=float, default=10, help="Weight of group noise")
+    parser.add_argument("--imagine", type=float, default=1, help="Weight of /imagine bursts")
+    parser.add_argument("--latency", type=float, default=0.5, help="Fake Shapes reply latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.1, help="Fake Shapes latency jitter in seconds")
+    parser.add_argument("--imagine-latency", type=float, default=3.0, help="Fake !imagine latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of Shapes requests that fail")
+    parser.add_argument("--reply-words", type=int, default=40, help="Words per fake reply")
+    parser.add_argument("--chunk-delay", type=float, default=0.05, help="Seconds between streamed chunks")
+    parser.add_argument("--settle", type=float, default=2.0, help="Quiet seconds that end the run")
+    parser.add_argument("--timeout", type=float, default=300, help="Give up waiting for replies after this")
+    parser.add_argument("--seed", type=int, help="Random seed for a repeatable update mix")
+    parser.add_argument("--verbose", action="store_true", help="Show the bot's log output")
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    asyncio.run(run(args))
@@ -1,7 +1,16 @@
 import os
+import asyncio
 import logging
-import re
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import ipaddress
+from urllib.parse import urlsplit
+
+from config import load_config
+
+# Load environment variables from .env file, before the modules below read their settings
+load_config()
+
+from telegram import Update, Message, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ChatAction
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -9,15 +18,29 @@ from telegram.ext import (
     filters,
     CallbackContext,
     ConversationHandler,
-    CallbackQueryHandler
+    CallbackQueryHandler,
+    InlineQueryHandler
 )
-from dotenv import load_dotenv
-
-from db import init_db, store_api_key, get_api_key, delete_api_key
-from api_handler import process_message, send_wack, send_sleep, send_reset, send_imagine
-
-# Load environment variables from .env file
-load_dotenv()
+from db import init_db, close_db, store_api_key_async, get_api_key_async
+from api_handler import process_message, stream_message, send_wack, send_sleep, send_reset, send_imagine, ErrorReply
+from client_pool import shapes_clients
+from update_processor import ChatOrderedUpdateProcessor
+from streaming import SHAPES_STREAMING, reply_streaming
+from formatting import reply_chunked
+from send_scheduler import SendScheduler, send_priority, PRIORITY_HIGH, SEND_GLOBAL_RATE
+from inflight import request_limiter, DROPPED, MAX_CONCURRENT_REQUESTS, set_max_concurrent_requests
+from bot_filters import ADDRESSED_TO_BOT, mention_pattern
+from context_store import context_store
+from persistence import SQLitePersistence
+import image_pipeline
+from image_pipeline import send_cached_image, reply_with_image
+from jobs import job_queue, assign_jobs_to_shards
+from chat_actions import chat_actions
+from inline_mode import inline_responder, REGISTER_START_PARAMETER
+import metrics
+from metrics import timed, HANDLER_SECONDS, QUEUE_DEPTH
+from health import startup_timer, mark_ready, mark_not_ready
+from profiling import profiler
 
 # Set up logging
 logger = logging.getLogger(__name__)
@@ -28,10 +51,40 @@ if not TELEGRAM_TOKEN:
     logger.error("No TELEGRAM_TOKEN found in environment variables!")
     exit(1)
 
+# Bot API server; point this at a local Bot API server or the benchmark's fake one
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
+
+# How updates reach the bot: "polling" (default) or "webhook"
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+
+# Webhook settings (only used in webhook mode)
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_SECRET_TOKEN = os.environ.get("WEBHOOK_SECRET_TOKEN")
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+# Seconds a stopping bot gives in-flight replies and jobs to finish before saving them for the next start
+DRAIN_TIMEOUT = float(os.environ.get("DRAIN_TIMEOUT", "8"))
+
 # Conversation states
 AWAITING_API_KEY = 1
 AWAITING_IMAGINE_PROMPT = 2
 
+# "/start register", sent when a user taps the inline mode registration button
+REGISTER_DEEP_LINK = filters.Regex(rf"^/start {REGISTER_START_PARAMETER}$")
+
+# Sent when a user is over their in-flight request limit
+STILL_THINKING_TEXT = "⏳ I'm still working on your last request, please wait a moment!"
+
+# Sent by background jobs when the user's key has gone away in the meantime
+NOT_REGISTERED_TEXT = (
+    "❌ You are not registered yet.\n"
+    "Please use /register in my DMs to set up your key first."
+)
+
+@timed(HANDLER_SECONDS, handler="start")
 async def start(update: Update, context: CallbackContext) -> None:
     """
     Handler for the /start command
@@ -43,11 +96,13 @@ async def start(update: Update, context: CallbackContext) -> None:
         "After registering, you can use me in any chat by:\n"
         "1. Mentioning me (@shapebot your question)\n"
         "2. Replying to my messages\n"
-        "3. DMing me directly\n\n"
+        "3. DMing me directly\n"
+        "4. Typing @shapebot your question in any chat, and picking my reply\n\n"
         "You can also use /imagine to generate images based on your descriptions!\n\n"
         "Type /help for more info."
     )
 
+@timed(HANDLER_SECONDS, handler="help_command")
 async def help_command(update: Update, context: CallbackContext) -> None:
     """
     Handler for the /help command
@@ -64,11 +119,13 @@ async def help_command(update: Update, context: CallbackContext) -> None:
         "Once you've registered, you can interact with me in any chat by:\n"
         "- Mentioning me: @shapebot hello there\n"
         "- Replying to my messages\n"
-        "- Sending me direct messages\n\n"
+        "- Sending me direct messages\n"
+        "- Typing @shapebot your question in any chat, then picking my reply\n\n"
         "Remember: To have fun!",
         parse_mode="Markdown"
     )
 
+@timed(HANDLER_SECONDS, handler="register_command")
 async def register_command(update: Update, context: CallbackContext) -> int:
     """
     Start the registration process to store the user's API key
@@ -87,6 +144,7 @@ async def register_command(update: Update, context: CallbackContext) -> int:
     )
     return AWAITING_API_KEY
 
+@timed(HANDLER_SECONDS, handler="process_api_key")
 async def process_api_key(update: Update, context: CallbackContext) -> int:
     """
     Process and store the provided API key
@@ -103,7 +161,7 @@ async def process_api_key(update: Update, context: CallbackContext) -> int:
         return AWAITING_API_KEY
     
     # Store the API key
-    store_api_key(user_id, api_key)
+    await store_api_key_async(user_id, api_key)
     
     await update.message.reply_text(
         "✅ You have been registered successfully!\n\n"
@@ -115,6 +173,7 @@ async def process_api_key(update: Update, context: CallbackContext) -> int:
     )
     return ConversationHandler.END
 
+@timed(HANDLER_SECONDS, handler="cancel_registration")
 async def cancel_registration(update: Update, context: CallbackContext) -> int:
     """
     Cancel the registration process
@@ -124,12 +183,13 @@ async def cancel_registration(update: Update, context: CallbackContext) -> int:
     )
     return ConversationHandler.END
 
+@timed(HANDLER_SECONDS, handler="wack_command")
 async def wack_command(update: Update, context: CallbackContext) -> None:
     """
     Handle the /wack command to restart the model
     """
     user_id = update.effective_user.id
-    api_key = get_api_key(user_id)
+    api_key = await get_api_key_async(user_id)
     
     if not api_key:
         await update.message.reply_text(
@@ -138,19 +198,26 @@ async def wack_command(update: Update, context: CallbackContext) -> None:
         )
         return
     
-    await update.message.reply_text("🔄 Sending !wack to restart your Shape...")
+    # Acknowledge right away, ahead of queued replies
+    with send_priority(PRIORITY_HIGH):
+        await update.message.reply_text("🔄 Sending !wack to restart your Shape...")
     
     # Send the !wack command
-    response = send_wack(api_key)
+    async with chat_actions.keep(context.bot, update.effective_chat.id, ChatAction.TYPING):
+        response = await send_wack(api_key)
+    
+    # A restarted chat starts without the old conversation
+    await context_store.clear(user_id, update.effective_chat.id)
     
     await update.message.reply_text(response or "✅ Shape restarted successfully!")
 
+@timed(HANDLER_SECONDS, handler="sleep_command")
 async def sleep_command(update: Update, context: CallbackContext) -> None:
     """
     Handle the /sleep command to save a memory
     """
     user_id = update.effective_user.id
-    api_key = get_api_key(user_id)
+    api_key = await get_api_key_async(user_id)
     
     if not api_key:
         await update.message.reply_text(
@@ -159,23 +226,43 @@ async def sleep_command(update: Update, context: CallbackContext) -> None:
         )
         return
     
-    await update.message.reply_text("💤 Sending !sleep to save a memory...")
+    # The !sleep command runs in the job queue so the chat isn't held up
+    queued = await job_queue.enqueue("sleep", update.message, user_id)
+    
+    # Acknowledge right away, ahead of queued replies
+    with send_priority(PRIORITY_HIGH):
+        if queued:
+            await update.message.reply_text("💤 Sending !sleep to save a memory...")
+        else:
+            await update.message.reply_text(STILL_THINKING_TEXT)
+
+@timed(HANDLER_SECONDS, handler="sleep_job")
+async def sleep_job(application: Application, message: Message, user_id: int) -> None:
+    """
+    Send the !sleep command and report back (runs in the job queue)
+    """
+    api_key = await get_api_key_async(user_id)
+    if not api_key:
+        await message.reply_text(NOT_REGISTERED_TEXT)
+        return
     
     # Send the !sleep command
-    response = send_sleep(api_key)
+    async with chat_actions.keep(application.bot, message.chat_id, ChatAction.TYPING):
+        response = await send_sleep(api_key)
     
-    await update.message.reply_text(response or "✅ Memory saved successfully!")
+    await message.reply_text(response or "✅ Memory saved successfully!")
 
 # Define callback data
 RESET_CONFIRM = "reset_confirm"
 RESET_CANCEL = "reset_cancel"
 
+@timed(HANDLER_SECONDS, handler="reset_command")
 async def reset_command(update: Update, context: CallbackContext) -> None:
     """
     Handle the /reset command to delete all long term memories
     """
     user_id = update.effective_user.id
-    api_key = get_api_key(user_id)
+    api_key = await get_api_key_async(user_id)
     
     if not api_key:
         await update.message.reply_text(
@@ -200,6 +287,7 @@ async def reset_command(update: Update, context: CallbackContext) -> None:
         parse_mode="Markdown"
     )
 
+@timed(HANDLER_SECONDS, handler="reset_button_callback")
 async def reset_button_callback(update: Update, context: CallbackContext) -> None:
     """
     Handle reset confirmation button callbacks
@@ -210,26 +298,47 @@ async def reset_button_callback(update: Update, context: CallbackContext) -> Non
     # Get the callback data
     data = query.data
     user_id = query.from_user.id
-    api_key = get_api_key(user_id)
     
     if data == RESET_CANCEL:
         await query.edit_message_text("🛑 Reset cancelled. Your memories are safe.")
         return
     
     if data == RESET_CONFIRM:
-        await query.edit_message_text("🔄 Processing !reset command...")
+        # The !reset command runs in the job queue so the chat isn't held up
+        queued = await job_queue.enqueue("reset", query.message, user_id)
         
-        # Send the !reset command
-        response = send_reset(api_key)
-        
-        await query.message.reply_text(response or "✅ All long term memories have been deleted.")
+        with send_priority(PRIORITY_HIGH):
+            if queued:
+                await query.edit_message_text("🔄 Processing !reset command...")
+            else:
+                await query.message.reply_text(STILL_THINKING_TEXT)
+
+@timed(HANDLER_SECONDS, handler="reset_job")
+async def reset_job(application: Application, message: Message, user_id: int) -> None:
+    """
+    Send the !reset command and report back (runs in the job queue)
+    """
+    api_key = await get_api_key_async(user_id)
+    if not api_key:
+        await message.reply_text(NOT_REGISTERED_TEXT)
+        return
+    
+    # Send the !reset command
+    async with chat_actions.keep(application.bot, message.chat_id, ChatAction.TYPING):
+        response = await send_reset(api_key)
+    
+    # Forget the user's recent conversations everywhere too
+    await context_store.clear(user_id)
+    
+    await message.reply_text(response or "✅ All long term memories have been deleted.")
 
+@timed(HANDLER_SECONDS, handler="imagine_command")
 async def imagine_command(update: Update, context: CallbackContext) -> int:
     """
     Start the image generation process
     """
     user_id = update.effective_user.id
-    api_key = get_api_key(user_id)
+    api_key = await get_api_key_async(user_id)
     
     if not api_key:
         await update.message.reply_text(
@@ -244,12 +353,12 @@ async def imagine_command(update: Update, context: CallbackContext) -> int:
     )
     return AWAITING_IMAGINE_PROMPT
 
+@timed(HANDLER_SECONDS, handler="process_imagine_prompt")
 async def process_imagine_prompt(update: Update, context: CallbackContext) -> int:
     """
     Process the image description and send it to the API
     """
     user_id = update.effective_user.id
-    api_key = get_api_key(user_id)
     prompt = update.message.text.strip()
     
     # Check if the prompt is too short
@@ -259,16 +368,43 @@ async def process_imagine_prompt(update: Update, context: CallbackContext) -> in
         )
         return AWAITING_IMAGINE_PROMPT
     
-    await update.message.reply_text("🎨 Creating your image, please wait...")
-    
-    # Send the !imagine command with the user's prompt
-    response = send_imagine(api_key, prompt)
+    # Image generation runs in the job queue so the chat isn't held up
+    queued = await job_queue.enqueue("imagine", update.message, user_id, prompt=prompt)
     
-    # Send the response back to the user
-    await update.message.reply_text(response or "✅ Image created!")
+    # Acknowledge right away, ahead of queued replies
+    with send_priority(PRIORITY_HIGH):
+        if queued:
+            await update.message.reply_text("🎨 Creating your image, please wait...")
+        else:
+            await update.message.reply_text(STILL_THINKING_TEXT)
     
     return ConversationHandler.END
 
+@timed(HANDLER_SECONDS, handler="imagine_job")
+async def imagine_job(application: Application, message: Message, user_id: int, prompt: str) -> None:
+    """
+    Generate the image for a prompt and send it (runs in the job queue)
+    """
+    api_key = await get_api_key_async(user_id)
+    if not api_key:
+        await message.reply_text(NOT_REGISTERED_TEXT)
+        return
+    
+    # Repeated prompts get the image that was already made for them
+    if await send_cached_image(message, prompt):
+        return
+    
+    async with chat_actions.keep(application.bot, message.chat_id, ChatAction.UPLOAD_PHOTO):
+        # Send the !imagine command with the user's prompt
+        response = await send_imagine(api_key, prompt)
+        
+        # Send the image back as a photo, or the response text if there is no image to send
+        if not isinstance(response, ErrorReply) and await reply_with_image(message, prompt, response):
+            return
+    
+    await message.reply_text(response or "✅ Image created!")
+
+@timed(HANDLER_SECONDS, handler="cancel_imagine")
 async def cancel_imagine(update: Update, context: CallbackContext) -> int:
     """
     Cancel the image generation process
@@ -278,6 +414,45 @@ async def cancel_imagine(update: Update, context: CallbackContext) -> int:
     )
     return ConversationHandler.END
 
+@timed(HANDLER_SECONDS, handler="handle_message.reply")
+async def answer_message(message: Message, user_id: int, api_key: str, message_text: str) -> None:
+    """
+    Get the Shape's response to a message and reply with it
+    """
+    chat_id = message.chat_id
+    
+    # Recent turns of this user's conversation in this chat
+    history = await context_store.get_history(chat_id, user_id, message_text)
+    
+    # Stream the reply into an edited message if enabled
+    if SHAPES_STREAMING:
+        async with chat_actions.keep(message.get_bot(), chat_id, ChatAction.TYPING):
+            response = await reply_streaming(message, stream_message(message_text, api_key, history))
+    else:
+        # Process the message with the Shapes API
+        async with chat_actions.keep(message.get_bot(), chat_id, ChatAction.TYPING):
+            response = await process_message(message_text, api_key, history)
+        
+        # Send the response back to the user, split into several messages if it's long
+        await reply_chunked(message, response)
+        
+        if isinstance(response, ErrorReply):
+            response = None
+    
+    # Remember successful exchanges for the next message
+    if response:
+        await context_store.add_exchange(chat_id, user_id, message_text, response)
+
+async def message_job(application: Application, message: Message, user_id: int, text: str) -> None:
+    """
+    Answer a message that the last run didn't get to before it stopped
+    """
+    api_key = await get_api_key_async(user_id)
+    if not api_key:
+        return
+    await answer_message(message, user_id, api_key, text)
+
+@timed(HANDLER_SECONDS, handler="handle_message")
 async def handle_message(update: Update, context: CallbackContext) -> None:
     """
     Process incoming messages that should be sent to the Shape
@@ -285,8 +460,16 @@ async def handle_message(update: Update, context: CallbackContext) -> None:
     # Get the user ID
     user_id = update.effective_user.id
     
+    # Get the message text
+    message_text = update.message.text
+    
+    # Group messages only get here if they mention or reply to the bot (see ADDRESSED_TO_BOT),
+    # so just remove the bot's username from the message
+    if update.effective_chat.type != "private":
+        message_text = mention_pattern(context.bot.username).sub('', message_text)
+    
     # Check if the user has registered an API key
-    api_key = get_api_key(user_id)
+    api_key = await get_api_key_async(user_id)
     if not api_key:
         await update.message.reply_text(
             "❌ You are not registered yet.\n"
@@ -294,55 +477,225 @@ async def handle_message(update: Update, context: CallbackContext) -> None:
         )
         return
     
-    # Get the message text
-    message_text = update.message.text
+    async def respond(message_text):
+        await answer_message(update.message, user_id, api_key, message_text)
     
-    # In group chats, verify this message is actually for this bot
-    if update.effective_chat.type != "private":
-        # Get the bot's username
-        bot_username = context.bot.username
-        
-        # Check if this is a mention or a reply
-        is_mention = bot_username and f"@{bot_username}" in message_text
-        is_reply_to_bot = (update.message.reply_to_message and 
-                          update.message.reply_to_message.from_user and
-                          update.message.reply_to_message.from_user.id == context.bot.id)
-        
-        # Only process if it's a direct mention of this bot or a reply to this bot's message
-        if not is_mention and not is_reply_to_bot:
-            logger.info("Ignoring message in group chat that isn't for this bot")
-            return
-        
-        # If it's a mention, remove the bot's username from the message
-        if is_mention and bot_username:
-            bot_mention_pattern = rf'@{bot_username}\s*'
-            message_text = re.sub(bot_mention_pattern, '', message_text, flags=re.IGNORECASE)
+    async def checkpoint(message_text):
+        # Answered from the job queue after the restart
+        if not await job_queue.enqueue("message", update.message, user_id, text=message_text):
+            logger.warning(f"Could not save an unanswered message from user {user_id}")
     
-    # Process the message with the Shapes API
-    response = process_message(message_text, api_key)
+    # Run in the background, within the user's in-flight limit
+    status = request_limiter.submit(user_id, message_text, respond, checkpoint=checkpoint)
+    if status == DROPPED:
+        with send_priority(PRIORITY_HIGH):
+            await update.message.reply_text(STILL_THINKING_TEXT)
+
+@timed(HANDLER_SECONDS, handler="inline_query")
+async def inline_query(update: Update, context: CallbackContext) -> None:
+    """
+    Answer "@bot question" typed in any chat with the user's Shape
+    """
+    api_key = await get_api_key_async(update.inline_query.from_user.id)
+    if not api_key:
+        await inline_responder.answer_unregistered(update.inline_query)
+        return
     
-    # Send the response back to the user
-    await update.message.reply_text(response)
+    await inline_responder.answer(update.inline_query, api_key)
+
+# Metrics HTTP server, when METRICS_PORT is set
+metrics_server = None
+
+# Waits for the application to start receiving updates
+ready_task = None
 
-def run_bot():
+async def startup(application: Application) -> None:
     """
-    Initialize and run the Telegram bot
+    Start background services once the application is initialized
     """
-    # Initialize the database
-    init_db()
+    global metrics_server, ready_task
+    startup_timer.mark("initialize")
+    
+    if metrics.METRICS_PORT and metrics_server is None:
+        metrics_server = await metrics.start_metrics_server()
+    
+    # Pick up queued jobs, including ones interrupted by the last shutdown
+    await job_queue.start(application)
+    
+    # Profile a sample of updates if PROFILE_SAMPLE_RATE is set
+    profiler.start()
+    startup_timer.mark("services")
+    
+    # The updater starts after this hook returns
+    ready_task = asyncio.create_task(announce_ready(application))
+
+async def announce_ready(application: Application) -> None:
+    """
+    Report readiness once the application is receiving updates
+    """
+    while not (application.running and (application.updater is None or application.updater.running)):
+        await asyncio.sleep(0.01)
+    
+    startup_timer.mark("receiving updates")
+    startup_timer.report()
+    mark_ready()
+    
+    # Load the Shapes client library now rather than on the first message
+    await shapes_clients.warm_up()
+
+async def stopping(application: Application) -> None:
+    """
+    Finish in-flight work while the bot can still send messages
+    """
+    mark_not_ready()
+    if ready_task is not None:
+        ready_task.cancel()
+    
+    # Give chat requests and jobs until the deadline; whatever is left is saved
+    # to the job queue and picked up by the next start
+    await asyncio.gather(
+        request_limiter.drain(DRAIN_TIMEOUT),
+        job_queue.stop(DRAIN_TIMEOUT),
+    )
+
+async def shutdown(application: Application) -> None:
+    """
+    Release shared resources when the application stops
+    """
+    global metrics_server
+    if metrics_server is not None:
+        metrics_server.close()
+        metrics_server = None
+    
+    # Close the pooled Shapes API connections and the image download client
+    await shapes_clients.close()
+    await image_pipeline.close()
+    
+    # Save recent conversations if they are spilled to the database
+    await context_store.flush()
+    
+    # Write out the last profiles
+    await profiler.stop()
+    
+    # Finish pending database work and close connections
+    close_db()
+
+def is_local_api_url(url):
+    """
+    Check whether a Bot API URL points at a server on this machine or network
     
+    Args:
+        url (str): e.g. TELEGRAM_API_URL
+        
+    Returns:
+        bool: True for localhost and private addresses, such as a local Bot API or the benchmark's fake one
+    """
+    host = urlsplit(url).hostname or ""
+    if host == "localhost":
+        return True
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return address.is_loopback or address.is_private
+
+def check_webhook_url():
+    """
+    Exit unless Telegram will be able to reach the webhook
+    
+    Raises:
+        SystemExit: If WEBHOOK_URL is needed but not set
+    """
+    # Without a public URL the local address would be registered, which Telegram rejects;
+    # a local or test Bot API server can reach it
+    if not WEBHOOK_URL and not is_local_api_url(TELEGRAM_API_URL):
+        logger.error("WEBHOOK_URL must be set to the bot's public HTTPS URL in webhook mode")
+        raise SystemExit(1)
+
+def webhook_settings():
+    """
+    Build the webhook server arguments from the environment
+    
+    Returns:
+        dict: Keyword arguments for run_webhook / start_webhook
+    """
+    check_webhook_url()
+    if not WEBHOOK_SECRET_TOKEN:
+        logger.warning("WEBHOOK_SECRET_TOKEN is not set - anyone who finds the webhook URL can post updates")
+    
+    return {
+        "listen": WEBHOOK_LISTEN,
+        "port": WEBHOOK_PORT,
+        "url_path": WEBHOOK_PATH,
+        "webhook_url": WEBHOOK_URL,
+        "secret_token": WEBHOOK_SECRET_TOKEN,
+        "max_connections": WEBHOOK_MAX_CONNECTIONS,
+        "allowed_updates": Update.ALL_TYPES,
+    }
+
+def build_application(with_updater=True, shard_count=1):
+    """
+    Create the Telegram application with all handlers registered
+    
+    Args:
+        with_updater (bool): Whether the application fetches its own updates.
+            Sharded workers receive updates from the front end instead.
+        shard_count (int): Number of worker processes sharing the bot's limits
+    
+    Returns:
+        Application: The configured application
+    """
     # Create the application
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    # Updates are handled concurrently, but each chat's updates stay in order
+    # (which also keeps the conversation handlers below consistent)
+    update_processor = ChatOrderedUpdateProcessor()
+    # Per-chat limits hold as they are, since each chat is handled by one worker
+    send_scheduler = SendScheduler(global_rate=SEND_GLOBAL_RATE / shard_count)
+    if shard_count > 1:
+        set_max_concurrent_requests(max(1, MAX_CONCURRENT_REQUESTS // shard_count))
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .base_url(f"{TELEGRAM_API_URL}/bot")
+        .base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+        .concurrent_updates(update_processor)
+        .rate_limiter(send_scheduler)
+        # Conversation states survive restarts, so users aren't dropped mid-/register or /imagine
+        .persistence(SQLitePersistence())
+        .post_init(startup)
+        .post_stop(stopping)
+        .post_shutdown(shutdown)
+    )
+    if not with_updater:
+        builder = builder.updater(None)
+    application = builder.build()
+    
+    # Expose queue depths on the metrics endpoint
+    QUEUE_DEPTH.set_callback(lambda: update_processor.current_concurrent_updates, queue="updates")
+    QUEUE_DEPTH.set_callback(lambda: send_scheduler.queued, queue="outgoing_messages")
+    QUEUE_DEPTH.set_callback(lambda: request_limiter.queued, queue="user_requests")
+    QUEUE_DEPTH.set_callback(lambda: job_queue.running, queue="running_jobs")
+    
+    # Slow commands run in the background job queue
+    job_queue.register("sleep", sleep_job, "😔 Sorry, I couldn't save a memory. Please try /sleep again.")
+    job_queue.register("reset", reset_job, "😔 Sorry, I couldn't reset your memories. Please try /reset again.")
+    job_queue.register("imagine", imagine_job, "😔 Sorry, I couldn't create your image. Please try /imagine again.")
+    job_queue.register("message", message_job, "😔 Sorry, I couldn't answer your message. Please send it again.")
     
     # Add conversation handler for registration
     registration_handler = ConversationHandler(
-        entry_points=[CommandHandler('register', register_command)],
+        entry_points=[
+            CommandHandler('register', register_command),
+            CommandHandler('start', register_command, filters=REGISTER_DEEP_LINK)
+        ],
         states={
             AWAITING_API_KEY: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, process_api_key)
             ],
         },
-        fallbacks=[CommandHandler('cancel', cancel_registration)]
+        fallbacks=[CommandHandler('cancel', cancel_registration)],
+        name="registration",
+        persistent=True
     )
     
     # Add conversation handler for imagine
@@ -353,11 +706,14 @@ def run_bot():
                 MessageHandler(filters.TEXT & ~filters.COMMAND, process_imagine_prompt)
             ],
         },
-        fallbacks=[CommandHandler('cancel', cancel_imagine)]
+        fallbacks=[CommandHandler('cancel', cancel_imagine)],
+        name="imagine",
+        persistent=True
     )
     
     # Add handlers
-    application.add_handler(CommandHandler("start", start))
+    # The registration deep link is handled by the registration conversation
+    application.add_handler(CommandHandler("start", start, filters=~REGISTER_DEEP_LINK))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("wack", wack_command))
     application.add_handler(CommandHandler("sleep", sleep_command))
@@ -374,14 +730,55 @@ def run_bot():
         handle_message
     ))
     
-    # 2. Messages in group chats - we'll do additional filtering in the handler
+    # 2. Messages in group chats - only those mentioning or replying to the bot
     application.add_handler(MessageHandler(
-        (filters.TEXT & ~filters.COMMAND & filters.ChatType.GROUPS), 
+        (filters.TEXT & ~filters.COMMAND & filters.ChatType.GROUPS & ADDRESSED_TO_BOT), 
         handle_message
     ))
     
+    # 3. Inline queries ("@bot question" in any chat)
+    application.add_handler(InlineQueryHandler(inline_query))
+    
+    return application
+
+# Event loop of a bot running in a child thread, for stop_bot()
+bot_loop = None
+
+def stop_bot():
+    """
+    Ask a bot running in a child thread to drain and shut down.
+    
+    In the main thread the bot stops itself on SIGINT/SIGTERM; a host that runs
+    it in a child thread (e.g. next to a web server) should call this from its
+    own shutdown handling. Safe to call from any thread.
+    """
+    if bot_loop is not None and bot_loop.is_running():
+        bot_loop.call_soon_threadsafe(bot_loop.stop)
+
+def run_bot(mode=None):
+    """
+    Initialize and run the Telegram bot
+    
+    Args:
+        mode (str, optional): "polling" or "webhook"; defaults to BOT_MODE
+    """
+    global bot_loop
+    mode = (mode or BOT_MODE).lower()
+    if mode not in ("polling", "webhook"):
+        raise ValueError(f"Unknown bot mode: {mode}")
+    
+    startup_timer.mark("imports")
+    
+    # Initialize the database, taking over jobs queued by sharded workers of an earlier run
+    init_db()
+    assign_jobs_to_shards(1)
+    startup_timer.mark("database")
+    
+    application = build_application()
+    startup_timer.mark("build")
+    
     # Start the bot
-    logger.info("Starting the bot...")
+    logger.info(f"Starting the bot in {mode} mode...")
     
     # When running in a thread from Flask, we need to use asyncio properly
     import asyncio
@@ -390,7 +787,10 @@ def run_bot():
     # Check if we're in the main thread or a child thread
     if threading.current_thread() is threading.main_thread():
         # In main thread, we can just run it directly
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        if mode == "webhook":
+            application.run_webhook(**webhook_settings())
+        else:
+            application.run_polling(allowed_updates=Update.ALL_TYPES)
     else:
         # In a child thread, we need to create and run a new event loop
         try:
@@ -401,13 +801,35 @@ def run_bot():
             # Define the async functions to run
             async def start_application():
                 await application.initialize()
-                await application.updater.start_polling()
+                await startup(application)
+                if mode == "webhook":
+                    await application.updater.start_webhook(**webhook_settings())
+                else:
+                    await application.updater.start_polling()
                 await application.start()
-                logger.info("Bot is now polling for updates...")
+                logger.info(f"Bot is now receiving updates via {mode}...")
+            
+            # The same steps run_polling takes when it gets a stop signal
+            async def stop_application():
+                # Stopping the updater also confirms the updates fetched so far with Telegram
+                if application.updater.running:
+                    await application.updater.stop()
+                if application.running:
+                    await application.stop()
+                    await stopping(application)
+                await application.shutdown()
+                await shutdown(application)
                 
-            # Run the async function in the event loop
-            loop.run_until_complete(start_application())
-            loop.run_forever()
+            # Run the async function in the event loop until stop_bot() is called
+            bot_loop = loop
+            try:
+                loop.run_until_complete(start_application())
+                loop.run_forever()
+            finally:
+                bot_loop = None
+                logger.info("Stopping the bot...")
+                loop.run_until_complete(stop_application())
+                loop.close()
         except Exception as e:
             logger.error(f"Error running bot: {str(e)}")
             raise
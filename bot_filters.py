@@ -0,0 +1,57 @@
+import re
+import functools
+
+from telegram import MessageEntity
+from telegram.ext import filters
+
+
+@functools.lru_cache(maxsize=8)
+def mention_pattern(bot_username):
+    """
+    Get the compiled pattern matching an @mention of the bot.
+
+    Args:
+        bot_username (str): The bot's username, without the @
+
+    Returns:
+        re.Pattern: Matches the mention plus any whitespace after it
+    """
+    return re.compile(rf'@{re.escape(bot_username)}\b\s*', re.IGNORECASE)
+
+
+class AddressedToBotFilter(filters.MessageFilter):
+    """
+    Passes messages that mention the bot or reply to one of its messages.
+
+    Only message entities and the reply header are inspected, so unrelated
+    group chatter is rejected before any handler (or database) work runs.
+    """
+
+    __slots__ = ()
+
+    def filter(self, message):
+        bot = message.get_bot()
+
+        # Replies to the bot's own messages
+        reply = message.reply_to_message
+        if reply and reply.from_user and reply.from_user.id == bot.id:
+            return True
+
+        if not message.entities:
+            return False
+
+        bot_username = bot.username.lower()
+        for entity in message.entities:
+            if entity.type == MessageEntity.MENTION:
+                # Entity offsets count UTF-16 code units, so let Telegram's helper slice the text
+                if message.parse_entity(entity)[1:].lower() == bot_username:
+                    return True
+            elif entity.type == MessageEntity.TEXT_MENTION:
+                if entity.user and entity.user.id == bot.id:
+                    return True
+
+        return False
+
+
+# Shared instance for handler registration
+ADDRESSED_TO_BOT = AddressedToBotFilter(name="AddressedToBot")
@@ -0,0 +1,76 @@
+import os
+import asyncio
+import logging
+import contextlib
+
+from telegram.error import Forbidden, TelegramError
+
+from send_scheduler import send_priority, PRIORITY_LOW
+import profiling
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Telegram shows a chat action for about 5 seconds, so repeat it a little sooner
+CHAT_ACTION_INTERVAL = float(os.environ.get("CHAT_ACTION_INTERVAL", "4.5"))
+
+
+class ChatActionManager:
+    """
+    Keeps "typing…" style indicators up while requests are in flight.
+
+    Each (chat, action) pair has at most one sender task, shared by every
+    request in that chat that wants the same action, and cancelled when
+    the last of them finishes. Actions go out at low priority through the
+    send scheduler, so they never hold up real replies.
+    """
+
+    def __init__(self, interval=CHAT_ACTION_INTERVAL):
+        self.interval = interval
+        # (chat_id, action) -> [sender task, number of requests using it]
+        self._senders = {}
+
+    def __len__(self):
+        return len(self._senders)
+
+    @contextlib.asynccontextmanager
+    async def keep(self, bot, chat_id, action):
+        """
+        Show a chat action for as long as the block runs.
+
+        Args:
+            bot (telegram.Bot): The bot to send with
+            chat_id (int): The chat to show the action in
+            action (str): A telegram.constants.ChatAction value
+        """
+        key = (chat_id, action)
+        entry = self._senders.get(key)
+        if entry is None:
+            entry = self._senders[key] = [asyncio.create_task(self._send_repeatedly(bot, chat_id, action)), 0]
+        entry[1] += 1
+
+        try:
+            yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._senders[key]
+                entry[0].cancel()
+
+    async def _send_repeatedly(self, bot, chat_id, action):
+        # Shared by every request in the chat, so not part of any one update's profile
+        profiling.detach()
+        while True:
+            try:
+                with send_priority(PRIORITY_LOW):
+                    await bot.send_chat_action(chat_id=chat_id, action=action)
+            except Forbidden:
+                # Blocked or removed from the chat; the reply will fail too
+                return
+            except TelegramError as e:
+                logger.debug(f"Could not send {action} to chat {chat_id}: {str(e)}")
+            await asyncio.sleep(self.interval)
+
+
+# Shared chat action manager
+chat_actions = ChatActionManager()
@@ -0,0 +1,127 @@
+import os
+import time
+import asyncio
+import logging
+import importlib.util
+from collections import OrderedDict
+
+import httpx
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Pool configuration
+SHAPES_API_URL = os.environ.get("SHAPES_API_URL", "https://api.shapes.inc/v1/")
+CLIENT_POOL_SIZE = int(os.environ.get("CLIENT_POOL_SIZE", "256"))
+CLIENT_IDLE_TIMEOUT = float(os.environ.get("CLIENT_IDLE_TIMEOUT", "300"))
+SHAPES_MAX_CONNECTIONS = int(os.environ.get("SHAPES_MAX_CONNECTIONS", "100"))
+SHAPES_MAX_KEEPALIVE = int(os.environ.get("SHAPES_MAX_KEEPALIVE", "20"))
+
+# HTTP/2 needs the optional h2 package (installed by httpx[http2])
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+class ShapesClientPool:
+    """
+    Registry of AsyncOpenAI clients keyed by API key.
+
+    All clients share one httpx connection pool, so connections to the
+    Shapes API stay warm no matter which user is talking. The per-key
+    clients themselves are cheap wrappers kept in a bounded LRU and
+    dropped after sitting idle.
+    """
+
+    def __init__(self, base_url=SHAPES_API_URL, max_size=CLIENT_POOL_SIZE,
+                 idle_timeout=CLIENT_IDLE_TIMEOUT):
+        self.base_url = base_url
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._clients = OrderedDict()
+        self._http_client = None
+
+    def _get_http_client(self):
+        """
+        Create the shared httpx client on first use, inside the running loop
+        """
+        if self._http_client is None or self._http_client.is_closed:
+            self._http_client = httpx.AsyncClient(
+                http2=HTTP2_AVAILABLE,
+                limits=httpx.Limits(
+                    max_connections=SHAPES_MAX_CONNECTIONS,
+                    max_keepalive_connections=SHAPES_MAX_KEEPALIVE,
+                    keepalive_expiry=self.idle_timeout,
+                ),
+                timeout=None,
+            )
+            logger.info(f"Opened Shapes HTTP connection pool (http2={HTTP2_AVAILABLE})")
+        return self._http_client
+
+    def _evict_idle(self, now):
+        """
+        Drop clients that haven't been used within the idle timeout
+        """
+        # Entries are kept in least-recently-used order, so stop at the first fresh one
+        while self._clients:
+            api_key, (client, last_used) = next(iter(self._clients.items()))
+            if now - last_used < self.idle_timeout:
+                break
+            self._clients.popitem(last=False)
+
+    def get(self, api_key):
+        """
+        Get the client for an API key, creating it if needed.
+
+        Args:
+            api_key (str): The user's API key
+
+        Returns:
+            AsyncOpenAI: A client bound to the shared connection pool
+        """
+        now = time.monotonic()
+        self._evict_idle(now)
+
+        entry = self._clients.pop(api_key, None)
+        if entry is None:
+            # The openai package is slow to import, so it isn't loaded until it's needed
+            from openai import AsyncOpenAI
+            
+            client = AsyncOpenAI(
+                api_key=api_key,
+                base_url=self.base_url,
+                http_client=self._get_http_client(),
+                # Retries are handled by the API handler's call pipeline
+                max_retries=0,
+            )
+        else:
+            client = entry[0]
+
+        self._clients[api_key] = (client, now)
+
+        # Keep the registry bounded
+        while len(self._clients) > self.max_size:
+            self._clients.popitem(last=False)
+
+        return client
+
+    def __len__(self):
+        return len(self._clients)
+
+    async def warm_up(self):
+        """
+        Import the openai package in a worker thread, so the first request doesn't wait for it
+        """
+        await asyncio.to_thread(importlib.import_module, "openai")
+
+    async def close(self):
+        """
+        Forget all clients and close the shared connection pool
+        """
+        self._clients.clear()
+        if self._http_client is not None and not self._http_client.is_closed:
+            await self._http_client.aclose()
+            logger.info("Closed Shapes HTTP connection pool")
+        self._http_client = None
+
+
+# Shared pool used by the API handler
+shapes_clients = ShapesClientPool()
@@ -0,0 +1,25 @@
+"""
+Configuration loading.
+
+Settings are read from environment variables, which may come from a .env
+file. The file is read once per process, before the modules that read
+their settings at import time are loaded.
+"""
+
+_loaded = False
+
+
+def load_config():
+    """
+    Load environment variables from the .env file if it exists.
+
+    Safe to call more than once; only the first call reads the file.
+    Variables already set in the environment take precedence.
+    """
+    global _loaded
+    if _loaded:
+        return
+
+    from dotenv import load_dotenv
+    load_dotenv()
+    _loaded = True
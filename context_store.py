@@ -0,0 +1,206 @@
+import os
+import json
+import logging
+from collections import OrderedDict, deque
+
+from db import run_in_db_thread, save_contexts, load_context, delete_context
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Rough token budget for the history sent with each message (0 turns history off)
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "1024"))
+
+# How many conversations to keep in memory before evicting the least recently used
+CONTEXT_MAX_CONVERSATIONS = int(os.environ.get("CONTEXT_MAX_CONVERSATIONS", "5000"))
+
+# Save evicted conversations to SQLite and load them back when they resume
+CONTEXT_SPILL = os.environ.get("CONTEXT_SPILL", "false").lower() in ("1", "true", "yes")
+
+
+def estimate_tokens(text):
+    """
+    Cheap token estimate (about four characters per token).
+
+    Args:
+        text (str): The text to measure
+
+    Returns:
+        int: Estimated token count
+    """
+    return len(text) // 4 + 1
+
+
+class _Conversation:
+    __slots__ = ("turns", "tokens")
+
+    def __init__(self, turns=()):
+        # Each turn is a compact (role, text, tokens) tuple
+        self.turns = deque()
+        self.tokens = 0
+        for role, text in turns:
+            self.append(role, text)
+
+    def append(self, role, text):
+        tokens = estimate_tokens(text)
+        self.turns.append((role, text, tokens))
+        self.tokens += tokens
+
+    def trim(self, budget):
+        """
+        Drop the oldest turns until the conversation fits the budget
+        """
+        while self.turns and self.tokens > budget:
+            _, _, tokens = self.turns.popleft()
+            self.tokens -= tokens
+
+    def to_json(self):
+        return json.dumps([[role, text] for role, text, _ in self.turns])
+
+
+class ConversationContextStore:
+    """
+    Recent turns per (chat_id, user_id), bounded in two ways.
+
+    Each conversation is trimmed to a token budget, oldest turns first, and
+    only the most recently active conversations are kept in memory. When
+    spilling is on, evicted conversations are written to SQLite in one
+    batch and read back when they resume.
+    """
+
+    def __init__(self, token_budget=CONTEXT_TOKEN_BUDGET, max_conversations=CONTEXT_MAX_CONVERSATIONS,
+                 spill=CONTEXT_SPILL):
+        self.token_budget = token_budget
+        self.max_conversations = max_conversations
+        self.spill = spill
+        self._conversations = OrderedDict()
+
+    @property
+    def enabled(self):
+        return self.token_budget > 0
+
+    def __len__(self):
+        return len(self._conversations)
+
+    async def _get(self, key):
+        """
+        Find a conversation in memory, or in SQLite when spilling
+        """
+        conversation = self._conversations.get(key)
+        if conversation is not None:
+            self._conversations.move_to_end(key)
+            return conversation
+
+        if not self.spill:
+            return None
+
+        stored = await run_in_db_thread(load_context, *key)
+        if stored is None:
+            return None
+
+        conversation = _Conversation(json.loads(stored))
+        await self._put(key, conversation)
+        return conversation
+
+    async def _put(self, key, conversation):
+        """
+        Add a conversation to memory, evicting the least recently used ones
+        """
+        self._conversations[key] = conversation
+        self._conversations.move_to_end(key)
+
+        evicted = []
+        while len(self._conversations) > self.max_conversations:
+            old_key, old_conversation = self._conversations.popitem(last=False)
+            evicted.append((old_key[0], old_key[1], old_conversation.to_json()))
+
+        if evicted and self.spill:
+            await run_in_db_thread(save_contexts, evicted)
+
+    async def get_history(self, chat_id, user_id, new_text=""):
+        """
+        Get the turns to send along with a new message.
+
+        Args:
+            chat_id (int): The Telegram chat ID
+            user_id (int): The Telegram user ID
+            new_text (str): The new message, whose tokens are reserved from the budget
+
+        Returns:
+            list: {"role", "content"} dicts, oldest first
+        """
+        if not self.enabled:
+            return []
+
+        conversation = await self._get((chat_id, user_id))
+        if conversation is None:
+            return []
+
+        # Take the newest turns that fit next to the new message
+        budget = self.token_budget - estimate_tokens(new_text)
+        history = []
+        for role, text, tokens in reversed(conversation.turns):
+            if tokens > budget:
+                break
+            budget -= tokens
+            history.append({"role": role, "content": text})
+        history.reverse()
+        return history
+
+    async def add_exchange(self, chat_id, user_id, user_text, reply_text):
+        """
+        Remember a message and the Shape's reply to it.
+
+        Args:
+            chat_id (int): The Telegram chat ID
+            user_id (int): The Telegram user ID
+            user_text (str): What the user said
+            reply_text (str): What the Shape answered
+        """
+        if not self.enabled:
+            return
+
+        key = (chat_id, user_id)
+        conversation = await self._get(key)
+        if conversation is None:
+            conversation = _Conversation()
+            await self._put(key, conversation)
+
+        conversation.append("user", user_text)
+        conversation.append("assistant", reply_text)
+        conversation.trim(self.token_budget)
+
+    async def clear(self, user_id, chat_id=None):
+        """
+        Forget a user's conversation in one chat, or in every chat.
+
+        Args:
+            user_id (int): The Telegram user ID
+            chat_id (int, optional): Only forget this chat's conversation
+        """
+        if chat_id is not None:
+            self._conversations.pop((chat_id, user_id), None)
+        else:
+            for key in [key for key in self._conversations if key[1] == user_id]:
+                del self._conversations[key]
+
+        if self.spill:
+            await run_in_db_thread(delete_context, user_id, chat_id)
+
+    async def flush(self):
+        """
+        Save every in-memory conversation to SQLite (when spilling is on).
+        """
+        if not self.spill or not self._conversations:
+            return
+
+        contexts = [
+            (chat_id, user_id, conversation.to_json())
+            for (chat_id, user_id), conversation in self._conversations.items()
+        ]
+        await run_in_db_thread(save_contexts, contexts)
+        logger.info(f"Saved {len(contexts)} conversations to the database")
+
+
+# Shared context store used by the message handler
+context_store = ConversationContextStore()
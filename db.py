@@ -1,6 +1,15 @@
 import sqlite3
 import logging
 import os
+import time
+import asyncio
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import TTLCache, MISSING
+from metrics import timed, DB_QUERY_SECONDS, CACHE_REQUESTS_TOTAL
+from profiling import span
 
 # Set up logging
 logger = logging.getLogger(__name__)
@@ -8,89 +17,692 @@ logger = logging.getLogger(__name__)
 # Database file name
 DB_FILE = os.environ.get("DB_FILE", "shape_bot.db")
 
+# How long (in milliseconds) to wait on a locked database before giving up
+DB_BUSY_TIMEOUT = int(os.environ.get("DB_BUSY_TIMEOUT", "5000"))
+
+# API key cache settings (negative entries remember unregistered users)
+API_KEY_CACHE_SIZE = int(os.environ.get("API_KEY_CACHE_SIZE", "10000"))
+API_KEY_CACHE_TTL = float(os.environ.get("API_KEY_CACHE_TTL", "600"))
+API_KEY_CACHE_NEGATIVE_TTL = float(os.environ.get("API_KEY_CACHE_NEGATIVE_TTL", "60"))
+
+# Seconds between checks for keys changed by other processes (other workers, admin.py)
+API_KEY_CACHE_CHECK_INTERVAL = float(os.environ.get("API_KEY_CACHE_CHECK_INTERVAL", "1"))
+
+# In-process cache of user_id -> api_key (None for unregistered users)
+api_key_cache = TTLCache(API_KEY_CACHE_SIZE, API_KEY_CACHE_TTL)
+CACHE_REQUESTS_TOTAL.set_callback(lambda: api_key_cache.hits, cache="api_key", result="hit")
+CACHE_REQUESTS_TOTAL.set_callback(lambda: api_key_cache.misses, cache="api_key", result="miss")
+
+# Version of the users table this process's cache reflects, and when to check it next
+_seen_users_version = None
+_next_users_check = 0.0
+
+# One long-lived connection per thread, tracked so they can be closed on shutdown
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+_generation = 0
+
+# Dedicated thread that runs queries for the async API
+_executor = None
+
+def get_connection():
+    """
+    Get this thread's persistent database connection, opening it if needed.
+
+    Returns:
+        sqlite3.Connection: A connection configured for WAL mode
+    """
+    # Reuse this thread's connection unless close_db() has run since it was opened
+    if getattr(_local, "generation", None) == _generation:
+        return _local.conn
+
+    conn = sqlite3.connect(DB_FILE, timeout=DB_BUSY_TIMEOUT / 1000, check_same_thread=False)
+
+    # WAL lets readers run alongside a writer; NORMAL sync only fsyncs at checkpoints
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT}")
+
+    _local.conn = conn
+    _local.generation = _generation
+    with _connections_lock:
+        _connections.append(conn)
+    return conn
+
+def _get_executor():
+    """
+    Get the single-threaded executor used for database work
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+    return _executor
+
+async def run_in_db_thread(func, *args, **kwargs):
+    """
+    Run a blocking database function on the dedicated DB thread.
+
+    Args:
+        func (callable): The function to run
+        *args: Positional arguments for the function
+        **kwargs: Keyword arguments for the function
+
+    Returns:
+        Whatever the function returns
+    """
+    loop = asyncio.get_running_loop()
+    with span("db"):
+        return await loop.run_in_executor(_get_executor(), functools.partial(func, *args, **kwargs))
+
+def close_db():
+    """
+    Wait for pending database work and close every open connection.
+    """
+    global _executor, _generation
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+    with _connections_lock:
+        for conn in _connections:
+            conn.close()
+        _connections.clear()
+        _generation += 1
+    logger.info("Database connections closed")
+
 def init_db():
     """
     Initialize the database with the required tables.
     """
     logger.info("Initializing database...")
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    # Create users table with user_id and api_key
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            api_key TEXT NOT NULL
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
+    conn = get_connection()
+
+    with conn:
+        # Create users table with user_id and api_key
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                api_key TEXT NOT NULL
+            )
+        ''')
+        
+        # Bumped on every change to users, so each process knows when its key cache is stale
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS users_version (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                version INTEGER NOT NULL
+            )
+        ''')
+        conn.execute('INSERT OR IGNORE INTO users_version (id, version) VALUES (0, 0)')
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS users_{event.lower()}_version AFTER {event} ON users
+                BEGIN
+                    UPDATE users_version SET version = version + 1 WHERE id = 0;
+                END
+            ''')
+        
+        # Conversation history spilled out of the in-memory context store
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS conversation_context (
+                chat_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                turns TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (chat_id, user_id)
+            )
+        ''')
+
+        # Conversation states and user/chat/bot data written by SQLitePersistence
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS bot_state (
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                data TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (kind, key)
+            )
+        ''')
+
+        # Images delivered for /imagine prompts, by prompt and by content hash
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS image_cache (
+                prompt_key TEXT PRIMARY KEY,
+                content_hash TEXT NOT NULL,
+                file_id TEXT,
+                created_at REAL NOT NULL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS image_cache_content_hash ON image_cache (content_hash)')
+
+        # Durable queue of slow commands, run by the job workers in jobs.py
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                owner INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS jobs_owner_status ON jobs (owner, status, id)')
+
     logger.info("Database initialized successfully!")
 
+@timed(DB_QUERY_SECONDS, query="store_api_key")
 def store_api_key(user_id, api_key):
     """
     Store a user's API key in the database.
-    
+
     Args:
         user_id (int): The Telegram user ID
         api_key (str): The user's Shapes API key
     """
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    # Insert or replace the user's API key
-    cursor.execute('''
-        INSERT OR REPLACE INTO users (user_id, api_key)
-        VALUES (?, ?)
-    ''', (user_id, api_key))
-    
-    conn.commit()
-    conn.close()
+    conn = get_connection()
+
+    with conn:
+        # Insert or replace the user's API key
+        conn.execute('''
+            INSERT OR REPLACE INTO users (user_id, api_key)
+            VALUES (?, ?)
+        ''', (user_id, api_key))
+
+    # Keep the cache in step with the new key
+    api_key_cache.set(user_id, api_key)
     logger.info(f"Stored API key for user {user_id}")
 
+def _users_check_due():
+    """
+    Check whether it is time to look for key changes made by other processes
+    """
+    global _next_users_check
+    now = time.monotonic()
+    if now < _next_users_check:
+        return False
+    _next_users_check = now + API_KEY_CACHE_CHECK_INTERVAL
+    return True
+
+@timed(DB_QUERY_SECONDS, query="check_users_version")
+def _check_users_version():
+    """
+    Empty the key cache if any process has changed the users table since the last check
+    """
+    global _seen_users_version
+    version = get_connection().execute('SELECT version FROM users_version WHERE id = 0').fetchone()
+    if version != _seen_users_version:
+        api_key_cache.clear()
+        _seen_users_version = version
+
 def get_api_key(user_id):
     """
-    Retrieve a user's API key from the database.
-    
+    Retrieve a user's API key, from the cache when possible.
+
     Args:
         user_id (int): The Telegram user ID
-        
+
     Returns:
         str or None: The API key if found, None otherwise
     """
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT api_key FROM users WHERE user_id = ?', (user_id,))
-    result = cursor.fetchone()
-    
-    conn.close()
-    
+    if _users_check_due():
+        _check_users_version()
+
+    # Serve repeat lookups (including unregistered users) from memory
+    cached = api_key_cache.get(user_id)
+    if cached is not MISSING:
+        return cached
+    return _load_api_key(user_id)
+
+@timed(DB_QUERY_SECONDS, query="get_api_key")
+def _load_api_key(user_id):
+    """
+    Read a user's API key from disk and remember the result in the cache
+    """
+    conn = get_connection()
+    result = conn.execute('SELECT api_key FROM users WHERE user_id = ?', (user_id,)).fetchone()
+
     if result:
+        api_key_cache.set(user_id, result[0])
         return result[0]
+
+    api_key_cache.set(user_id, None, ttl=API_KEY_CACHE_NEGATIVE_TTL)
     return None
 
+@timed(DB_QUERY_SECONDS, query="delete_api_key")
 def delete_api_key(user_id):
     """
     Delete a user's API key from the database.
-    
+
     Args:
         user_id (int): The Telegram user ID
-        
+
     Returns:
         bool: True if a key was deleted, False otherwise
     """
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    cursor.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
-    rows_affected = cursor.rowcount
-    
-    conn.commit()
-    conn.close()
-    
+    conn = get_connection()
+
+    with conn:
+        rows_affected = conn.execute('DELETE FROM users WHERE user_id = ?', (user_id,)).rowcount
+
+    # The user is now unregistered either way
+    api_key_cache.set(user_id, None, ttl=API_KEY_CACHE_NEGATIVE_TTL)
+
     if rows_affected > 0:
         logger.info(f"Deleted API key for user {user_id}")
         return True
     return False
+
+@timed(DB_QUERY_SECONDS, query="list_api_keys")
+def list_api_keys(after=None, limit=1000):
+    """
+    Retrieve a page of registered users, in user ID order.
+
+    Args:
+        after (int, optional): Only users with a higher ID (the last ID of the previous page)
+        limit (int): Maximum users to return
+
+    Returns:
+        list: (user_id, api_key) tuples
+    """
+    conn = get_connection()
+    if after is None:
+        return conn.execute(
+            'SELECT user_id, api_key FROM users ORDER BY user_id LIMIT ?', (limit,)
+        ).fetchall()
+    return conn.execute(
+        'SELECT user_id, api_key FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?',
+        (after, limit)
+    ).fetchall()
+
+def iter_api_keys(batch_size=1000):
+    """
+    Iterate over every registered user without loading them all at once.
+
+    Args:
+        batch_size (int): Users read per query
+
+    Yields:
+        tuple: (user_id, api_key)
+    """
+    after = None
+    while True:
+        rows = list_api_keys(after, batch_size)
+        yield from rows
+        if len(rows) < batch_size:
+            return
+        after = rows[-1][0]
+
+@timed(DB_QUERY_SECONDS, query="store_api_keys")
+def store_api_keys(rows, replace=True):
+    """
+    Store many users' API keys in one transaction.
+
+    Rows are consumed as they are written, so they can be streamed from a
+    file. If any row fails, none are stored.
+
+    Args:
+        rows (iterable): (user_id, api_key) tuples
+        replace (bool): Overwrite the keys of users already registered; otherwise keep them
+
+    Returns:
+        int: How many users were stored
+    """
+    conn = get_connection()
+    verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+
+    with conn:
+        stored = conn.executemany(f'''
+            {verb} INTO users (user_id, api_key)
+            VALUES (?, ?)
+        ''', rows).rowcount
+
+    # Any cached key may be stale now
+    api_key_cache.clear()
+    logger.info(f"Stored API keys for {stored} users")
+    return stored
+
+@timed(DB_QUERY_SECONDS, query="delete_api_keys")
+def delete_api_keys(rows):
+    """
+    Delete many users' API keys in one transaction.
+
+    A user is only deleted if their key is still the given one, so users
+    who registered a new key in the meantime are kept.
+
+    Args:
+        rows (iterable): (user_id, api_key) tuples
+
+    Returns:
+        int: How many keys were deleted
+    """
+    conn = get_connection()
+    rows = list(rows)
+
+    with conn:
+        deleted = conn.executemany('DELETE FROM users WHERE user_id = ? AND api_key = ?', rows).rowcount
+
+    # Let the next lookups see what is left
+    for user_id, _ in rows:
+        api_key_cache.pop(user_id)
+    logger.info(f"Deleted API keys for {deleted} users")
+    return deleted
+
+@timed(DB_QUERY_SECONDS, query="save_contexts")
+def save_contexts(contexts):
+    """
+    Store several conversations' recent turns in one transaction.
+
+    Args:
+        contexts (list): (chat_id, user_id, turns_json) tuples
+    """
+    conn = get_connection()
+    now = time.time()
+
+    with conn:
+        conn.executemany('''
+            INSERT OR REPLACE INTO conversation_context (chat_id, user_id, turns, updated_at)
+            VALUES (?, ?, ?, ?)
+        ''', [(chat_id, user_id, turns, now) for chat_id, user_id, turns in contexts])
+
+@timed(DB_QUERY_SECONDS, query="load_context")
+def load_context(chat_id, user_id):
+    """
+    Retrieve a conversation's stored turns.
+
+    Args:
+        chat_id (int): The Telegram chat ID
+        user_id (int): The Telegram user ID
+
+    Returns:
+        str or None: The turns as JSON if stored, None otherwise
+    """
+    conn = get_connection()
+    result = conn.execute(
+        'SELECT turns FROM conversation_context WHERE chat_id = ? AND user_id = ?',
+        (chat_id, user_id)
+    ).fetchone()
+    return result[0] if result else None
+
+@timed(DB_QUERY_SECONDS, query="delete_context")
+def delete_context(user_id, chat_id=None):
+    """
+    Delete a user's stored conversation turns.
+
+    Args:
+        user_id (int): The Telegram user ID
+        chat_id (int, optional): Only delete this chat's conversation
+    """
+    conn = get_connection()
+
+    with conn:
+        if chat_id is None:
+            conn.execute('DELETE FROM conversation_context WHERE user_id = ?', (user_id,))
+        else:
+            conn.execute(
+                'DELETE FROM conversation_context WHERE chat_id = ? AND user_id = ?',
+                (chat_id, user_id)
+            )
+
+@timed(DB_QUERY_SECONDS, query="load_state")
+def load_state(kind):
+    """
+    Retrieve every stored entry of one kind of bot state.
+
+    Args:
+        kind (str): e.g. "conversation:imagine"
+
+    Returns:
+        list: (key, data) tuples, both JSON strings
+    """
+    conn = get_connection()
+    return conn.execute('SELECT key, data FROM bot_state WHERE kind = ?', (kind,)).fetchall()
+
+@timed(DB_QUERY_SECONDS, query="save_state")
+def save_state(updates, deletes=()):
+    """
+    Store and delete bot state entries in one transaction.
+
+    Args:
+        updates (list): (kind, key, data) tuples to insert or replace
+        deletes (list): (kind, key) tuples to delete
+    """
+    conn = get_connection()
+    now = time.time()
+
+    with conn:
+        if deletes:
+            conn.executemany('DELETE FROM bot_state WHERE kind = ? AND key = ?', deletes)
+        if updates:
+            conn.executemany('''
+                INSERT OR REPLACE INTO bot_state (kind, key, data, updated_at)
+                VALUES (?, ?, ?, ?)
+            ''', [(kind, key, data, now) for kind, key, data in updates])
+
+@timed(DB_QUERY_SECONDS, query="get_cached_image")
+def get_cached_image(prompt_key, max_age):
+    """
+    Retrieve the image delivered for a prompt, if it is recent enough.
+
+    Args:
+        prompt_key (str): Hash of the model and normalized prompt
+        max_age (float): Ignore entries older than this many seconds
+
+    Returns:
+        tuple or None: (content_hash, file_id) if found; file_id may be None
+    """
+    conn = get_connection()
+    return conn.execute(
+        'SELECT content_hash, file_id FROM image_cache WHERE prompt_key = ? AND created_at > ?',
+        (prompt_key, time.time() - max_age)
+    ).fetchone()
+
+@timed(DB_QUERY_SECONDS, query="find_image_file_id")
+def find_image_file_id(content_hash):
+    """
+    Find the Telegram file_id of an image that was already uploaded.
+
+    Args:
+        content_hash (str): SHA-256 of the image bytes
+
+    Returns:
+        str or None: The file_id if the image was uploaded before
+    """
+    conn = get_connection()
+    result = conn.execute(
+        'SELECT file_id FROM image_cache WHERE content_hash = ? AND file_id IS NOT NULL LIMIT 1',
+        (content_hash,)
+    ).fetchone()
+    return result[0] if result else None
+
+@timed(DB_QUERY_SECONDS, query="save_cached_image")
+def save_cached_image(prompt_key, content_hash, file_id):
+    """
+    Remember the image delivered for a prompt.
+
+    Args:
+        prompt_key (str): Hash of the model and normalized prompt
+        content_hash (str): SHA-256 of the image bytes
+        file_id (str or None): Telegram's file_id for the uploaded image
+    """
+    conn = get_connection()
+
+    with conn:
+        conn.execute('''
+            INSERT OR REPLACE INTO image_cache (prompt_key, content_hash, file_id, created_at)
+            VALUES (?, ?, ?, ?)
+        ''', (prompt_key, content_hash, file_id, time.time()))
+
+@timed(DB_QUERY_SECONDS, query="enqueue_job")
+def enqueue_job(owner, kind, user_id, payload, max_per_user):
+    """
+    Add a job to the queue, unless the user already has too many waiting.
+
+    Args:
+        owner (int): The worker process that will run the job
+        kind (str): Which job handler runs it
+        user_id (int): The Telegram user the job is for
+        payload (str): JSON arguments for the handler
+        max_per_user (int): How many unfinished jobs a user may have
+
+    Returns:
+        int or None: The new job's ID, or None if the user is over the limit
+    """
+    conn = get_connection()
+    now = time.time()
+
+    with conn:
+        cursor = conn.execute('''
+            INSERT INTO jobs (owner, kind, user_id, payload, status, created_at, updated_at)
+            SELECT ?, ?, ?, ?, 'queued', ?, ?
+            WHERE (SELECT COUNT(*) FROM jobs WHERE owner = ? AND user_id = ?) < ?
+        ''', (owner, kind, user_id, payload, now, now, owner, user_id, max_per_user))
+    return cursor.lastrowid if cursor.rowcount else None
+
+@timed(DB_QUERY_SECONDS, query="claim_job")
+def claim_job(owner):
+    """
+    Mark the oldest runnable job as running and return it.
+
+    Jobs of a user who already has one running are skipped, so each user's
+    jobs run one at a time and in order.
+
+    Args:
+        owner (int): The worker process claiming the job
+
+    Returns:
+        tuple or None: (id, kind, user_id, payload, attempts) if a job was claimed
+    """
+    conn = get_connection()
+
+    with conn:
+        return conn.execute('''
+            UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ?
+            WHERE id = (
+                SELECT id FROM jobs
+                WHERE owner = ? AND status = 'queued' AND user_id NOT IN (
+                    SELECT user_id FROM jobs WHERE owner = ? AND status = 'running'
+                )
+                ORDER BY id LIMIT 1
+            )
+            RETURNING id, kind, user_id, payload, attempts
+        ''', (time.time(), owner, owner)).fetchone()
+
+@timed(DB_QUERY_SECONDS, query="finish_job")
+def finish_job(job_id):
+    """
+    Remove a job that has finished (or given up).
+
+    Args:
+        job_id (int): The job's ID
+    """
+    conn = get_connection()
+
+    with conn:
+        conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+
+@timed(DB_QUERY_SECONDS, query="release_jobs")
+def release_jobs(job_ids, count_attempt=True):
+    """
+    Put running jobs back in the queue.
+
+    Args:
+        job_ids (list): IDs of the jobs
+        count_attempt (bool): Whether the interrupted run counts towards the attempt limit
+    """
+    conn = get_connection()
+    refund = 0 if count_attempt else 1
+
+    with conn:
+        conn.executemany(
+            "UPDATE jobs SET status = 'queued', attempts = attempts - ?, updated_at = ? WHERE id = ?",
+            [(refund, time.time(), job_id) for job_id in job_ids]
+        )
+
+@timed(DB_QUERY_SECONDS, query="requeue_running_jobs")
+def requeue_running_jobs(owner):
+    """
+    Put back jobs that were running when the process last stopped.
+
+    Args:
+        owner (int): The worker process whose jobs to recover
+
+    Returns:
+        int: How many jobs were put back
+    """
+    conn = get_connection()
+
+    with conn:
+        return conn.execute(
+            "UPDATE jobs SET status = 'queued', updated_at = ? WHERE owner = ? AND status = 'running'",
+            (time.time(), owner)
+        ).rowcount
+
+@timed(DB_QUERY_SECONDS, query="reassign_jobs")
+def reassign_jobs(owner_for):
+    """
+    Give every unfinished job to the worker process that should now run it.
+
+    Args:
+        owner_for (callable): Takes a job's payload and returns its owner
+
+    Returns:
+        int: How many jobs changed owner
+    """
+    conn = get_connection()
+
+    with conn:
+        moves = []
+        for job_id, owner, payload in conn.execute('SELECT id, owner, payload FROM jobs').fetchall():
+            new_owner = owner_for(payload)
+            if new_owner != owner:
+                moves.append((new_owner, job_id))
+        conn.executemany('UPDATE jobs SET owner = ? WHERE id = ?', moves)
+    return len(moves)
+
+async def store_api_key_async(user_id, api_key):
+    """
+    Store a user's API key without blocking the event loop.
+
+    Args:
+        user_id (int): The Telegram user ID
+        api_key (str): The user's Shapes API key
+    """
+    await run_in_db_thread(store_api_key, user_id, api_key)
+
+async def get_api_key_async(user_id):
+    """
+    Retrieve a user's API key without blocking the event loop.
+
+    Cache hits are answered directly; only misses, and a check for keys
+    changed by other processes at most every API_KEY_CACHE_CHECK_INTERVAL
+    seconds, go to the DB thread.
+
+    Args:
+        user_id (int): The Telegram user ID
+
+    Returns:
+        str or None: The API key if found, None otherwise
+    """
+    if _users_check_due():
+        await run_in_db_thread(_check_users_version)
+
+    cached = api_key_cache.get(user_id)
+    if cached is not MISSING:
+        return cached
+    return await run_in_db_thread(_load_api_key, user_id)
+
+async def delete_api_key_async(user_id):
+    """
+    Delete a user's API key without blocking the event loop.
+
+    Args:
+        user_id (int): The Telegram user ID
+
+    Returns:
+        bool: True if a key was deleted, False otherwise
+    """
+    return await run_in_db_thread(delete_api_key, user_id)
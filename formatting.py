@@ -0,0 +1,257 @@
+import os
+import re
+import html
+import logging
+
+from telegram.constants import MessageLimit, ParseMode
+from telegram.error import BadRequest
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Render the Markdown in Shapes responses (bold, code blocks, links...) instead of showing it as typed
+REPLY_MARKDOWN = os.environ.get("REPLY_MARKDOWN", "false").lower() in ("1", "true", "yes")
+
+# A code fence line, capturing the marker and language tag that reopen its block
+FENCE_PATTERN = re.compile(r"^\s*(```[\w+#.-]*)")
+SENTENCE_END_PATTERN = re.compile(r"[.!?…][)\"'”’]*\s+")
+
+# Closes a code block that continues in the next message
+FENCE_CLOSE = "\n```"
+
+CODE_BLOCK_PATTERN = re.compile(r"```([\w+#.-]*)[^\S\n]*\n?(.*?)(?:\n?```|$)", re.DOTALL)
+HEADING_PATTERN = re.compile(r"^#{1,6}[^\S\n]+(.+?)[^\S\n]*#*$", re.MULTILINE)
+INLINE_PATTERN = re.compile(
+    r"`(?P<code>[^`\n]+)`"
+    r"|\[(?P<label>[^\]\n]+)\]\((?P<url>https?://[^)\s]+)\)"
+    r"|\*\*(?P<bold>[^\n]+?)\*\*"
+    r"|__(?P<bold2>[^\n]+?)__"
+    r"|~~(?P<strike>[^\n]+?)~~"
+    r"|\*(?P<italic>[^*\s](?:[^*\n]*[^*\s])?)\*"
+    r"|(?<!\w)_(?P<italic2>[^_\s](?:[^_\n]*[^_\s])?)_(?!\w)"
+)
+
+
+def _fence_marker(line):
+    """
+    Get the marker of the code fence a line opens or closes, if any.
+
+    Returns:
+        str or None: e.g. "```" or "```python"; None if the line isn't a fence
+        or is a whole code block on its own (```{"k": 1}```)
+    """
+    match = FENCE_PATTERN.match(line)
+    if match is None or "```" in line[match.end():]:
+        return None
+    return match.group(1)
+
+
+def _line_cuts(text, limit, in_code):
+    """
+    Find the places a message can be cut at line boundaries.
+
+    Returns:
+        tuple: (block cuts between paragraphs or code blocks, all line cuts)
+    """
+    blocks = []
+    lines = []
+    offset = 0
+    for line in text.splitlines(keepends=True):
+        if offset > limit:
+            break
+        if offset > 0:
+            lines.append(offset)
+            if not in_code and (not line.strip() or FENCE_PATTERN.match(line)):
+                # Before a blank line, or before a code block starts
+                blocks.append(offset)
+        offset += len(line)
+        if _fence_marker(line):
+            in_code = not in_code
+            if not in_code and offset <= limit:
+                # Right after a code block ends
+                blocks.append(offset)
+    return blocks, lines
+
+
+def _find_cut(text, limit, in_code):
+    """
+    Pick where to end a message that is too long, preferring to cut between
+    paragraphs and code blocks, then lines, sentences and words.
+    """
+    blocks, lines = _line_cuts(text, limit, in_code)
+    window = text[:limit]
+    sentences = [m.end() for m in SENTENCE_END_PATTERN.finditer(window)] if not in_code else []
+    words = [m.end() for m in re.finditer(r"\s+", window)]
+
+    # Don't leave a message mostly empty just to cut somewhere nicer
+    shortest = limit // 2
+    for cuts in (blocks, lines, sentences, words):
+        cuts = [cut for cut in cuts if shortest <= cut <= limit]
+        if cuts:
+            return cuts[-1]
+    return limit
+
+
+def _open_fence(text, fence):
+    """
+    Get the marker of the code block still open at the end of the text, if any
+    """
+    for line in text.splitlines():
+        marker = _fence_marker(line)
+        if marker:
+            fence = None if fence else marker
+    return fence
+
+
+def split_text(text, limit=MessageLimit.MAX_TEXT_LENGTH):
+    """
+    Split a response into pieces that each fit in one message.
+
+    Pieces end between paragraphs or code blocks where possible, then at
+    line, sentence or word boundaries. A code block that has to be split is
+    closed at the end of one piece and reopened at the start of the next.
+
+    Args:
+        text (str): The full response
+        limit (int): Maximum characters per piece
+
+    Yields:
+        str: The pieces, in order
+    """
+    fence = None
+    rest = text
+    while rest:
+        prefix = fence + "\n" if fence else ""
+        budget = limit - len(prefix) - len(FENCE_CLOSE)
+        carry = budget >= max(1, limit // 2)
+        if not carry:
+            # Too little room to close and reopen the code block (a tiny limit or a
+            # huge language tag), so cut it like plain text
+            prefix, budget = "", limit
+
+        if len(prefix) + len(rest) <= limit:
+            yield prefix + rest
+            return
+
+        cut = max(1, _find_cut(rest, budget, fence is not None))
+        piece = rest[:cut].rstrip()
+        # A line cut in two only counts as a fence if the whole line is one
+        line_end = rest.find("\n", cut)
+        fence = _open_fence(rest[:line_end if line_end != -1 else len(rest)], fence)
+        # Indentation matters inside code, so only drop the line breaks there
+        rest = rest[cut:].lstrip("\n" if fence else None)
+
+        if not piece.strip():
+            continue
+        yield prefix + piece + (FENCE_CLOSE if fence and carry else "")
+
+
+def _render_inline(text):
+    """
+    Convert inline Markdown in text outside code blocks to Telegram HTML
+    """
+    parts = []
+    position = 0
+    for match in INLINE_PATTERN.finditer(text):
+        parts.append(html.escape(text[position:match.start()], quote=False))
+        position = match.end()
+        kind = match.lastgroup
+        if kind == "code":
+            parts.append(f"<code>{html.escape(match['code'], quote=False)}</code>")
+        elif kind == "url":
+            parts.append(f'<a href="{html.escape(match["url"])}">{_render_inline(match["label"])}</a>')
+        else:
+            tag = {"bold": "b", "bold2": "b", "strike": "s", "italic": "i", "italic2": "i"}[kind]
+            parts.append(f"<{tag}>{_render_inline(match[kind])}</{tag}>")
+    parts.append(html.escape(text[position:], quote=False))
+    return "".join(parts)
+
+
+def render_markdown(text):
+    """
+    Convert the Markdown a Shapes response is written in to Telegram HTML.
+
+    Only well-formed markup is converted; anything else is escaped and
+    shown as typed, so the result is always safe to send.
+
+    Args:
+        text (str): Markdown text
+
+    Returns:
+        str: Text for parse_mode=HTML
+    """
+    parts = []
+    position = 0
+    for match in CODE_BLOCK_PATTERN.finditer(text):
+        parts.append(_render_inline(HEADING_PATTERN.sub(r"**\1**", text[position:match.start()])))
+        position = match.end()
+        language, code = match.groups()
+        code = html.escape(code, quote=False)
+        if language:
+            parts.append(f'<pre><code class="language-{html.escape(language)}">{code}</code></pre>')
+        else:
+            parts.append(f"<pre>{code}</pre>")
+    parts.append(_render_inline(HEADING_PATTERN.sub(r"**\1**", text[position:])))
+    return "".join(parts)
+
+
+def _is_parse_error(error):
+    return "parse entities" in str(error).lower()
+
+
+async def reply_formatted(message, text):
+    """
+    Reply with text, rendering its Markdown if REPLY_MARKDOWN is set.
+
+    Falls back to plain text if Telegram can't parse the result.
+
+    Args:
+        message (telegram.Message): The message to reply to
+        text (str): Markdown text that fits in one message
+
+    Returns:
+        telegram.Message: The sent message
+    """
+    if REPLY_MARKDOWN:
+        try:
+            return await message.reply_text(render_markdown(text), parse_mode=ParseMode.HTML)
+        except BadRequest as e:
+            if not _is_parse_error(e):
+                raise
+            logger.warning(f"Sending reply as plain text: {str(e)}")
+    return await message.reply_text(text)
+
+
+async def edit_formatted(message, text):
+    """
+    Replace a message's text, rendering its Markdown if REPLY_MARKDOWN is set.
+
+    Falls back to plain text if Telegram can't parse the result.
+
+    Args:
+        message (telegram.Message): The message to edit
+        text (str): Markdown text that fits in one message
+    """
+    if REPLY_MARKDOWN:
+        try:
+            await message.edit_text(render_markdown(text), parse_mode=ParseMode.HTML)
+            return
+        except BadRequest as e:
+            if not _is_parse_error(e):
+                raise
+            logger.warning(f"Showing reply as plain text: {str(e)}")
+    await message.edit_text(text)
+
+
+async def reply_chunked(message, text):
+    """
+    Reply with a response of any length, split into as many messages as it needs.
+
+    Each piece is sent as soon as it is split off, in order.
+
+    Args:
+        message (telegram.Message): The message to reply to
+        text (str): The full response
+    """
+    for piece in split_text(text):
+        await reply_formatted(message, piece)
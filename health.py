@@ -0,0 +1,108 @@
+"""
+Startup timing and readiness reporting for process supervisors.
+
+Readiness is served as /readyz (and liveness as /healthz) on the metrics
+port, and, when READY_FILE is set, as a file that exists only while the
+bot is receiving updates, for health checks that can't make HTTP requests.
+"""
+
+import os
+import time
+import logging
+
+import metrics
+from metrics import Gauge
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# File created once the bot is receiving updates and removed when it stops (empty disables it)
+READY_FILE = os.environ.get("READY_FILE", "")
+
+STARTUP_SECONDS = Gauge(
+    "shape_bot_startup_seconds", "Time spent in each phase of the last startup", ["phase"]
+)
+READY = Gauge(
+    "shape_bot_ready", "1 while the bot is receiving updates"
+)
+
+
+class StartupTimer:
+    """
+    Measures the phases of startup, each from the end of the previous one.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.last = self.started
+        self.phases = []
+
+    def mark(self, phase):
+        """
+        End a startup phase.
+
+        Args:
+            phase (str): What the time since the previous phase was spent on
+        """
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        STARTUP_SECONDS.set(now - self.last, phase=phase)
+        self.last = now
+
+    def report(self):
+        """
+        Log how long startup took, phase by phase.
+        """
+        phases = ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in self.phases)
+        logger.info(f"Started in {self.last - self.started:.2f}s ({phases})")
+
+
+# Timer for this process, started when this module is first imported
+startup_timer = StartupTimer()
+
+_ready = False
+
+
+def is_ready():
+    return _ready
+
+
+def mark_ready():
+    """
+    Report that the bot is receiving updates.
+    """
+    global _ready
+    _ready = True
+    READY.set(1)
+    if READY_FILE:
+        with open(READY_FILE, "w") as file:
+            file.write(f"{os.getpid()}\n")
+
+
+def mark_not_ready():
+    """
+    Report that the bot is not (or no longer) receiving updates.
+    """
+    global _ready
+    _ready = False
+    READY.set(0)
+    if READY_FILE:
+        try:
+            os.unlink(READY_FILE)
+        except FileNotFoundError:
+            pass
+
+
+def _healthz():
+    # Answering at all means the event loop is alive
+    return "200 OK", "ok\n"
+
+
+def _readyz():
+    if _ready:
+        return "200 OK", "ready\n"
+    return "503 Service Unavailable", "not ready\n"
+
+
+metrics.add_route("/healthz", _healthz)
+metrics.add_route("/readyz", _readyz)
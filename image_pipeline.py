@@ -0,0 +1,449 @@
+import os
+import re
+import time
+import socket
+import asyncio
+import hashlib
+import logging
+import ipaddress
+import tempfile
+import threading
+import contextlib
+from collections import OrderedDict
+
+import httpx
+from telegram.error import BadRequest, TelegramError
+
+from api_handler import SHAPES_MODEL
+from db import run_in_db_thread, get_cached_image, find_image_file_id, save_cached_image
+from metrics import CACHE_REQUESTS_TOTAL
+from profiling import span
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Where downloaded images are kept, and how much disk they may use
+IMAGE_CACHE_DIR = os.environ.get("IMAGE_CACHE_DIR", "image_cache")
+IMAGE_CACHE_MAX_MB = float(os.environ.get("IMAGE_CACHE_MAX_MB", "200"))
+
+# How long a prompt's image is reused instead of generating a new one (0 always generates)
+IMAGE_PROMPT_CACHE_TTL = float(os.environ.get("IMAGE_PROMPT_CACHE_TTL", "86400"))
+
+# Telegram rejects photos over 10 MB
+IMAGE_MAX_DOWNLOAD_MB = float(os.environ.get("IMAGE_MAX_DOWNLOAD_MB", "10"))
+IMAGE_DOWNLOAD_TIMEOUT = float(os.environ.get("IMAGE_DOWNLOAD_TIMEOUT", "60"))
+
+# Partial downloads untouched for this long are left over from a crash. Live downloads
+# write at least once per timeout (it applies to each network operation), and other
+# worker processes may be downloading into the same directory.
+STALE_DOWNLOAD_AGE = 2 * IMAGE_DOWNLOAD_TIMEOUT
+
+# Hosts (and their subdomains) images may be downloaded from; other images are sent as links
+IMAGE_HOSTS = [host.strip().lower() for host in os.environ.get("IMAGE_HOSTS", "shapes.inc").split(",")
+               if host.strip()]
+IMAGE_URL_SCHEMES = [scheme.strip().lower() for scheme in os.environ.get("IMAGE_URL_SCHEMES", "https").split(",")]
+
+# Allow downloads from private, loopback and link-local addresses (only for local testing)
+IMAGE_ALLOW_PRIVATE_HOSTS = os.environ.get("IMAGE_ALLOW_PRIVATE_HOSTS", "false").lower() in ("1", "true", "yes")
+
+# Redirects followed per download, each checked like the original URL
+IMAGE_MAX_REDIRECTS = 5
+
+URL_PATTERN = re.compile(r'https?://[^\s<>"\')\]]+')
+
+# Telegram's limit for photo captions
+CAPTION_LIMIT = 1024
+
+EXTENSIONS = {"image/png": ".png", "image/jpeg": ".jpg", "image/webp": ".webp", "image/gif": ".gif"}
+
+
+def prompt_key(prompt):
+    """
+    Get the cache key of an /imagine prompt.
+
+    Args:
+        prompt (str): The user's image description
+
+    Returns:
+        str: Hash of the model and the prompt with case and spacing normalized
+    """
+    normalized = " ".join(prompt.lower().split())
+    return hashlib.sha256(f"{SHAPES_MODEL}\n{normalized}".encode()).hexdigest()
+
+
+def split_response(text):
+    """
+    Separate the image URL in an /imagine response from the rest of the text.
+
+    Args:
+        text (str): The Shapes response
+
+    Returns:
+        tuple: (url or None, caption)
+    """
+    match = URL_PATTERN.search(text or "")
+    if not match:
+        return None, text
+    url = match.group(0).rstrip(".,;:!?")
+    caption = (text[:match.start()] + text[match.end():]).strip()
+    return url, caption[:CAPTION_LIMIT]
+
+
+class ImageURLRejected(ValueError):
+    """
+    Raised instead of downloading an image from somewhere it may not come from.
+    """
+
+
+def _host_allowed(host):
+    host = host.lower().rstrip(".")
+    return any(host == allowed or host.endswith("." + allowed) for allowed in IMAGE_HOSTS)
+
+
+async def check_image_url(url):
+    """
+    Make sure an image URL points at an allowed public host.
+
+    The model writes the URL, and users can talk it into writing anything,
+    so without this the bot could be made to fetch internal addresses.
+
+    Args:
+        url (httpx.URL): The URL to download
+
+    Raises:
+        ImageURLRejected: If the scheme or host isn't allowed, or the host
+            resolves to a private, loopback or otherwise non-public address
+    """
+    if url.scheme not in IMAGE_URL_SCHEMES:
+        raise ImageURLRejected(f"Scheme {url.scheme} is not allowed")
+    if not url.host or not _host_allowed(url.host):
+        raise ImageURLRejected(f"Host {url.host} is not allowed")
+    if IMAGE_ALLOW_PRIVATE_HOSTS:
+        return
+
+    port = url.port or (443 if url.scheme == "https" else 80)
+    try:
+        addresses = await asyncio.get_running_loop().getaddrinfo(url.host, port, type=socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        raise ImageURLRejected(f"Could not resolve {url.host}: {str(e)}")
+    for *_, sockaddr in addresses:
+        # Drop any IPv6 scope ID, and look through IPv4-mapped IPv6 addresses
+        address = ipaddress.ip_address(sockaddr[0].split("%")[0])
+        address = getattr(address, "ipv4_mapped", None) or address
+        if not address.is_global:
+            raise ImageURLRejected(f"Host {url.host} resolves to non-public address {address}")
+
+
+class ImageStore:
+    """
+    Content-addressed image files on disk.
+
+    Files are named after the SHA-256 of their bytes, so the same image is
+    only stored once. When the directory grows past max_bytes, the least
+    recently used files are deleted. Methods block on disk I/O; call them
+    from a worker thread.
+    """
+
+    def __init__(self, directory=IMAGE_CACHE_DIR, max_bytes=int(IMAGE_CACHE_MAX_MB * 1024 * 1024)):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        # content_hash -> (path, size), least recently used first
+        self._files = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        """
+        Index the files already on disk, oldest first
+        """
+        if self._files is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+
+        entries = []
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            if entry.name.endswith(".part"):
+                if now - stat.st_mtime > STALE_DOWNLOAD_AGE:
+                    # Left over from an interrupted download
+                    with contextlib.suppress(FileNotFoundError):
+                        os.unlink(entry.path)
+                continue
+            entries.append((stat.st_mtime, os.path.splitext(entry.name)[0], entry.path, stat.st_size))
+
+        self._files = OrderedDict()
+        for _, content_hash, path, size in sorted(entries):
+            self._files[content_hash] = (path, size)
+            self.total_bytes += size
+
+    def path_for(self, content_hash):
+        """
+        Get the stored file for an image, marking it as recently used.
+
+        Args:
+            content_hash (str): SHA-256 of the image bytes
+
+        Returns:
+            str or None: The file path if the image is stored
+        """
+        with self._lock:
+            self._load()
+            entry = self._files.get(content_hash)
+            if entry is None:
+                return None
+            if not os.path.exists(entry[0]):
+                del self._files[content_hash]
+                self.total_bytes -= entry[1]
+                return None
+            self._files.move_to_end(content_hash)
+            os.utime(entry[0])
+            return entry[0]
+
+    def temp_file(self):
+        """
+        Open a file to download into, inside the store's directory.
+
+        Returns:
+            tuple: (file object, path)
+        """
+        with self._lock:
+            self._load()
+        fd, path = tempfile.mkstemp(dir=self.directory, suffix=".part")
+        return os.fdopen(fd, "wb"), path
+
+    def add(self, temp_path, content_hash, extension):
+        """
+        Move a finished download into the store.
+
+        Args:
+            temp_path (str): The downloaded file
+            content_hash (str): SHA-256 of its bytes
+            extension (str): File extension, e.g. ".png"
+
+        Returns:
+            str: The stored file's path
+        """
+        with self._lock:
+            self._load()
+            existing = self._files.get(content_hash)
+            if existing is not None and os.path.exists(existing[0]):
+                os.unlink(temp_path)
+                self._files.move_to_end(content_hash)
+                return existing[0]
+
+            path = os.path.join(self.directory, content_hash + extension)
+            os.replace(temp_path, path)
+            size = os.path.getsize(path)
+            self._files[content_hash] = (path, size)
+            self.total_bytes += size
+            self._evict(keep=content_hash)
+            return path
+
+    def _evict(self, keep):
+        while self.total_bytes > self.max_bytes and len(self._files) > 1:
+            content_hash, (path, size) = next(iter(self._files.items()))
+            if content_hash == keep:
+                break
+            del self._files[content_hash]
+            self.total_bytes -= size
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+# Shared on-disk image store
+image_store = ImageStore()
+
+# HTTP client for image downloads, created on first use
+_http_client = None
+
+
+def _get_http_client():
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        # Redirects are followed by _open_image, which checks every hop
+        _http_client = httpx.AsyncClient(follow_redirects=False, timeout=IMAGE_DOWNLOAD_TIMEOUT)
+    return _http_client
+
+
+async def _open_image(url):
+    """
+    Start downloading an image, following redirects only to allowed URLs
+
+    Returns:
+        httpx.Response: The streamed response; the caller must close it
+    """
+    client = _get_http_client()
+    request = client.build_request("GET", url)
+    for _ in range(IMAGE_MAX_REDIRECTS + 1):
+        await check_image_url(request.url)
+        response = await client.send(request, stream=True)
+        if response.next_request is None:
+            return response
+        await response.aclose()
+        request = response.next_request
+    raise ImageURLRejected(f"More than {IMAGE_MAX_REDIRECTS} redirects")
+
+
+async def download_image(url):
+    """
+    Stream an image into the store, hashing it on the way.
+
+    Args:
+        url (str): Where the generated image is
+
+    Returns:
+        tuple or None: (content_hash, path), or None if the URL is not an image
+
+    Raises:
+        ImageURLRejected: If the URL, or a redirect, leads somewhere images may not come from
+    """
+    max_bytes = IMAGE_MAX_DOWNLOAD_MB * 1024 * 1024
+
+    response = await _open_image(url)
+    try:
+        response.raise_for_status()
+        content_type = response.headers.get("content-type", "").split(";")[0].strip().lower()
+        if not content_type.startswith("image/"):
+            logger.info(f"Not an image ({content_type or 'no content type'}): {url}")
+            return None
+
+        digest = hashlib.sha256()
+        size = 0
+        file, temp_path = await asyncio.to_thread(image_store.temp_file)
+        try:
+            with file:
+                async for chunk in response.aiter_bytes(64 * 1024):
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise ValueError(f"Image is larger than {IMAGE_MAX_DOWNLOAD_MB} MB")
+                    digest.update(chunk)
+                    await asyncio.to_thread(file.write, chunk)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+    finally:
+        await response.aclose()
+
+    content_hash = digest.hexdigest()
+    extension = EXTENSIONS.get(content_type, ".img")
+    path = await asyncio.to_thread(image_store.add, temp_path, content_hash, extension)
+    return content_hash, path
+
+
+async def _upload(message, key, content_hash, path, caption):
+    """
+    Upload a stored image as a photo and remember Telegram's file_id for it
+    """
+    with open(path, "rb") as file:
+        data = await asyncio.to_thread(file.read)
+    sent = await message.reply_photo(photo=data, caption=caption or None, filename=os.path.basename(path))
+    await run_in_db_thread(save_cached_image, key, content_hash, sent.photo[-1].file_id)
+
+
+async def send_cached_image(message, prompt):
+    """
+    Answer a repeated prompt with the image already made for it.
+
+    Args:
+        message (telegram.Message): The message with the prompt
+        prompt (str): The user's image description
+
+    Returns:
+        bool: True if a cached image was sent
+    """
+    if IMAGE_PROMPT_CACHE_TTL <= 0:
+        return False
+
+    key = prompt_key(prompt)
+    entry = await run_in_db_thread(get_cached_image, key, IMAGE_PROMPT_CACHE_TTL)
+    if entry is None:
+        CACHE_REQUESTS_TOTAL.inc(cache="image", result="miss")
+        return False
+
+    content_hash, file_id = entry
+    if file_id:
+        try:
+            await message.reply_photo(photo=file_id)
+            CACHE_REQUESTS_TOTAL.inc(cache="image", result="hit")
+            return True
+        except BadRequest as e:
+            # The file_id is no longer valid (e.g. the bot token changed); upload it again
+            logger.warning(f"Cached file_id was rejected: {str(e)}")
+
+    path = await asyncio.to_thread(image_store.path_for, content_hash)
+    if path is None:
+        CACHE_REQUESTS_TOTAL.inc(cache="image", result="miss")
+        return False
+
+    try:
+        await _upload(message, key, content_hash, path, None)
+    except TelegramError as e:
+        logger.error(f"Error uploading cached image: {str(e)}")
+        return False
+    CACHE_REQUESTS_TOTAL.inc(cache="image", result="hit")
+    return True
+
+
+async def reply_with_image(message, prompt, response_text):
+    """
+    Deliver the image from an /imagine response as a photo.
+
+    Args:
+        message (telegram.Message): The message with the prompt
+        prompt (str): The user's image description
+        response_text (str): The Shapes response, containing the image URL
+
+    Returns:
+        bool: True if the image was sent; False if the caller should send the text instead
+    """
+    url, caption = split_response(response_text)
+    if url is None:
+        return False
+
+    try:
+        # Generated images are served by Shapes, so the download counts as upstream time
+        with span("shapes"):
+            downloaded = await download_image(url)
+    except ImageURLRejected as e:
+        logger.warning(f"Not downloading image {url}: {str(e)}")
+        return False
+    except Exception as e:
+        logger.error(f"Error downloading image {url}: {str(e)}")
+        return False
+    if downloaded is None:
+        return False
+
+    content_hash, path = downloaded
+    key = prompt_key(prompt)
+
+    # The same picture may already be on Telegram's servers under another prompt
+    file_id = await run_in_db_thread(find_image_file_id, content_hash)
+    if file_id:
+        try:
+            await message.reply_photo(photo=file_id, caption=caption or None)
+            await run_in_db_thread(save_cached_image, key, content_hash, file_id)
+            return True
+        except BadRequest as e:
+            logger.warning(f"Cached file_id was rejected: {str(e)}")
+
+    try:
+        await _upload(message, key, content_hash, path, caption)
+    except TelegramError as e:
+        logger.error(f"Error uploading image: {str(e)}")
+        return False
+    return True
+
+
+async def close():
+    """
+    Close the download client.
+    """
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
@@ -0,0 +1,237 @@
+import os
+import asyncio
+import logging
+from collections import deque
+
+import profiling
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# How many Shapes requests one user may have running at once
+USER_MAX_INFLIGHT = int(os.environ.get("USER_MAX_INFLIGHT", "1"))
+
+# What to do with requests over the limit: "queue", "drop" or "merge"
+USER_INFLIGHT_POLICY = os.environ.get("USER_INFLIGHT_POLICY", "queue").lower()
+
+# How many requests one user may have waiting (extra ones are dropped)
+USER_MAX_QUEUED = int(os.environ.get("USER_MAX_QUEUED", "5"))
+
+# How many Shapes requests may run at once across all users. Handlers return before
+# their requests run, so MAX_CONCURRENT_UPDATES doesn't bound these.
+MAX_CONCURRENT_REQUESTS = int(os.environ.get("MAX_CONCURRENT_REQUESTS", "64"))
+
+# What happened to a submitted request
+STARTED = "started"
+QUEUED = "queued"
+MERGED = "merged"
+DROPPED = "dropped"
+
+POLICIES = ("queue", "drop", "merge")
+
+# Shared by every limiter, so chat messages and inline queries count together
+_request_slots = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+
+def set_max_concurrent_requests(limit):
+    """
+    Change how many requests may run at once across all limiters.
+
+    Call before any request is submitted, e.g. to give each sharded
+    worker its share of MAX_CONCURRENT_REQUESTS.
+
+    Args:
+        limit (int): Requests allowed to run at once
+    """
+    global _request_slots
+    _request_slots = asyncio.Semaphore(limit)
+
+
+class _PendingRequest:
+    __slots__ = ("text", "runner", "mergeable", "checkpoint", "profile")
+
+    def __init__(self, text, runner, mergeable, checkpoint):
+        self.text = text
+        self.runner = runner
+        self.mergeable = mergeable
+        self.checkpoint = checkpoint
+        # Keeps the submitting update's profile open until the request has run
+        self.profile = profiling.hold()
+
+
+class _UserState:
+    __slots__ = ("active", "pending", "running")
+
+    def __init__(self):
+        self.active = 0
+        self.pending = deque()
+        self.running = set()
+
+
+class UserRequestLimiter:
+    """
+    Caps how many Shapes requests each user can have in flight.
+
+    Requests run in the background so the update handler returns right
+    away, at most MAX_CONCURRENT_REQUESTS at a time across all users. When
+    a user is at their limit, new requests are handled by the policy:
+
+    - queue: wait for the user's earlier requests, in order
+    - drop: reject the request so the caller can send a "still thinking" notice
+    - merge: fold rapid-fire messages into one request, answered on the latest message
+
+    On shutdown, drain() lets requests finish for a while and hands the
+    rest to their checkpoint functions so they can be answered after a
+    restart.
+    """
+
+    def __init__(self, max_inflight=USER_MAX_INFLIGHT, policy=USER_INFLIGHT_POLICY,
+                 max_queued=USER_MAX_QUEUED):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown in-flight policy: {policy}")
+        self.max_inflight = max_inflight
+        self.policy = policy
+        self.max_queued = max_queued
+        self._users = {}
+        self._tasks = set()
+
+    @property
+    def active_users(self):
+        """
+        Number of users with requests running or waiting
+        """
+        return len(self._users)
+
+    @property
+    def queued(self):
+        """
+        Number of requests waiting across all users
+        """
+        return sum(len(state.pending) for state in self._users.values())
+
+    def submit(self, user_id, text, runner, mergeable=True, checkpoint=None, spawn=asyncio.create_task):
+        """
+        Run a request for a user now, later, or not at all.
+
+        Args:
+            user_id (int): The Telegram user ID
+            text (str): The request text
+            runner (callable): Coroutine function taking the (possibly merged) text
+            mergeable (bool): Whether this request may be merged with others
+            checkpoint (callable, optional): Coroutine function taking the text, called
+                to save the request if a drain cuts it short
+            spawn (callable): Starts a coroutine in the background
+
+        Returns:
+            str: STARTED, QUEUED, MERGED or DROPPED
+        """
+        state = self._users.get(user_id)
+        if state is None:
+            state = self._users[user_id] = _UserState()
+
+        if state.active < self.max_inflight:
+            state.active += 1
+            task = spawn(self._work(user_id, state, _PendingRequest(text, runner, mergeable, checkpoint)))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            return STARTED
+
+        if self.policy == "drop":
+            return DROPPED
+
+        if self.policy == "merge" and mergeable and state.pending and state.pending[-1].mergeable:
+            # Answer the combined text on the newest message
+            last = state.pending[-1]
+            last.text = f"{last.text}\n{text}"
+            last.runner = runner
+            last.checkpoint = checkpoint
+            profiling.release(last.profile)
+            last.profile = profiling.hold()
+            return MERGED
+
+        if len(state.pending) >= self.max_queued:
+            return DROPPED
+
+        state.pending.append(_PendingRequest(text, runner, mergeable, checkpoint))
+        return QUEUED
+
+    async def _work(self, user_id, state, request):
+        """
+        Run a request, then keep taking the user's waiting requests
+        """
+        try:
+            while True:
+                state.running.add(request)
+                try:
+                    with profiling.resumed(request.profile):
+                        with profiling.span("queued"):
+                            await _request_slots.acquire()
+                        try:
+                            await request.runner(request.text)
+                        finally:
+                            _request_slots.release()
+                except Exception as e:
+                    logger.error(f"Error handling request for user {user_id}: {str(e)}")
+                finally:
+                    state.running.discard(request)
+
+                if not state.pending:
+                    break
+                request = state.pending.popleft()
+        finally:
+            state.active -= 1
+            if state.active == 0 and not state.pending:
+                self._users.pop(user_id, None)
+
+    async def drain(self, timeout):
+        """
+        Wait for running and queued requests to finish, then cut off the rest.
+
+        Requests still unfinished after the timeout are cancelled and passed
+        to their checkpoint functions.
+
+        Args:
+            timeout (float): Seconds to wait
+
+        Returns:
+            int: The number of requests that were checkpointed
+        """
+        if self._tasks:
+            logger.info(f"Waiting up to {timeout}s for requests from {len(self._users)} users to finish")
+            await asyncio.wait(set(self._tasks), timeout=timeout)
+        if not self._tasks:
+            return 0
+
+        running = []
+        queued = []
+        for state in self._users.values():
+            running.extend(state.running)
+            queued.extend(state.pending)
+            state.pending.clear()
+
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        # Queued requests never ran, so their profiles are still held
+        for request in queued:
+            profiling.release(request.profile)
+
+        unfinished = running + queued
+        saved = 0
+        for request in unfinished:
+            if request.checkpoint is None:
+                continue
+            try:
+                await request.checkpoint(request.text)
+                saved += 1
+            except Exception as e:
+                logger.error(f"Error saving an unfinished request: {str(e)}")
+
+        logger.info(f"Saved {saved} of {len(unfinished)} unfinished requests for after the restart")
+        return saved
+
+
+# Shared limiter for chat messages
+request_limiter = UserRequestLimiter()
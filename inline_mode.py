@@ -0,0 +1,232 @@
+"""
+Inline mode: answering "@bot question" typed in any chat.
+
+Telegram sends a new inline query on nearly every keystroke, so a query
+is only sent to Shapes once the user has stopped typing for
+INLINE_DEBOUNCE seconds; queries superseded in the meantime are never
+answered. The wait and the Shapes request run in the background, under a
+per-user limit of their own so they never queue behind chat messages, and
+a query still waiting once Telegram has likely given up on it is dropped.
+Responses are cached per (user, normalized query) for INLINE_CACHE_TTL
+seconds, and Telegram is told to cache them for the same user too, so
+retyping or going back to a query is free.
+"""
+
+import os
+import time
+import asyncio
+import hashlib
+import logging
+
+from telegram import InlineQueryResultArticle, InputTextMessageContent, InlineQueryResultsButton
+from telegram.error import BadRequest
+
+from api_handler import process_message, ErrorReply, SHAPES_INLINE_TIMEOUT
+from cache import TTLCache, MISSING
+from formatting import split_text
+from inflight import UserRequestLimiter, DROPPED
+from metrics import CACHE_REQUESTS_TOTAL
+import profiling
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Seconds a query must stay unchanged before it is sent to Shapes
+INLINE_DEBOUNCE = float(os.environ.get("INLINE_DEBOUNCE", "0.8"))
+
+# Shorter queries are not sent to Shapes
+INLINE_MIN_QUERY_LENGTH = int(os.environ.get("INLINE_MIN_QUERY_LENGTH", "3"))
+
+# How long, and for how many queries, responses are reused
+INLINE_CACHE_TTL = float(os.environ.get("INLINE_CACHE_TTL", "300"))
+INLINE_CACHE_SIZE = int(os.environ.get("INLINE_CACHE_SIZE", "2000"))
+
+# Inline queries one user may have sent to Shapes at once, and waiting for that
+# (further ones are answered with no results)
+INLINE_MAX_INFLIGHT = int(os.environ.get("INLINE_MAX_INFLIGHT", "1"))
+INLINE_MAX_QUEUED = int(os.environ.get("INLINE_MAX_QUEUED", "1"))
+
+# Telegram stops accepting an answer about 10 seconds after the query, so
+# queries that waited this long are not sent to Shapes at all
+INLINE_MAX_AGE = SHAPES_INLINE_TIMEOUT
+
+# Telegram shows this in place of results to users without a key
+REGISTER_BUTTON_TEXT = "🔑 Register your Shapes key to use me"
+
+# Deep-link payload of that button: it opens the bot's DM with "/start register"
+REGISTER_START_PARAMETER = "register"
+
+# Shown under the result title
+DESCRIPTION_LENGTH = 200
+
+
+def normalize_query(query):
+    """
+    Get the form of a query used as its cache key.
+
+    Args:
+        query (str): The inline query as typed
+
+    Returns:
+        str: The query with case and spacing normalized
+    """
+    return " ".join(query.lower().split())
+
+
+def _results(query, response):
+    """
+    Build the single article that sends the Shape's response to the chat
+    """
+    # Inline results are sent as one message
+    text = next(split_text(response), response)
+    title = "Something went wrong" if isinstance(response, ErrorReply) else f"Reply to: {query}"
+    return [InlineQueryResultArticle(
+        id=hashlib.sha256(text.encode()).hexdigest()[:64],
+        title=title[:64],
+        description=text[:DESCRIPTION_LENGTH],
+        input_message_content=InputTextMessageContent(text),
+    )]
+
+
+class InlineResponder:
+    """
+    Answers inline queries with the user's Shape, debounced and cached.
+
+    Identical queries from the same user that arrive while a response is
+    being generated share that one Shapes request.
+    """
+
+    def __init__(self, debounce=INLINE_DEBOUNCE, min_query_length=INLINE_MIN_QUERY_LENGTH,
+                 cache_ttl=INLINE_CACHE_TTL, cache_size=INLINE_CACHE_SIZE, limiter=None):
+        self.debounce = debounce
+        self.min_query_length = min_query_length
+        self.cache = TTLCache(cache_size, cache_ttl)
+        # Separate from the chat message limiter, whose requests can take minutes
+        self.limiter = limiter or UserRequestLimiter(INLINE_MAX_INFLIGHT, "queue", INLINE_MAX_QUEUED)
+        # user_id -> ID of their newest inline query that is still unanswered
+        self._latest = {}
+        # (user_id, normalized query) -> Shapes request in progress
+        self._pending = {}
+        # Queries waiting for the user to stop typing
+        self._tasks = set()
+
+    async def answer(self, inline_query, api_key):
+        """
+        Answer an inline query, unless the user types on before it is sent to Shapes.
+
+        Cached and too-short queries are answered right away; others are
+        answered in the background, so this returns without waiting for Shapes.
+
+        Args:
+            inline_query (telegram.InlineQuery): The query
+            api_key (str): The user's API key
+        """
+        received = time.monotonic()
+        user_id = inline_query.from_user.id
+        query = inline_query.query.strip()
+        key = (user_id, normalize_query(query))
+
+        # Every new query supersedes the user's older ones, answered here or not
+        self._latest[user_id] = inline_query.id
+
+        if len(key[1]) < self.min_query_length:
+            self._forget(inline_query)
+            # Nothing to send yet; don't cache so results appear once there is
+            await self._send(inline_query, [], cache_time=0)
+            return
+
+        response = self.cache.get(key)
+        if response is not MISSING:
+            self._forget(inline_query)
+            await self._reply(inline_query, query, response)
+            return
+
+        task = asyncio.create_task(self._answer_later(inline_query, key, query, api_key, received,
+                                                      profiling.hold()))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _answer_later(self, inline_query, key, query, api_key, received, held):
+        """
+        Wait for the user to stop typing, then answer within their inline query limit
+        """
+        user_id = inline_query.from_user.id
+        with profiling.resumed(held):
+            await asyncio.sleep(self.debounce)
+            if not self._is_latest(inline_query):
+                return
+
+            async def respond(query):
+                try:
+                    # The user may have typed on while their earlier queries ran
+                    if not self._is_latest(inline_query):
+                        return
+                    if time.monotonic() - received > INLINE_MAX_AGE:
+                        logger.debug(f"Inline query {inline_query.id} is too old to answer")
+                        return
+                    await self._reply(inline_query, query, await self._complete(key, query, api_key))
+                finally:
+                    self._forget(inline_query)
+
+            status = self.limiter.submit(user_id, query, respond, mergeable=False)
+            if status == DROPPED:
+                self._forget(inline_query)
+                await self._send(inline_query, [], cache_time=0)
+
+    def _is_latest(self, inline_query):
+        return self._latest.get(inline_query.from_user.id) == inline_query.id
+
+    def _forget(self, inline_query):
+        """
+        Stop tracking a query once it is answered, unless a newer one replaced it
+        """
+        if self._is_latest(inline_query):
+            del self._latest[inline_query.from_user.id]
+
+    async def _reply(self, inline_query, query, response):
+        if isinstance(response, ErrorReply):
+            await self._send(inline_query, _results(query, response), cache_time=0)
+        else:
+            await self._send(inline_query, _results(query, response))
+
+    async def answer_unregistered(self, inline_query):
+        """
+        Point a user without a key to registration.
+
+        Args:
+            inline_query (telegram.InlineQuery): The query
+        """
+        button = InlineQueryResultsButton(text=REGISTER_BUTTON_TEXT, start_parameter=REGISTER_START_PARAMETER)
+        await self._send(inline_query, [], cache_time=0, button=button)
+
+    async def _complete(self, key, query, api_key):
+        """
+        Get the Shape's response to a query, sharing requests already in progress
+        """
+        request = self._pending.get(key)
+        if request is None:
+            request = self._pending[key] = asyncio.ensure_future(process_message(query, api_key, command="inline"))
+            request.add_done_callback(lambda _: self._pending.pop(key, None))
+
+        # The request may be shared, so a waiter giving up must not cancel it
+        response = await asyncio.shield(request)
+        if not isinstance(response, ErrorReply):
+            self.cache.set(key, response)
+        return response
+
+    async def _send(self, inline_query, results, cache_time=None, **kwargs):
+        if cache_time is None:
+            cache_time = int(self.cache.ttl)
+        try:
+            # The response depends on the user's Shape, so Telegram must not share it
+            await inline_query.answer(results, cache_time=cache_time, is_personal=True, **kwargs)
+        except BadRequest as e:
+            # Telegram stops accepting answers once the query is too old
+            logger.debug(f"Could not answer inline query {inline_query.id}: {str(e)}")
+
+
+# Shared inline query responder
+inline_responder = InlineResponder()
+
+CACHE_REQUESTS_TOTAL.set_callback(lambda: inline_responder.cache.hits, cache="inline", result="hit")
+CACHE_REQUESTS_TOTAL.set_callback(lambda: inline_responder.cache.misses, cache="inline", result="miss")
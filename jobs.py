@@ -0,0 +1,204 @@
+import os
+import json
+import asyncio
+import logging
+
+from telegram import Message
+
+from db import (
+    run_in_db_thread, enqueue_job, claim_job, finish_job, release_jobs, requeue_running_jobs, reassign_jobs
+)
+from inflight import USER_MAX_QUEUED
+import profiling
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# How many slow commands may run at once, separately from chat traffic
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "4"))
+
+# Runs per job (including ones cut short by a crash) before giving up on it
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+
+# How often idle workers look for jobs they weren't woken for
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", "5"))
+
+
+def assign_jobs_to_shards(shard_count):
+    """
+    Hand unfinished jobs to the worker process that now handles their chat.
+
+    Jobs belong to the worker that queued them, so after BOT_WORKERS is
+    lowered, or the bot goes back to a single process, jobs of workers that
+    no longer exist would never run. Call this at startup, before any
+    worker claims jobs.
+
+    Args:
+        shard_count (int): Number of worker processes (1 when not sharded)
+    """
+    def owner_for(payload):
+        # The same split as sharding.shard_for(): by chat
+        return json.loads(payload)["message"]["chat"]["id"] % shard_count
+
+    moved = reassign_jobs(owner_for)
+    if moved:
+        logger.info(f"Moved {moved} unfinished jobs to the worker now handling their chat")
+
+
+class DurableJobQueue:
+    """
+    Runs slow commands in the background from a queue kept in SQLite.
+
+    Handlers enqueue a job and return right away; a fixed pool of workers
+    runs the jobs and answers in the chat when they finish. Each user's
+    jobs run one at a time, in order. Jobs still running when a stop's
+    grace period ends are put back for the next start, and ones cut short
+    by a crash are picked up again on startup, up to max_attempts runs.
+    """
+
+    def __init__(self, workers=JOB_WORKERS, max_attempts=JOB_MAX_ATTEMPTS, max_per_user=1 + USER_MAX_QUEUED):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.max_per_user = max_per_user
+        # Worker process whose jobs this queue runs (see sharding.py)
+        self.owner = 0
+        self._handlers = {}
+        self._tasks = []
+        self._running = set()
+        self._wakeup = None
+        self._stopping = False
+        self._application = None
+
+    @property
+    def running(self):
+        return len(self._running)
+
+    def register(self, kind, handler, failure_text):
+        """
+        Set the coroutine function that runs one kind of job.
+
+        Args:
+            kind (str): The job kind, e.g. "imagine"
+            handler (callable): Called as handler(application, message, user_id, **args)
+            failure_text (str): Sent to the chat if the job keeps failing
+        """
+        self._handlers[kind] = (handler, failure_text)
+
+    async def enqueue(self, kind, message, user_id, **args):
+        """
+        Queue a job.
+
+        Args:
+            kind (str): The job kind
+            message (telegram.Message): The message to answer when the job is done
+            user_id (int): The Telegram user the job is for
+            **args: JSON-serializable arguments for the handler
+
+        Returns:
+            bool: True if queued, False if the user already has too many jobs waiting
+        """
+        payload = json.dumps({"message": message.to_dict(), "args": args})
+        job_id = await run_in_db_thread(enqueue_job, self.owner, kind, user_id, payload, self.max_per_user)
+        if job_id is None:
+            return False
+
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return True
+
+    async def start(self, application):
+        """
+        Recover interrupted jobs and start the workers.
+
+        Args:
+            application (Application): Used to send the results
+        """
+        self._application = application
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+
+        recovered = await run_in_db_thread(requeue_running_jobs, self.owner)
+        if recovered:
+            logger.info(f"Resuming {recovered} interrupted jobs")
+
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        logger.info(f"Started {self.workers} job workers")
+
+    async def stop(self, timeout=0):
+        """
+        Stop the workers and put the jobs they were running back in the queue.
+
+        Args:
+            timeout (float): Seconds to let running jobs finish first; no new
+                jobs are started meanwhile
+        """
+        self._stopping = True
+        if self._wakeup is not None:
+            # Idle workers exit right away
+            self._wakeup.set()
+
+        if self._tasks and timeout > 0:
+            if self._running:
+                logger.info(f"Waiting up to {timeout}s for {len(self._running)} running jobs to finish")
+            await asyncio.wait(self._tasks, timeout=timeout)
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        if self._running:
+            await run_in_db_thread(release_jobs, list(self._running), count_attempt=False)
+            logger.info(f"Put {len(self._running)} unfinished jobs back in the queue")
+            self._running.clear()
+
+    async def _work(self):
+        while not self._stopping:
+            # Clear first so an enqueue during the claim isn't missed
+            self._wakeup.clear()
+            job = await run_in_db_thread(claim_job, self.owner)
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run(*job)
+
+    async def _run(self, job_id, kind, user_id, payload, attempts):
+        """
+        Run one claimed job and remove it from the queue when done
+        """
+        self._running.add(job_id)
+        try:
+            data = json.loads(payload)
+            message = Message.de_json(data["message"], self._application.bot)
+            handler, failure_text = self._handlers.get(kind, (None, None))
+
+            if handler is None:
+                logger.error(f"Dropping {kind} job {job_id}: no handler for this kind of job")
+            elif attempts > self.max_attempts:
+                logger.error(f"Giving up on {kind} job {job_id} after {self.max_attempts} attempts")
+                await message.reply_text(failure_text)
+            else:
+                with profiling.profiled(f"job:{kind}"):
+                    await handler(self._application, message, user_id, **data["args"])
+        except asyncio.CancelledError:
+            # stop() puts the job back
+            raise
+        except Exception as e:
+            logger.error(f"Error running {kind} job {job_id}: {str(e)}")
+            self._running.discard(job_id)
+            await run_in_db_thread(release_jobs, [job_id])
+            return
+
+        self._running.discard(job_id)
+        # Don't let a stop in the middle of this leave a finished job to run again
+        await asyncio.shield(run_in_db_thread(finish_job, job_id))
+
+        # The user's next job can run now
+        self._wakeup.set()
+
+
+# Shared job queue for slow commands
+job_queue = DurableJobQueue()
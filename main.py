@@ -8,7 +8,9 @@ In production deployment, this starts the actual Telegram bot.
 
 import os
 import logging
-from dotenv import load_dotenv
+
+from config import load_config
+from health import startup_timer, mark_not_ready
 
 # Set up logging
 logging.basicConfig(
@@ -22,7 +24,8 @@ logger = logging.getLogger(__name__)
 IN_REPLIT = os.environ.get("REPL_ID") is not None
 
 # Load environment variables from .env file if it exists
-load_dotenv()
+load_config()
+startup_timer.mark("config")
 
 # Import app for Replit (gunicorn expects app in main.py)
 if IN_REPLIT:
@@ -31,21 +34,47 @@ else:
     # When not in Replit, 'app' isn't needed
     pass
 
-def start_bot():
+def start_bot(mode=None, workers=None):
     """
     Print a simple banner and start the bot.
     This function is used when called directly or from another module.
+    
+    Args:
+        mode (str, optional): "polling" or "webhook"; defaults to the BOT_MODE env var
+        workers (int, optional): Worker processes to shard chats across; defaults to BOT_WORKERS
     """
     print("=" * 50)
     print("Starting Shape on Telegram Bot")
     print("=" * 50)
     
+    # A ready file left by the previous run would make health checks pass too early
+    mark_not_ready()
+    
+    from sharding import BOT_WORKERS
+    workers = workers or BOT_WORKERS
+    
     # Always start the actual bot regardless of environment
     # since you want to test it directly in Replit
     logger.info("Starting bot in production mode")
-    # Import and start the bot
-    from bot import run_bot
-    run_bot()
+    
+    if workers > 1:
+        # One process receives updates and fans them out to worker processes
+        from bot import BOT_MODE
+        from sharding import run_sharded
+        run_sharded(workers, mode or BOT_MODE)
+    else:
+        # Import and start the bot
+        from bot import run_bot
+        run_bot(mode)
     
 if __name__ == "__main__":
-    start_bot()
\ No newline at end of file
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="Run the Shape on Telegram bot")
+    parser.add_argument("--mode", choices=["polling", "webhook"],
+                        help="How to receive updates (default: BOT_MODE env var or polling)")
+    parser.add_argument("--workers", type=int,
+                        help="Worker processes to shard chats across (default: BOT_WORKERS env var or 1)")
+    args = parser.parse_args()
+    
+    start_bot(args.mode, args.workers)
\ No newline at end of file
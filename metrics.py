@@ -0,0 +1,281 @@
+"""
+Minimal Prometheus-style metrics: counters, gauges and histograms rendered
+in the text exposition format and served on a local HTTP port.
+"""
+
+import os
+import time
+import asyncio
+import logging
+import functools
+import threading
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Port for the /metrics endpoint (0 disables it) and the address to bind
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+
+# Latency buckets in seconds, wide enough for slow image generation
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Every metric, by name, in registration order
+REGISTRY = {}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        REGISTRY[name] = self
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def samples(self):
+        """
+        Yield (suffix, label_values, extra_labels, value) tuples
+        """
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, values, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, values, extra)} {value}")
+        return "\n".join(lines)
+
+
+class _ValueMetric(_Metric):
+    """
+    A metric with one value per label set, set directly or read from a callback.
+    """
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self._values = {}
+        self._callbacks = {}
+
+    def set_callback(self, callback, **labels):
+        """
+        Read the value from `callback()` each time metrics are scraped
+        """
+        with self._lock:
+            self._callbacks[self._key(labels)] = callback
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+            callbacks = list(self._callbacks.items())
+        for values, value in items:
+            yield "", values, (), value
+        for values, callback in callbacks:
+            try:
+                yield "", values, (), callback()
+            except Exception as e:
+                logger.error(f"Error reading metric {self.name}: {str(e)}")
+
+
+class Counter(_ValueMetric):
+    """
+    A value that only goes up.
+    """
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_ValueMetric):
+    """
+    A value that goes up and down.
+    """
+
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    """
+    Counts observations into cumulative buckets, with their sum and count.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self._lock:
+            items = [(values, (list(entry[0]), entry[1], entry[2])) for values, entry in self._values.items()]
+        for values, (counts, total, count) in items:
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield "_bucket", values, (("le", bound),), bucket_count
+            yield "_bucket", values, (("le", "+Inf"),), count
+            yield "_sum", values, (), total
+            yield "_count", values, (), count
+
+
+def timed(histogram, **labels):
+    """
+    Decorator that records how long a sync or async function takes.
+
+    Args:
+        histogram (Histogram): Where to record the duration
+        **labels: Label values for the observation
+    """
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - start, **labels)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, **labels)
+        return wrapper
+    return decorator
+
+
+def render():
+    """
+    Render every registered metric in the Prometheus text format.
+
+    Returns:
+        str: The exposition text
+    """
+    return "\n".join(metric.render() for metric in REGISTRY.values()) + "\n"
+
+
+# Extra endpoints on the metrics port: path -> function returning (status, body text)
+_ROUTES = {}
+
+
+def add_route(path, handler):
+    """
+    Serve another plain-text endpoint on the metrics port.
+
+    Args:
+        path (str): The URL path, e.g. "/healthz"
+        handler (callable): Returns (status line, body text) for each request
+    """
+    _ROUTES[path] = handler
+
+
+async def _handle_request(reader, writer):
+    """
+    Answer a single HTTP request on the metrics port
+    """
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        # Skip the headers; nothing in them matters here
+        while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+            pass
+
+        parts = request_line.decode("latin-1").split()
+        path = parts[1] if len(parts) > 1 else ""
+
+        path = path.split("?")[0]
+        if path == "/metrics":
+            status, content_type, body = "200 OK", "text/plain; version=0.0.4", render().encode()
+        elif path in _ROUTES:
+            status, text = _ROUTES[path]()
+            content_type, body = "text/plain", text.encode()
+        else:
+            status, content_type, body = "404 Not Found", "text/plain", b"Not found\n"
+
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host=None, port=None):
+    """
+    Serve /metrics on the given address.
+
+    Args:
+        host (str, optional): Address to bind; defaults to METRICS_HOST
+        port (int, optional): Port to listen on; defaults to METRICS_PORT
+
+    Returns:
+        asyncio.base_events.Server: The running server
+    """
+    host = host or METRICS_HOST
+    port = METRICS_PORT if port is None else port
+    server = await asyncio.start_server(_handle_request, host, port)
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
+
+
+# Metrics shared across the bot
+UPDATES_TOTAL = Counter(
+    "shape_bot_updates_total", "Updates received from Telegram", ["type"]
+)
+HANDLER_SECONDS = Histogram(
+    "shape_bot_handler_seconds", "Time spent in each update handler", ["handler"]
+)
+SHAPES_REQUEST_SECONDS = Histogram(
+    "shape_bot_shapes_request_seconds", "Latency of Shapes API requests", ["command"]
+)
+SHAPES_ERRORS_TOTAL = Counter(
+    "shape_bot_shapes_errors_total", "Failed Shapes API requests", ["command", "error"]
+)
+DB_QUERY_SECONDS = Histogram(
+    "shape_bot_db_query_seconds", "Latency of database queries", ["query"]
+)
+CACHE_REQUESTS_TOTAL = Counter(
+    "shape_bot_cache_requests_total", "Cache lookups, by result", ["cache", "result"]
+)
+QUEUE_DEPTH = Gauge(
+    "shape_bot_queue_depth", "Items waiting in internal queues", ["queue"]
+)
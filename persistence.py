@@ -0,0 +1,147 @@
+import os
+import json
+import asyncio
+import logging
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from db import run_in_db_thread, load_state, save_state
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Seconds between the application's persistence passes (how much state a hard crash can lose)
+PERSISTENCE_INTERVAL = float(os.environ.get("PERSISTENCE_INTERVAL", "5"))
+
+
+def _encode_key(key):
+    return json.dumps(list(key) if isinstance(key, tuple) else key)
+
+
+def _decode_key(key):
+    value = json.loads(key)
+    return tuple(value) if isinstance(value, list) else value
+
+
+class SQLitePersistence(BasePersistence):
+    """
+    Keeps conversation states in the SQLite database.
+
+    The handlers keep nothing in user_data, chat_data or bot_data, so those
+    are not persisted; that would cost a row and a write for every new user
+    and chat. The methods for them remain because PTB requires them.
+
+    Everything is read once at startup. Changes are written behind: the
+    application hands over what changed every `update_interval` seconds, and
+    each pass is written in a single transaction on the DB thread, skipping
+    entries whose data did not change. Handlers never wait on the disk.
+
+    Data is stored as JSON, so it must be JSON-serializable.
+    """
+
+    def __init__(self, update_interval=PERSISTENCE_INTERVAL):
+        # Only conversation states are stored
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=False, callback_data=False),
+            update_interval=update_interval
+        )
+        # (kind, key) -> JSON of the last stored data, to skip unchanged writes
+        self._stored = {}
+        # (kind, key) -> JSON to write, or None to delete
+        self._pending = {}
+        self._writer = None
+
+    async def _load(self, kind):
+        rows = await run_in_db_thread(load_state, kind)
+        for key, data in rows:
+            self._stored[(kind, key)] = data
+        return {_decode_key(key): json.loads(data) for key, data in rows}
+
+    def _queue(self, kind, key, data):
+        """
+        Schedule a change; the writer picks up everything queued in the same pass
+        """
+        entry = (kind, _encode_key(key))
+        encoded = None if data is None else json.dumps(data)
+        if encoded == self._stored.get(entry) and entry not in self._pending:
+            return
+
+        self._pending[entry] = encoded
+        if self._writer is None:
+            self._writer = asyncio.create_task(self._write_pending())
+
+    async def _write_pending(self):
+        try:
+            # The application runs a pass as concurrent calls; let them all queue first
+            await asyncio.sleep(0)
+            while self._pending:
+                pending, self._pending = self._pending, {}
+                updates = [(kind, key, data) for (kind, key), data in pending.items() if data is not None]
+                deletes = [(kind, key) for (kind, key), data in pending.items() if data is None]
+                await run_in_db_thread(save_state, updates, deletes)
+
+                for entry, data in pending.items():
+                    if data is None:
+                        self._stored.pop(entry, None)
+                    else:
+                        self._stored[entry] = data
+        except Exception as e:
+            logger.error(f"Error saving bot state: {str(e)}")
+        finally:
+            self._writer = None
+
+    async def get_user_data(self):
+        return await self._load("user_data")
+
+    async def get_chat_data(self):
+        return await self._load("chat_data")
+
+    async def get_bot_data(self):
+        return (await self._load("bot_data")).get("bot_data", {})
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return await self._load(f"conversation:{name}")
+
+    async def update_conversation(self, name, key, new_state):
+        # A finished conversation has no state left to keep
+        self._queue(f"conversation:{name}", key, new_state)
+
+    async def update_user_data(self, user_id, data):
+        self._queue("user_data", user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        self._queue("chat_data", chat_id, data)
+
+    async def update_bot_data(self, data):
+        self._queue("bot_data", "bot_data", data)
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_user_data(self, user_id):
+        self._queue("user_data", user_id, None)
+
+    async def drop_chat_data(self, chat_id):
+        self._queue("chat_data", chat_id, None)
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        """
+        Write anything still pending; called when the application shuts down
+        """
+        if self._writer is not None:
+            await self._writer
+        if self._pending:
+            await self._write_pending()
+        logger.info("Bot state saved to the database")
@@ -0,0 +1,355 @@
+"""
+Opt-in profiling of the update hot path.
+
+With PROFILE_SAMPLE_RATE set, that fraction of updates is followed from
+arrival until its reply is sent, including work it hands off to the
+background (queued Shapes requests, slow-command jobs). Time is split into
+spans: waiting in queues, database queries, Shapes API calls, waiting for
+the send scheduler, Telegram API calls, and the handler's own time (the
+rest). With PROFILE_STACK_INTERVAL also set, a sampler thread records
+where the event loop spends its CPU; it holds the GIL on every sample, so it
+is off by default.
+
+Every PROFILE_INTERVAL seconds they are written to PROFILE_DIR in folded
+stack format ("frame;frame;frame value" per line), which flamegraph.pl,
+inferno and speedscope read directly, along with a JSON line per profiled
+update with its breakdown.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import threading
+import contextlib
+import contextvars
+from collections import Counter
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Fraction of updates to profile (0 disables profiling)
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+
+# Where profiles are written, and how often
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", "60"))
+
+# Milliseconds between stack samples of the event loop (0, the default, disables the sampler)
+PROFILE_STACK_INTERVAL = float(os.environ.get("PROFILE_STACK_INTERVAL", "0"))
+
+# Time not spent in any span
+HANDLER_SPAN = "handler"
+
+_current = contextvars.ContextVar("update_profile", default=None)
+
+
+class UpdateProfile:
+    """
+    The span breakdown of one update.
+
+    The update holds it while its handlers run; background work started
+    for the update takes extra holds. It is finished, and handed to the
+    profiler, when the last hold is released.
+    """
+
+    __slots__ = ("kind", "started", "spans", "holds")
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.started = time.perf_counter()
+        self.spans = Counter()
+        self.holds = 1
+
+    def add(self, span, seconds):
+        self.spans[span] += seconds
+
+    def release(self):
+        self.holds -= 1
+        if self.holds == 0:
+            profiler.record(self)
+
+
+@contextlib.contextmanager
+def profiled(kind):
+    """
+    Profile the block as an update, if it is picked by sampling.
+
+    Args:
+        kind (str): What is being handled, e.g. "message" or "job:imagine"
+    """
+    if not profiler.enabled or random.random() >= profiler.sample_rate:
+        yield
+        return
+
+    profile = UpdateProfile(kind)
+    token = _current.set(profile)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+        profile.release()
+
+
+@contextlib.contextmanager
+def span(name):
+    """
+    Count the block's time towards a span of the current update, if it is profiled.
+
+    Args:
+        name (str): The span, e.g. "db" or "telegram"
+    """
+    profile = _current.get()
+    if profile is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add(name, time.perf_counter() - start)
+
+
+def add_span(name, seconds):
+    """
+    Count time measured elsewhere towards a span of the current update.
+
+    Args:
+        name (str): The span
+        seconds (float): The time to add
+    """
+    profile = _current.get()
+    if profile is not None:
+        profile.add(name, seconds)
+
+
+async def span_iter(iterator, name):
+    """
+    Iterate over an async iterator, counting the waits for each item towards a span.
+
+    Args:
+        iterator (AsyncIterator): The items, e.g. a response stream
+        name (str): The span
+
+    Yields:
+        The iterator's items
+    """
+    iterator = iterator.__aiter__()
+    while True:
+        with span(name):
+            try:
+                item = await iterator.__anext__()
+            except StopAsyncIteration:
+                return
+        yield item
+
+
+def hold():
+    """
+    Keep the current update's profile open for work that outlives its handler.
+
+    Returns:
+        tuple or None: Pass to resumed() when the work runs, or to release()
+        if it never does
+    """
+    profile = _current.get()
+    if profile is None:
+        return None
+    profile.holds += 1
+    return profile, time.perf_counter()
+
+
+def release(held):
+    """
+    Let go of a hold whose work will never run.
+
+    Args:
+        held (tuple or None): What hold() returned
+    """
+    if held is not None:
+        held[0].release()
+
+
+@contextlib.contextmanager
+def resumed(held):
+    """
+    Run held work as part of its update, counting the wait for it as queued time.
+
+    Args:
+        held (tuple or None): What hold() returned
+    """
+    if held is None:
+        # Don't attribute the work to whatever update started this task
+        token = _current.set(None)
+        try:
+            yield
+        finally:
+            _current.reset(token)
+        return
+
+    profile, held_at = held
+    profile.add("queued", time.perf_counter() - held_at)
+    token = _current.set(profile)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+        profile.release()
+
+
+def detach():
+    """
+    Stop attributing the current task's work to the update that started it.
+
+    For helper tasks, like chat action senders, that run alongside the update.
+    """
+    _current.set(None)
+
+
+class _StackSampler(threading.Thread):
+    """
+    Samples the event loop thread's Python stack at a fixed interval.
+    """
+
+    def __init__(self, thread_id, interval):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            # Skip samples where the loop is idle, waiting for I/O
+            if frame is None or frame.f_code.co_filename.endswith("selectors.py"):
+                continue
+
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            with self.lock:
+                self.stacks[";".join(reversed(names))] += 1
+
+    def take(self):
+        with self.lock:
+            stacks, self.stacks = self.stacks, Counter()
+        return stacks
+
+
+class Profiler:
+    """
+    Collects finished update profiles and stack samples, and writes them out periodically.
+    """
+
+    def __init__(self, sample_rate=PROFILE_SAMPLE_RATE, directory=PROFILE_DIR,
+                 interval=PROFILE_INTERVAL, stack_interval=PROFILE_STACK_INTERVAL):
+        self.sample_rate = sample_rate
+        self.enabled = sample_rate > 0
+        self.directory = directory
+        self.interval = interval
+        self.stack_interval = stack_interval
+        self._updates = []
+        self._sampler = None
+        self._task = None
+
+    def record(self, profile):
+        """
+        Add a finished update profile to the next dump
+        """
+        total = time.perf_counter() - profile.started
+        spans = dict(profile.spans)
+        # Overlapping spans (e.g. sends during a stream) can add up to more than the total
+        spans[HANDLER_SPAN] = max(0.0, total - sum(spans.values()))
+        self._updates.append((profile.kind, total, spans))
+
+    def start(self):
+        """
+        Start sampling stacks and writing profiles; does nothing unless profiling is enabled
+        """
+        if not self.enabled or self._task is not None:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        if self.stack_interval > 0:
+            self._sampler = _StackSampler(threading.get_ident(), self.stack_interval / 1000)
+            self._sampler.start()
+        self._task = asyncio.create_task(self._dump_periodically())
+        logger.info(f"Profiling {self.sample_rate:.1%} of updates into {self.directory}/")
+
+    async def stop(self):
+        """
+        Stop sampling and write what was collected since the last dump
+        """
+        if self._task is None:
+            return
+
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+        if self._sampler is not None:
+            self._sampler.stopped.set()
+            self._sampler = None
+        await self.dump()
+
+    async def _dump_periodically(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.dump()
+            except OSError as e:
+                logger.error(f"Error writing profiles: {str(e)}")
+
+    async def dump(self):
+        """
+        Write the profiles collected since the last dump to new files.
+        """
+        updates, self._updates = self._updates, []
+        stacks = self._sampler.take() if self._sampler is not None else Counter()
+        if updates or stacks:
+            await asyncio.to_thread(self._write, updates, stacks)
+
+    def _write(self, updates, stacks):
+        suffix = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+
+        if updates:
+            # Span times in microseconds, one stack per update kind and span
+            spans = Counter()
+            for kind, _, breakdown in updates:
+                for name, seconds in breakdown.items():
+                    spans[f"{kind};{name}"] += seconds
+            _write_folded(os.path.join(self.directory, f"spans-{suffix}.folded"),
+                          {stack: round(seconds * 1_000_000) for stack, seconds in spans.items()})
+
+            with open(os.path.join(self.directory, f"updates-{suffix}.jsonl"), "w") as file:
+                for kind, total, breakdown in updates:
+                    record = {"kind": kind, "total_ms": round(total * 1000, 3)}
+                    record.update({f"{name}_ms": round(seconds * 1000, 3) for name, seconds in breakdown.items()})
+                    file.write(json.dumps(record) + "\n")
+
+        if stacks:
+            _write_folded(os.path.join(self.directory, f"stacks-{suffix}.folded"), stacks)
+
+        logger.info(f"Wrote profiles of {len(updates)} updates and {sum(stacks.values())} stack samples")
+
+
+def _write_folded(path, counts):
+    with open(path, "w") as file:
+        for stack, count in sorted(counts.items()):
+            if count > 0:
+                file.write(f"{stack} {count}\n")
+
+
+# Shared profiler for this process
+profiler = Profiler()
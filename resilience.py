@@ -0,0 +1,169 @@
+import time
+import random
+import asyncio
+import logging
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling an upstream that is known to be failing.
+    """
+
+
+class CircuitBreaker:
+    """
+    Fails fast while an upstream service is down.
+
+    After `failure_threshold` consecutive failures the circuit opens and
+    calls are rejected for `reset_timeout` seconds. Then a single trial call
+    is let through (half-open): success closes the circuit, failure opens it
+    again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_running = False
+
+    def before_call(self):
+        """
+        Check whether a call may go ahead.
+
+        Raises:
+            CircuitOpenError: If the circuit is open
+        """
+        if self.state == self.CLOSED:
+            return
+
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(f"{self.name} is temporarily unavailable, please try again shortly")
+            self.state = self.HALF_OPEN
+            self._trial_running = False
+
+        # Half-open: only one trial call at a time
+        if self._trial_running:
+            raise CircuitOpenError(f"{self.name} is temporarily unavailable, please try again shortly")
+        self._trial_running = True
+
+    def record_success(self):
+        """
+        Note a successful call, closing the circuit.
+        """
+        if self.state != self.CLOSED:
+            logger.info(f"Circuit for {self.name} closed again")
+        self.state = self.CLOSED
+        self.failures = 0
+        self._trial_running = False
+
+    def record_failure(self):
+        """
+        Note a failed call, opening the circuit if there have been too many.
+        """
+        self.failures += 1
+        self._trial_running = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(f"Circuit for {self.name} opened after {self.failures} failures")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def release(self):
+        """
+        Note a call that ended without telling us anything about the upstream.
+        """
+        self._trial_running = False
+
+
+def backoff_delay(attempt, base_delay, max_delay):
+    """
+    Exponential backoff with full jitter.
+
+    Args:
+        attempt (int): The retry number, starting at 0
+        base_delay (float): Delay before the first retry, in seconds
+        max_delay (float): Upper bound for any delay, in seconds
+
+    Returns:
+        float: Seconds to wait before the next attempt
+    """
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+async def call_with_retries(func, is_transient, breaker=None, retries=2,
+                            base_delay=0.5, max_delay=8.0, is_failure=None, retry_after=None):
+    """
+    Call an async function, retrying transient failures with backoff.
+
+    The breaker hears about the call once, when it has succeeded or given
+    up, so the retries of one call don't count as several failures.
+
+    Args:
+        func (callable): Zero-argument coroutine function to call
+        is_transient (callable): Returns True for exceptions worth retrying
+        breaker (CircuitBreaker, optional): Circuit breaker guarding the upstream
+        retries (int): How many times to retry after the first attempt
+        base_delay (float): Delay before the first retry, in seconds
+        max_delay (float): Upper bound for any delay, in seconds
+        is_failure (callable, optional): Returns True for exceptions that mean the
+            upstream itself is failing and count towards the breaker; defaults to is_transient
+        retry_after (callable, optional): Returns the seconds the upstream asked us
+            to wait before retrying after an exception, or None
+
+    Returns:
+        Whatever func returns
+
+    Raises:
+        CircuitOpenError: If the breaker is open
+        Exception: The last error, once retries are used up or it isn't transient
+    """
+    if is_failure is None:
+        is_failure = is_transient
+
+    if breaker is not None:
+        breaker.before_call()
+
+    try:
+        for attempt in range(retries + 1):
+            try:
+                result = await func()
+            except Exception as e:
+                if not is_transient(e) or attempt == retries:
+                    raise
+                delay = backoff_delay(attempt, base_delay, max_delay)
+                wait = retry_after(e) if retry_after is not None else None
+                if wait is not None:
+                    if wait > max_delay:
+                        # Not worth holding the caller that long
+                        raise
+                    delay = max(delay, wait)
+                logger.warning(f"Transient error ({type(e).__name__}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+            else:
+                if breaker is not None:
+                    breaker.record_success()
+                return result
+    except Exception as e:
+        if breaker is not None:
+            if is_failure(e):
+                breaker.record_failure()
+            else:
+                # The upstream answered; this error is about the request (or the caller) itself
+                breaker.release()
+        raise
+    except BaseException:
+        # Cancelled: make sure a half-open trial doesn't stay reserved
+        if breaker is not None:
+            breaker.release()
+        raise
@@ -0,0 +1,279 @@
+import os
+import time
+import asyncio
+import logging
+import itertools
+import contextvars
+from contextlib import contextmanager
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from profiling import span
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Telegram's documented limits: ~30 messages/s overall, ~1/s per private chat, 20/min per group
+SEND_GLOBAL_RATE = float(os.environ.get("SEND_GLOBAL_RATE", "30"))
+SEND_PRIVATE_RATE = float(os.environ.get("SEND_PRIVATE_RATE", "1"))
+SEND_GROUP_RATE = float(os.environ.get("SEND_GROUP_RATE", str(20 / 60)))
+SEND_BURST = float(os.environ.get("SEND_BURST", "3"))
+
+# How many times a request is retried after Telegram answers with RetryAfter
+SEND_MAX_RETRIES = int(os.environ.get("SEND_MAX_RETRIES", "3"))
+
+# Send priorities (lower goes first)
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# Endpoints that default to low priority because they are only cosmetic
+LOW_PRIORITY_ENDPOINTS = {"sendChatAction"}
+
+# Endpoints that don't use up a chat's message allowance (they still respect its flood pauses)
+UNMETERED_CHAT_ENDPOINTS = {"sendChatAction"}
+
+_send_priority = contextvars.ContextVar("send_priority", default=None)
+
+
+@contextmanager
+def send_priority(priority):
+    """
+    Give every Telegram request made inside the block the given priority.
+
+    Args:
+        priority (int): One of PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_LOW
+    """
+    token = _send_priority.set(priority)
+    try:
+        yield
+    finally:
+        _send_priority.reset(token)
+
+
+class TokenBucket:
+    """
+    Classic token bucket: refills at `rate` tokens per second up to `capacity`.
+    """
+
+    __slots__ = ("rate", "capacity", "tokens", "updated", "paused_until")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """
+        Seconds until a token is available (0 if one is available now)
+        """
+        self.refill(now)
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        """
+        Stop handing out tokens for a while (used after RetryAfter)
+        """
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class SendScheduler(BaseRateLimiter):
+    """
+    Rate limiter for every outgoing Telegram request.
+
+    Requests that target a chat wait in a priority queue until both the
+    global and the chat's token bucket allow them. A single pump task hands
+    out send slots, preferring high-priority requests (short command
+    acknowledgements) over long completions and cosmetic chat actions. Chat
+    actions only count against the global rate, so typing indicators never
+    use up a chat's allowance for replies. When Telegram still answers with
+    RetryAfter, the chat (or everything, for chat-less requests) is paused
+    for the requested time and the request is retried in its original place
+    in the queue.
+    """
+
+    def __init__(self, global_rate=SEND_GLOBAL_RATE, private_rate=SEND_PRIVATE_RATE,
+                 group_rate=SEND_GROUP_RATE, burst=SEND_BURST, max_retries=SEND_MAX_RETRIES):
+        self.global_rate = global_rate
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, max(burst, global_rate))
+        self._chats = {}
+        self._queue = []
+        self._counter = itertools.count()
+        self._wakeup = None
+        self._pump_task = None
+
+    @property
+    def queued(self):
+        """
+        Number of requests waiting for a send slot
+        """
+        return len(self._queue)
+
+    async def initialize(self):
+        """
+        Start the pump task that grants send slots
+        """
+        # The application and its updater both initialize the bot, and with it the rate limiter
+        if self._pump_task is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._pump_task = asyncio.create_task(self._pump(), name="send_scheduler")
+
+    async def shutdown(self):
+        """
+        Stop the pump, letting anything still queued go out immediately
+        """
+        if self._pump_task is not None:
+            self._pump_task.cancel()
+            try:
+                await self._pump_task
+            except asyncio.CancelledError:
+                pass
+            self._pump_task = None
+
+        for _, _, _, _, future in self._queue:
+            if not future.done():
+                future.set_result(None)
+        self._queue.clear()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Group and channel IDs are negative
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = self.group_rate if is_group else self.private_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, self.burst)
+        return bucket
+
+    def _prune_buckets(self, now):
+        """
+        Drop buckets that are full again, so idle chats don't use memory
+        """
+        waiting = {entry[2] for entry in self._queue}
+        for chat_id, bucket in list(self._chats.items()):
+            if chat_id in waiting:
+                continue
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity and now >= bucket.paused_until:
+                del self._chats[chat_id]
+
+    async def _pump(self):
+        """
+        Hand out send slots to queued requests as the buckets allow
+        """
+        last_prune = time.monotonic()
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            if now - last_prune > 60:
+                self._prune_buckets(now)
+                last_prune = now
+
+            global_wait = self._global.wait_time(now)
+            if global_wait > 0:
+                await asyncio.sleep(global_wait)
+                continue
+
+            # Pick the best request whose chat can send right now
+            chosen = None
+            shortest_wait = None
+            for entry in sorted(self._queue):
+                if entry[4].done():
+                    chosen = entry
+                    break
+                bucket = self._chat_bucket(entry[2])
+                wait = bucket.wait_time(now) if entry[3] else max(0.0, bucket.paused_until - now)
+                if wait == 0:
+                    chosen = entry
+                    break
+                if shortest_wait is None or wait < shortest_wait:
+                    shortest_wait = wait
+
+            if chosen is None:
+                # Nothing can go yet; sleep until a chat frees up or a new request arrives
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=shortest_wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._queue.remove(chosen)
+
+            future = chosen[4]
+            if future.done():
+                # The caller gave up while waiting
+                continue
+
+            self._global.take()
+            if chosen[3]:
+                self._chat_bucket(chosen[2]).take()
+            future.set_result(None)
+
+    async def _acquire(self, chat_id, priority, seq, metered=True):
+        """
+        Wait in the queue until the request may be sent
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._queue.append((priority, seq, chat_id, metered, future))
+        self._wakeup.set()
+        await future
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        """
+        Queue the request according to its chat and priority, then send it
+        """
+        chat_id = data.get("chat_id")
+
+        # Priority: explicit rate_limit_args, then send_priority(), then the endpoint default
+        priority = (rate_limit_args or {}).get("priority", _send_priority.get())
+        if priority is None:
+            priority = PRIORITY_LOW if endpoint in LOW_PRIORITY_ENDPOINTS else PRIORITY_NORMAL
+
+        # Retries keep their original position in the queue
+        seq = next(self._counter)
+
+        for attempt in range(self.max_retries + 1):
+            with span("send_queue"):
+                if chat_id is not None and self._pump_task is not None:
+                    await self._acquire(chat_id, priority, seq, endpoint not in UNMETERED_CHAT_ENDPOINTS)
+                elif self._global.paused_until > time.monotonic():
+                    # Chat-less requests skip the queue but still respect a global pause
+                    await asyncio.sleep(self._global.paused_until - time.monotonic())
+
+            try:
+                with span("telegram"):
+                    return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(
+                    f"Flood control on {endpoint} (chat {chat_id}), retrying in {e.retry_after}s"
+                )
+                if chat_id is not None:
+                    self._chat_bucket(chat_id).pause(e.retry_after)
+                else:
+                    self._global.pause(e.retry_after)
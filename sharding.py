@@ -0,0 +1,250 @@
+"""
+Multi-process mode: one front end receives updates and fans them out to
+worker processes, each running its own Application.
+
+Updates are sharded by chat ID (user ID for chat-less updates), so every
+chat is always handled by the same worker and keeps its update order and
+conversation state. Workers share the SQLite database, which runs in WAL
+mode with a busy timeout so concurrent writers wait instead of failing.
+"""
+
+import os
+import queue
+import signal
+import asyncio
+import logging
+import multiprocessing
+
+from update_processor import ordering_key
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Number of worker processes (1 disables sharding)
+BOT_WORKERS = int(os.environ.get("BOT_WORKERS", "1"))
+
+# Seconds between checks that the other side (workers, or the front end) is still alive
+PROCESS_CHECK_INTERVAL = 1.0
+
+
+def shard_for(update, shard_count):
+    """
+    Pick the worker responsible for an update.
+
+    Args:
+        update (telegram.Update): The incoming update
+        shard_count (int): Number of workers
+
+    Returns:
+        int: The worker index
+    """
+    key = ordering_key(update)
+    if key is None:
+        return 0
+    return key % shard_count
+
+
+def _worker_main(index, worker_count, update_queue, ready):
+    """
+    Entry point of a worker process
+    """
+    logging.basicConfig(
+        format=f'%(asctime)s - shard-{index} - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+
+    # Each worker serves its own metrics on the port after the previous worker's
+    import metrics
+    if metrics.METRICS_PORT:
+        metrics.METRICS_PORT += index
+
+    # The ready file belongs to the front end, which is ready once every worker is
+    import health
+    health.READY_FILE = ""
+
+    # The front end decides when to stop; workers wait for its signal on the queue,
+    # or stop by themselves if the front end dies without sending it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    asyncio.run(_run_worker(index, worker_count, update_queue, ready))
+
+
+async def _run_worker(index, worker_count, update_queue, ready):
+    """
+    Feed updates from the front end into this worker's application
+    """
+    from telegram import Update
+    from bot import build_application, startup, stopping, shutdown
+    from jobs import job_queue
+
+    # Each worker runs the jobs queued by its own chats
+    job_queue.owner = index
+    # Telegram's overall send limit is per bot, so each worker gets its share
+    application = build_application(with_updater=False, shard_count=worker_count)
+    loop = asyncio.get_running_loop()
+
+    await application.initialize()
+    await startup(application)
+    await application.start()
+    logger.info(f"Worker {index} is ready")
+    ready.set()
+
+    front_end = multiprocessing.parent_process()
+    try:
+        while True:
+            try:
+                data = await loop.run_in_executor(None, update_queue.get, True, PROCESS_CHECK_INTERVAL)
+            except queue.Empty:
+                if not front_end.is_alive():
+                    logger.error(f"Front end is gone, stopping worker {index}")
+                    break
+                continue
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+    finally:
+        logger.info(f"Worker {index} is stopping...")
+        await application.stop()
+        await stopping(application)
+        await application.shutdown()
+        await shutdown(application)
+
+
+async def _forward(update_queue, worker_queues):
+    """
+    Move updates from the front end's updater to the right worker
+    """
+    while True:
+        update = await update_queue.get()
+        index = shard_for(update, len(worker_queues))
+        worker_queues[index].put(update.to_dict())
+
+
+async def _watch_workers(processes, stop_event):
+    """
+    Stop the front end if a worker process dies, since its chats would go unanswered
+
+    Returns:
+        str: The name of the worker that died
+    """
+    while True:
+        for process in processes:
+            if not process.is_alive():
+                logger.error(f"Worker {process.name} died (exit code {process.exitcode}), stopping")
+                stop_event.set()
+                return process.name
+        await asyncio.sleep(PROCESS_CHECK_INTERVAL)
+
+
+async def _run_front_end(mode, worker_queues, processes, ready_events):
+    """
+    Receive updates from Telegram until asked to stop, or until a worker dies
+
+    Returns:
+        bool: True if the front end stopped because a worker died
+    """
+    from telegram import Bot, Update
+    from telegram.ext import Updater
+    from bot import TELEGRAM_TOKEN, TELEGRAM_API_URL, webhook_settings
+    from health import startup_timer, mark_ready, mark_not_ready
+
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    bot = Bot(TELEGRAM_TOKEN, base_url=f"{TELEGRAM_API_URL}/bot", base_file_url=f"{TELEGRAM_API_URL}/file/bot")
+    updater = Updater(bot=bot, update_queue=asyncio.Queue())
+    async with updater:
+        if mode == "webhook":
+            await updater.start_webhook(**webhook_settings())
+        else:
+            await updater.start_polling(allowed_updates=Update.ALL_TYPES)
+        logger.info(f"Front end is receiving updates via {mode} for {len(worker_queues)} workers")
+        startup_timer.mark("receiving updates")
+
+        forwarder = asyncio.create_task(_forward(updater.update_queue, worker_queues))
+        watcher = asyncio.create_task(_watch_workers(processes, stop_event))
+
+        # Updates received meanwhile wait in the workers' queues, but the bot isn't
+        # ready until every worker can answer them
+        while not all(event.is_set() for event in ready_events) and not stop_event.is_set():
+            await asyncio.sleep(0.05)
+        if not stop_event.is_set():
+            startup_timer.mark("workers")
+            startup_timer.report()
+            mark_ready()
+
+        await stop_event.wait()
+
+        logger.info("Stopping front end...")
+        mark_not_ready()
+        await updater.stop()
+
+        # Hand over anything received before the updater stopped
+        forwarder.cancel()
+        while not updater.update_queue.empty():
+            update = updater.update_queue.get_nowait()
+            worker_queues[shard_for(update, len(worker_queues))].put(update.to_dict())
+
+    if watcher.done():
+        return True
+    watcher.cancel()
+    return False
+
+
+def run_sharded(workers, mode):
+    """
+    Run the bot as one update front end plus several worker processes.
+
+    If a worker dies, the others are stopped and the process exits with
+    status 1, for the supervisor to restart the whole bot.
+
+    Args:
+        workers (int): Number of worker processes
+        mode (str): "polling" or "webhook"
+    """
+    from db import init_db, close_db
+    from jobs import assign_jobs_to_shards
+
+    mode = mode.lower()
+    if mode not in ("polling", "webhook"):
+        raise ValueError(f"Unknown bot mode: {mode}")
+    if mode == "webhook":
+        # Fail before starting any workers
+        from bot import check_webhook_url
+        check_webhook_url()
+
+    # Create tables once, and hand over the jobs of workers that no longer exist,
+    # before any worker touches the database
+    init_db()
+    assign_jobs_to_shards(workers)
+    close_db()
+
+    # Spawn fresh interpreters so workers don't inherit the front end's state
+    context = multiprocessing.get_context("spawn")
+    worker_queues = [context.Queue() for _ in range(workers)]
+    ready_events = [context.Event() for _ in range(workers)]
+    processes = [
+        context.Process(target=_worker_main, args=(index, workers, worker_queues[index], ready_events[index]),
+                        name=f"shard-{index}")
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    logger.info(f"Started {workers} worker processes")
+
+    worker_died = False
+    try:
+        worker_died = asyncio.run(_run_front_end(mode, worker_queues, processes, ready_events))
+    finally:
+        # Tell every worker to finish what it has and exit
+        for worker_queue in worker_queues:
+            worker_queue.put(None)
+        for process in processes:
+            process.join()
+        logger.info("All workers stopped")
+
+    if worker_died:
+        raise SystemExit(1)
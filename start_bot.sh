@@ -28,5 +28,6 @@ fi
 mkdir -p data
 
 # Start the bot
+# (exec, so the bot gets the container's stop signal and can shut down cleanly)
 echo "🚀 Starting the bot..."
-python main.py
\ No newline at end of file
+exec python main.py
\ No newline at end of file
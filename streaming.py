@@ -0,0 +1,172 @@
+import os
+import time
+import asyncio
+import logging
+
+from telegram.constants import MessageLimit
+from telegram.error import BadRequest, RetryAfter
+
+from api_handler import ErrorReply
+from send_scheduler import send_priority, PRIORITY_LOW
+from formatting import REPLY_MARKDOWN, split_text, reply_formatted, edit_formatted
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Stream Shapes responses into an edited message instead of waiting for the full reply
+SHAPES_STREAMING = os.environ.get("SHAPES_STREAMING", "false").lower() in ("1", "true", "yes")
+
+# Minimum seconds between edits of the same message (groups have stricter limits)
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", "1.0"))
+STREAM_GROUP_EDIT_INTERVAL = float(os.environ.get("STREAM_GROUP_EDIT_INTERVAL", "3.0"))
+
+# Characters to collect before posting the first partial reply
+STREAM_FIRST_CHUNK_CHARS = int(os.environ.get("STREAM_FIRST_CHUNK_CHARS", "20"))
+
+# Shown at the end of a reply that is still being written
+CURSOR = " ▌"
+
+
+class StreamingReply:
+    """
+    A reply that is posted early and then edited as more text arrives.
+
+    Edits are throttled per message, and skipped entirely while Telegram
+    asks us to back off, so a fast stream never exceeds the chat's limits.
+    When the response outgrows one message, the finished part is settled
+    and the rest continues in a new message.
+    """
+
+    def __init__(self, message):
+        self.message = message
+        self.text = ""
+        # The part of the response shown in the current message
+        self.current = ""
+        self.failed = False
+        self.sent = None
+        self.shown = ""
+        self.next_edit_at = 0.0
+        if message.chat.type == "private":
+            self.interval = STREAM_EDIT_INTERVAL
+        else:
+            self.interval = STREAM_GROUP_EDIT_INTERVAL
+
+    async def _show(self, text, final=False):
+        """
+        Post or edit the reply, returning False if Telegram asked us to wait.
+
+        Only the final text is rendered as Markdown; partial text often has
+        unclosed markup.
+        """
+        if text == self.shown and not (final and REPLY_MARKDOWN):
+            return True
+        try:
+            if self.sent is None:
+                if final:
+                    self.sent = await reply_formatted(self.message, text)
+                else:
+                    self.sent = await self.message.reply_text(text)
+            elif final:
+                await edit_formatted(self.sent, text)
+            else:
+                await self.sent.edit_text(text)
+            self.shown = text
+            return True
+        except RetryAfter as e:
+            logger.warning(f"Rate limited while streaming, pausing edits for {e.retry_after}s")
+            self.next_edit_at = time.monotonic() + e.retry_after
+            return False
+        except BadRequest as e:
+            # Telegram rejects edits that don't change anything
+            if "not modified" in str(e).lower():
+                self.shown = text
+                return True
+            raise
+
+    async def add(self, delta):
+        """
+        Add newly generated text, updating the visible reply if it's time to.
+
+        Args:
+            delta (str): The new piece of the response
+        """
+        self.text += delta
+        self.current += delta
+
+        # Error messages are shown like any text, but the reply counts as failed
+        if isinstance(delta, ErrorReply):
+            self.failed = True
+
+        if len(self.current) > MessageLimit.MAX_TEXT_LENGTH:
+            await self._overflow()
+
+        if self.sent is None and len(self.text) < STREAM_FIRST_CHUNK_CHARS:
+            return
+
+        now = time.monotonic()
+        if now < self.next_edit_at:
+            return
+
+        # Partial previews are cosmetic, so let other chats' replies go first
+        preview = self.current[:MessageLimit.MAX_TEXT_LENGTH - len(CURSOR)] + CURSOR
+        with send_priority(PRIORITY_LOW):
+            shown = await self._show(preview)
+        if shown:
+            self.next_edit_at = now + self.interval
+
+    async def _settle(self, text):
+        """
+        Show the final text of the current message
+        """
+        # The final edit must land, so wait out any flood control first
+        while not await self._show(text, final=True):
+            await _sleep_until(self.next_edit_at)
+
+    async def _overflow(self):
+        """
+        Settle the full messages at the start of the current text and carry
+        the rest over to a new message
+        """
+        pieces = list(split_text(self.current))
+        await self._settle(pieces[0])
+        for piece in pieces[1:-1]:
+            await reply_formatted(self.message, piece)
+
+        self.current = pieces[-1]
+        self.sent = None
+        self.shown = ""
+        self.next_edit_at = 0.0
+
+    async def finish(self):
+        """
+        Show the complete response, sending any overflow as extra messages.
+        """
+        pieces = list(split_text(self.current)) or ["…"]
+        await self._settle(pieces[0])
+        for piece in pieces[1:]:
+            await reply_formatted(self.message, piece)
+
+
+async def _sleep_until(deadline):
+    """
+    Sleep until the given time.monotonic() deadline
+    """
+    await asyncio.sleep(max(0.0, deadline - time.monotonic()))
+
+
+async def reply_streaming(message, chunks):
+    """
+    Reply to a message with a streamed response.
+
+    Args:
+        message (telegram.Message): The message being answered
+        chunks (AsyncIterator[str]): Pieces of the response, in order
+
+    Returns:
+        str or None: The full response, or None if the request failed
+    """
+    reply = StreamingReply(message)
+    async for delta in chunks:
+        await reply.add(delta)
+    await reply.finish()
+    return None if reply.failed else reply.text
@@ -0,0 +1,96 @@
+import random
+
+import pytest
+
+from formatting import split_text, render_markdown
+
+LIMIT = 4096
+
+
+def pieces(text, limit=LIMIT):
+    result = list(split_text(text, limit))
+    assert all(len(piece) <= limit for piece in result)
+    return result
+
+
+def test_short_text_is_one_piece():
+    assert pieces("hello there") == ["hello there"]
+
+
+def test_prefers_paragraph_breaks():
+    first = "a" * 3000
+    second = "b" * 3000
+    assert pieces(f"{first}\n\n{second}") == [first, second]
+
+
+def test_token_longer_than_limit_is_hard_cut():
+    text = "x" * 10000
+    result = pieces(text)
+    assert len(result) == 3
+    assert "".join(result) == text
+
+
+def test_split_code_block_is_closed_and_reopened():
+    code = "\n".join(f"print({i})" for i in range(1000))
+    result = pieces(f"Here:\n```python\n{code}\n```\nDone")
+    assert len(result) == 3
+    assert result[0].endswith("\n```")
+    assert result[1].startswith("```python\n")
+    assert result[1].endswith("\n```")
+    assert result[2].startswith("```python\n")
+
+
+def test_long_fence_line_reopens_only_the_marker():
+    text = '```json {"data": "' + "q" * 5000 + '"}\n```'
+    result = pieces(text)
+    assert len(result) == 2
+    assert result[1].startswith("```json\n")
+
+
+def test_one_line_fenced_blob_is_split_like_text():
+    text = "Here you go:\n```" + '{"k": 1}, ' * 600 + "```"
+    result = pieces(text)
+    assert len(result) == 2
+    assert "".join("".join(piece.split()) for piece in result) == "".join(text.split())
+
+
+def test_unterminated_fence():
+    code = "\n".join(f"line {i}" for i in range(1000))
+    result = pieces(f"```\n{code}")
+    assert len(result) == 3
+    assert all(piece.endswith("\n```") for piece in result[:-1])
+    assert all(piece.startswith("```\n") for piece in result[1:])
+
+
+def test_huge_language_tag_falls_back_to_plain_cuts():
+    text = "```" + "a" * 5000 + "\n" + "code\n" * 100
+    assert len(pieces(text)) == 2
+
+
+@pytest.mark.parametrize("limit", [5, 10, 37, 100, 500])
+def test_small_limits_always_finish(limit):
+    rng = random.Random(limit)
+    words = ["word", "```", "```py", "\n", "\n\n", "x" * 60, "end.", '```json {"a": 1}', '```{"a": 1}```']
+    for _ in range(50):
+        text = "".join(rng.choice(words) + rng.choice(" \n") for _ in range(rng.randint(1, 200)))
+        # pieces() checks that every piece fits
+        result = pieces(text, limit)
+        if "```" not in text:
+            assert "".join("".join(piece.split()) for piece in result) == "".join(text.split())
+
+
+def test_text_is_kept_when_split():
+    text = " ".join(f"Sentence number {i}." for i in range(2000))
+    assert "".join("".join(piece.split()) for piece in pieces(text)) == "".join(text.split())
+
+
+def test_render_markdown_escapes_and_formats():
+    assert render_markdown("**bold** <b> & _it_") == "<b>bold</b> &lt;b&gt; &amp; <i>it</i>"
+
+
+def test_render_markdown_code_block():
+    assert render_markdown("```python\nx < 1\n```") == '<pre><code class="language-python">x &lt; 1</code></pre>'
+
+
+def test_render_markdown_unterminated_code_block():
+    assert render_markdown("see\n```\na <b>\n") == "see\n<pre>a &lt;b&gt;</pre>\n"
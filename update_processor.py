@@ -0,0 +1,127 @@
+import os
+import time
+import asyncio
+import logging
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from metrics import UPDATES_TOTAL
+import profiling
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# How many updates may run handlers at the same time
+MAX_CONCURRENT_UPDATES = int(os.environ.get("MAX_CONCURRENT_UPDATES", "64"))
+
+# How many updates may be accepted (running or waiting on their chat) at once
+MAX_PENDING_UPDATES = int(os.environ.get("MAX_PENDING_UPDATES", "1024"))
+
+
+def ordering_key(update):
+    """
+    Get the key whose updates must be handled one after another.
+
+    Args:
+        update (object): The incoming update
+
+    Returns:
+        int or None: The chat ID (or user ID for chat-less updates), or None if unordered
+    """
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return None
+
+
+def update_type(update):
+    """
+    Get a short name for the kind of update, for metrics.
+
+    Args:
+        update (object): The incoming update
+
+    Returns:
+        str: e.g. "message", "callback_query" or "inline_query"
+    """
+    if not isinstance(update, Update):
+        return "other"
+    for kind in ("message", "edited_message", "callback_query", "inline_query", "chosen_inline_result"):
+        if getattr(update, kind) is not None:
+            return kind
+    return "other"
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates concurrently while keeping each chat's updates in order.
+
+    Updates for different chats run in parallel up to max_concurrent_updates.
+    Updates for the same chat wait for the previous one to finish, and do not
+    take up a concurrency slot while waiting, so one busy chat can't starve
+    the others.
+    """
+
+    def __init__(self, max_concurrent_updates=MAX_CONCURRENT_UPDATES,
+                 max_pending_updates=MAX_PENDING_UPDATES):
+        super().__init__(max(max_pending_updates, max_concurrent_updates))
+        self.active_limit = max_concurrent_updates
+        self._active = None
+        self._chat_locks = {}
+
+    @property
+    def waiting_chats(self):
+        """
+        Number of chats that currently have updates running or queued
+        """
+        return len(self._chat_locks)
+
+    async def do_process_update(self, update, coroutine):
+        """
+        Run the update's handlers once its chat is free and a slot is available
+        """
+        kind = update_type(update)
+        UPDATES_TOTAL.inc(type=kind)
+
+        with profiling.profiled(kind):
+            arrived = time.perf_counter()
+            key = ordering_key(update)
+            # Each keystroke supersedes the user's last inline query, so they must not queue behind it
+            if key is None or kind == "inline_query":
+                async with self._active:
+                    profiling.add_span("queued", time.perf_counter() - arrived)
+                    await coroutine
+                return
+
+            # asyncio.Lock wakes waiters in FIFO order, which keeps the chat's updates ordered
+            entry = self._chat_locks.get(key)
+            if entry is None:
+                entry = self._chat_locks[key] = [asyncio.Lock(), 0]
+            entry[1] += 1
+
+            try:
+                async with entry[0]:
+                    async with self._active:
+                        profiling.add_span("queued", time.perf_counter() - arrived)
+                        await coroutine
+            finally:
+                # Forget the lock once nobody is using it so the dict stays small
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._chat_locks[key]
+
+    async def initialize(self):
+        """
+        Create the concurrency limiter inside the running event loop
+        """
+        self._active = asyncio.Semaphore(self.active_limit)
+        logger.info(f"Processing up to {self.active_limit} updates concurrently (ordered per chat)")
+
+    async def shutdown(self):
+        """
+        Nothing to release; in-flight updates are awaited by the application
+        """